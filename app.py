@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import posixpath
 import subprocess
 import shutil
 import urllib.parse
@@ -8,20 +9,46 @@ import sqlite3
 import json
 import zipfile
 import tempfile
+import hashlib
+import hmac
+import io
 import unicodedata
 import re
-from flask import Flask, request, redirect, url_for, render_template_string, send_file, flash, session, Response, jsonify
+import time
+import uuid
+import click
+import threading
+import multiprocessing
+import queue
+import signal
+import sys
+import struct
+import select
+import ctypes
+import ctypes.util
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from flask import Flask, request, redirect, url_for, render_template_string, send_file, flash, session, Response, jsonify, g, has_app_context, has_request_context, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import ClientDisconnected
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 from sqlalchemy import or_, case, and_, event, func, not_
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.sql.util import ClauseAdapter
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape, quoteattr
 from functools import wraps
 from PIL import Image # Them thu vien Pillow de xu ly anh
 
 # --- CAU HINH UNG DUNG ---
-CONFIG_FILE = 'config.json'
+CONFIG_FILE = os.environ.get('THUVIEN_CONFIG', 'config.json') # Cho phep chi dinh file cau hinh khac (vd. cho benchmark)
 
 def load_config():
     """Tai cau hinh tu file config.json, hoac tao file neu chua co."""
@@ -31,7 +58,21 @@ def load_config():
         'data_path': default_path,
         'port': 5000,
         'theme': 'dark',
-        'theme_color': 'cyan'
+        'theme_color': 'cyan',
+        'query_budget': 30, # So truy van SQL toi da cho mot request truoc khi ghi log canh bao
+        'n_plus_one_threshold': 5, # Cung mot cau lenh lap lai tu so lan nay tro len bi coi la N+1
+        'debug_toolbar': False,
+        'slow_query_ms': 0, # Ghi log cac truy van cham hon nguong nay (ms), 0 = tat
+        'slow_query_log_max_mb': 5,
+        'metrics_token': '', # /metrics nhan header Authorization: Bearer <token>; de trong thi chi quan tri vien dang nhap xem duoc
+        'convert_concurrency': 2, # So ebook-convert chay dong thoi tren ca may (moi worker cong lai)
+        'convert_timeout': 1800, # Giay; qua thoi gian nay tien trinh chuyen doi bi dung
+        'conversion_cache_mb': 2048, # Dung luong toi da cho cac ban chuyen doi khi tai ve
+        'upload_max_mb': 2048, # Kich thuoc toi da cua mot file sach (tai len, thu muc theo doi, nhap Calibre)
+        'user_quota_mb': 0, # Tong dung luong sach toi da cua moi nguoi dung, 0 = khong gioi han
+        'cover_workers': 0, # So process xu ly anh bia khi nhap hang loat, 0 = so nhan CPU
+        'cover_backfill_workers': 4, # So sach tao lai anh bia dong thoi (moi sach mot ebook-meta), 0 = so nhan CPU
+        'watch_poll_seconds': 60 # Chu ky quet lai thu muc theo doi khi khong co inotify
     }
     if not os.path.exists(CONFIG_FILE):
         save_config(default_config)
@@ -68,6 +109,7 @@ ADMIN_PASSWORD = 'password'
 GUEST_USERNAME = 'guest'
 BOOKS_PER_PAGE = 21 # Tang so luong sach moi trang
 COVER_MAX_HEIGHT = 600
+CONVERT_TARGET_FORMATS = ('epub', 'mobi', 'pdf', 'azw3')
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -125,6 +167,80 @@ class Book(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('books', lazy=True, cascade="all, delete-orphan"))
     has_cover = db.Column(db.Boolean, default=False, nullable=False)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), index=True) # Noi dung file trong kho blobs/
+
+class Tag(db.Model):
+    __tablename__ = 'tag'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), unique=True, nullable=False)
+
+# Bang the chuan hoa tu Book.tags ("a, b"), dong bo boi sync_book_tags()
+book_tag = db.Table('book_tag',
+    db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    db.Index('ix_book_tag_tag', 'tag_id', 'book_id')
+)
+
+class TagCount(db.Model):
+    """So sach (tua + tac gia) cua moi user co the nay, do trigger tren book_tag cap nhat."""
+    __tablename__ = 'tag_count'
+    user_id = db.Column(db.Integer, primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+class FacetCount(db.Model):
+    """So sach (tua + tac gia) cua moi user theo tung gia tri cua mot thuoc tinh loc, do trigger tren book cap nhat."""
+    __tablename__ = 'facet_count'
+    __table_args__ = (db.Index('ix_facet_count_top', 'user_id', 'facet', 'count'),)
+    user_id = db.Column(db.Integer, primary_key=True)
+    facet = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.String(200), primary_key=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+class Blob(db.Model):
+    __tablename__ = 'blob'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ext = db.Column(db.String(20), nullable=False) # ebook-meta / ebook-convert nhan dang dinh dang theo duoi file
+    refcount = db.Column(db.Integer, default=0, nullable=False) # So Book tro toi, do trigger cap nhat
+    opf_metadata = db.Column(db.Text) # JSON ket qua ebook-meta --to-opf, dung lai cho ban tai len trung noi dung
+    has_cover = db.Column(db.Boolean) # None = chua trich xuat anh bia
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_session'
+    id = db.Column(db.String(32), primary_key=True) # uuid4 hex, nam trong URL
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, default=0, nullable=False) # So byte lien tuc da nhan tu dau file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class WatchFolder(db.Model):
+    __tablename__ = 'watch_folder'
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1000), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # Sach nhap tu thu muc thuoc ve nguoi nay
+    user = db.relationship('User')
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+    rescan_requested = db.Column(db.Boolean, default=True, nullable=False) # Vong theo doi se quet lai ca cay
+    last_scan_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class WatchedFile(db.Model):
+    """Chi muc file trong thu muc theo doi: (size, mtime) khong doi thi lan quet sau bo qua."""
+    __tablename__ = 'watched_file'
+    __table_args__ = (db.UniqueConstraint('folder_id', 'path', name='uq_watched_file_path'),)
+    id = db.Column(db.Integer, primary_key=True)
+    folder_id = db.Column(db.Integer, db.ForeignKey('watch_folder.id'), nullable=False)
+    path = db.Column(db.String(1000), nullable=False) # Tuong doi so voi thu muc theo doi, dung '/'
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64))
+    status = db.Column(db.String(20), nullable=False) # ingested, duplicate, failed
+    book_id = db.Column(db.Integer)
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class BookList(db.Model):
     __tablename__ = 'book_list'
@@ -162,6 +278,440 @@ class GuestPermission(db.Model):
     can_bookmark = db.Column(db.Boolean, default=False, nullable=False)
     can_favorite = db.Column(db.Boolean, default=False, nullable=False)
 
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    dedupe_key = db.Column(db.String(300), index=True) # Tac vu giong het dang cho/chay thi dung lai, khong tao moi
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True) # queued, running, done, failed, cancelled
+    progress = db.Column(db.Integer, default=0, nullable=False) # 0-100
+    message = db.Column(db.String(500))
+    params = db.Column(db.Text) # JSON
+    result = db.Column(db.Text) # JSON
+    cancel_requested = db.Column(db.Boolean, default=False, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(64)) # Process dang chay tac vu (xem current_worker_id)
+
+class ImportCheckpoint(db.Model):
+    """Muc (thu muc sach) da nhap xong cua mot tac vu nhap hang loat, ghi cung transaction voi cac Book."""
+    __tablename__ = 'import_checkpoint'
+    __table_args__ = (db.UniqueConstraint('job_id', 'entry', name='uq_import_checkpoint_entry'),)
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('background_job.id'), nullable=False)
+    entry = db.Column(db.String(500), nullable=False)
+    added = db.Column(db.Integer, default=0, nullable=False)
+    skipped = db.Column(db.Integer, default=0, nullable=False)
+    failed = db.Column(db.Integer, default=0, nullable=False)
+
+class LibraryGeneration(db.Model):
+    """So the he tang khi danh muc sach / ke sach thay doi (do trigger cap nhat), dung lam ETag. id = user_id, 0 = ca thu vien."""
+    __tablename__ = 'library_generation'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# --- NANG CAP CSDL (MIGRATIONS) ---
+# db.create_all() chi tao cac bang chua co, khong sua bang da ton tai. Moi thay doi
+# tren bang cu (them cot, them index, rang buoc unique, sua du lieu) phai la mot buoc
+# migration co so phien ban. Phien ban hien tai luu trong PRAGMA user_version cua books.db.
+#
+# Cach them migration moi:
+#   @schema_migration(<so tiep theo>, "Mo ta ngan")
+#   def _migration_xxx(conn):
+#       conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ...")
+# Migration phai chay lai duoc an toan (IF NOT EXISTS, kiem tra cot truoc khi ALTER),
+# vi tren CSDL moi create_all() da tao san bang tu model.
+SCHEMA_MIGRATIONS = []
+
+def schema_migration(version, description):
+    """Dang ky mot buoc nang cap CSDL voi so phien ban tang dan."""
+    def decorator(func):
+        if any(v == version for v, _, _ in SCHEMA_MIGRATIONS):
+            raise ValueError(f"Trung so phien ban migration: {version}")
+        SCHEMA_MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+def get_schema_version(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+
+def run_schema_migrations():
+    """Chay cac migration co phien ban lon hon phien ban hien tai cua books.db."""
+    with db.engine.connect() as conn:
+        current_version = get_schema_version(conn)
+
+    for version, description, func in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+        if version <= current_version:
+            continue
+        print(f"Dang nang cap CSDL len phien ban {version}: {description}")
+        with db.engine.begin() as conn:
+            func(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+        current_version = version
+
+def _create_indexes(conn, statements):
+    for statement in statements:
+        conn.exec_driver_sql(statement)
+
+@schema_migration(1, "Index va rang buoc unique cho cac truy van (user_id, book_id) va (user_id, title, author, format)")
+def _migration_core_indexes(conn):
+    # Xoa ban ghi trung lap truoc khi tao unique index, giu ban ghi cu nhat
+    for table in ('favorite', 'book_mark', 'reading_history'):
+        conn.exec_driver_sql(
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY user_id, book_id)"
+        )
+
+    _create_indexes(conn, [
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_favorite_user_book ON favorite (user_id, book_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_book_mark_user_book ON book_mark (user_id, book_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_reading_history_user_book ON reading_history (user_id, book_id)",
+        # Xoa sach can tim theo book_id
+        "CREATE INDEX IF NOT EXISTS ix_favorite_book_id ON favorite (book_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_mark_book_id ON book_mark (book_id)",
+        "CREATE INDEX IF NOT EXISTS ix_reading_history_book_id ON reading_history (book_id)",
+        # Tim sach trung lap khi ghi, tim moi dinh dang cua mot dau sach va GROUP BY title, author theo user
+        "CREATE INDEX IF NOT EXISTS ix_book_user_title_author_format ON book (user_id, title, author, format)",
+        # GROUP BY title, author tren toan thu vien (admin)
+        "CREATE INDEX IF NOT EXISTS ix_book_title_author ON book (title, author)",
+        "CREATE INDEX IF NOT EXISTS ix_book_date_added ON book (date_added)",
+        "CREATE INDEX IF NOT EXISTS ix_book_rating ON book (rating)",
+        # Khoa chinh la (book_id, book_list_id); liet ke sach trong ke can chieu nguoc lai
+        "CREATE INDEX IF NOT EXISTS ix_book_list_association_list ON book_list_association (book_list_id, book_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_list_user_name ON book_list (user_id, name)",
+    ])
+
+@schema_migration(2, "Moi dedupe_key chi co mot tac vu nen dang cho hoac dang chay")
+def _migration_background_job_dedupe(conn):
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_background_job_active ON background_job (dedupe_key) "
+        "WHERE status IN ('queued', 'running')"
+    )
+
+@schema_migration(3, "Kho file theo noi dung: cot book.blob_sha256 va trigger dem tham chieu blob")
+def _migration_blob_store(conn):
+    columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(book)")]
+    if 'blob_sha256' not in columns:
+        conn.exec_driver_sql("ALTER TABLE book ADD COLUMN blob_sha256 VARCHAR(64) REFERENCES blob (sha256)")
+    # File hien co duoc dua vao kho bang lenh: flask --app app dedupe-books
+    _create_indexes(conn, [
+        "CREATE INDEX IF NOT EXISTS ix_book_blob_sha256 ON book (blob_sha256)",
+        "CREATE INDEX IF NOT EXISTS ix_blob_unused ON blob (created_at) WHERE refcount <= 0",
+        """CREATE TRIGGER IF NOT EXISTS trg_book_blob_insert AFTER INSERT ON book
+           WHEN NEW.blob_sha256 IS NOT NULL
+           BEGIN UPDATE blob SET refcount = refcount + 1 WHERE sha256 = NEW.blob_sha256; END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_book_blob_delete AFTER DELETE ON book
+           WHEN OLD.blob_sha256 IS NOT NULL
+           BEGIN UPDATE blob SET refcount = refcount - 1 WHERE sha256 = OLD.blob_sha256; END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_book_blob_update AFTER UPDATE OF blob_sha256 ON book
+           WHEN OLD.blob_sha256 IS NOT NEW.blob_sha256
+           BEGIN
+               UPDATE blob SET refcount = refcount - 1 WHERE sha256 = OLD.blob_sha256;
+               UPDATE blob SET refcount = refcount + 1 WHERE sha256 = NEW.blob_sha256;
+           END""",
+    ])
+
+@schema_migration(4, "The he thu vien: trigger tang library_generation khi book / ke sach thay doi")
+def _migration_library_generation(conn):
+    conn.exec_driver_sql("INSERT OR IGNORE INTO library_generation (id, value, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP)")
+    bump = "BEGIN UPDATE library_generation SET value = value + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1; END"
+    _create_indexes(conn, [
+        f"CREATE TRIGGER IF NOT EXISTS trg_generation_{table}_{action.lower()} AFTER {action} ON {table} {bump}"
+        for table in ('book', 'book_list', 'book_list_association')
+        for action in ('INSERT', 'UPDATE', 'DELETE')
+    ])
+
+# Mot the chi tinh mot lan cho moi sach (tua + tac gia), du sach co nhieu dinh dang
+TAG_WORK_EXISTS_SQL = """EXISTS (SELECT 1 FROM book nb
+    JOIN book b ON b.user_id = nb.user_id AND b.title = nb.title AND b.author IS nb.author AND b.id != nb.id
+    JOIN book_tag bt ON bt.book_id = b.id AND bt.tag_id = {row}.tag_id
+    WHERE nb.id = {row}.book_id)"""
+TAG_COUNT_REBUILD_SQL = """INSERT INTO tag_count (user_id, tag_id, count)
+    SELECT user_id, tag_id, COUNT(*) FROM (
+        SELECT DISTINCT b.user_id, b.title, b.author, bt.tag_id FROM book_tag bt JOIN book b ON b.id = bt.book_id
+    ) GROUP BY user_id, tag_id"""
+
+@schema_migration(5, "The chuan hoa: bang tag / book_tag / tag_count tu cot book.tags va trigger dem so sach")
+def _migration_normalized_tags(conn):
+    rows = conn.exec_driver_sql("SELECT id, tags FROM book WHERE tags IS NOT NULL AND tags != ''").all()
+    pairs = {(book_id, name) for book_id, tags in rows for name in split_tags(tags)}
+    if pairs:
+        conn.exec_driver_sql("INSERT OR IGNORE INTO tag (name) VALUES (?)", [(name,) for name in {name for _, name in pairs}])
+        tag_ids = dict(conn.exec_driver_sql("SELECT name, id FROM tag").all())
+        conn.exec_driver_sql("INSERT OR IGNORE INTO book_tag (book_id, tag_id) VALUES (?, ?)",
+                             [(book_id, tag_ids[name]) for book_id, name in pairs])
+    conn.exec_driver_sql("DELETE FROM tag_count")
+    conn.exec_driver_sql(TAG_COUNT_REBUILD_SQL)
+    _create_indexes(conn, [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_book_tag_insert AFTER INSERT ON book_tag
+           BEGIN
+               INSERT OR IGNORE INTO tag_count (user_id, tag_id, count) SELECT user_id, NEW.tag_id, 0 FROM book WHERE id = NEW.book_id;
+               UPDATE tag_count SET count = count + 1
+               WHERE tag_id = NEW.tag_id AND user_id = (SELECT user_id FROM book WHERE id = NEW.book_id)
+                   AND NOT {TAG_WORK_EXISTS_SQL.format(row='NEW')};
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_book_tag_delete AFTER DELETE ON book_tag
+           BEGIN
+               UPDATE tag_count SET count = count - 1
+               WHERE tag_id = OLD.tag_id AND user_id = (SELECT user_id FROM book WHERE id = OLD.book_id)
+                   AND NOT {TAG_WORK_EXISTS_SQL.format(row='OLD')};
+           END""",
+        # BEFORE de trigger tren book_tag con thay dong book khi tru so dem
+        """CREATE TRIGGER IF NOT EXISTS trg_book_tag_cascade BEFORE DELETE ON book
+           BEGIN DELETE FROM book_tag WHERE book_id = OLD.id; END""",
+    ])
+
+# Thuoc tinh loc (facet): bieu thuc SQL tren mot dong book ({row} = 'NEW.' / 'OLD.' / 'book.' / '' trong index)
+FACET_SQL = {
+    'author': "{row}author",
+    'series': "{row}series",
+    'language': "{row}language",
+    'publisher': "{row}publisher",
+    'format': "{row}format",
+    'rating': "NULLIF({row}rating, 0)",
+    'year': "CASE WHEN {row}pubdate GLOB '[0-9][0-9][0-9][0-9]*' THEN substr({row}pubdate, 1, 4) END",
+}
+
+def facet_count_statements(facet, row, delta):
+    """Cong / tru mot cho gia tri facet cua dong row, tru khi sach (tua + tac gia) con dinh dang khac cung gia tri."""
+    value = FACET_SQL[facet].format(row=row)
+    statements = []
+    if delta > 0:
+        statements.append(f"INSERT OR IGNORE INTO facet_count (user_id, facet, value, count) "
+                          f"SELECT {row}user_id, '{facet}', {value}, 0 WHERE {value} IS NOT NULL AND {value} != '';")
+    statements.append(
+        f"UPDATE facet_count SET count = count {'+' if delta > 0 else '-'} 1 "
+        f"WHERE user_id = {row}user_id AND facet = '{facet}' AND value = {value} AND NOT EXISTS ("
+        f"SELECT 1 FROM book b WHERE b.user_id = {row}user_id AND b.title = {row}title AND b.author IS {row}author "
+        f"AND b.id != {row}id AND {FACET_SQL[facet].format(row='b.')} IS {value});")
+    return statements
+
+def rebuild_facet_counts(conn):
+    conn.exec_driver_sql("DELETE FROM facet_count")
+    for facet, expression in FACET_SQL.items():
+        conn.exec_driver_sql(
+            f"INSERT INTO facet_count (user_id, facet, value, count) "
+            f"SELECT user_id, '{facet}', value, COUNT(*) FROM ("
+            f"SELECT DISTINCT user_id, title, author, {expression.format(row='book.')} AS value FROM book"
+            f") WHERE value IS NOT NULL AND value != '' GROUP BY user_id, value")
+
+@schema_migration(6, "Loc theo thuoc tinh: bang facet_count, trigger dem so sach va index cho tung thuoc tinh")
+def _migration_facets(conn):
+    rebuild_facet_counts(conn)
+    changed = " OR ".join([f"({FACET_SQL[facet].format(row='OLD.')}) IS NOT ({FACET_SQL[facet].format(row='NEW.')})" for facet in FACET_SQL])
+    insert_body = "\n".join(sql for facet in FACET_SQL for sql in facet_count_statements(facet, 'NEW.', 1))
+    delete_body = "\n".join(sql for facet in FACET_SQL for sql in facet_count_statements(facet, 'OLD.', -1))
+    _create_indexes(conn, [
+        f"CREATE TRIGGER IF NOT EXISTS trg_facet_insert AFTER INSERT ON book BEGIN\n{insert_body}\nEND",
+        f"CREATE TRIGGER IF NOT EXISTS trg_facet_delete AFTER DELETE ON book BEGIN\n{delete_body}\nEND",
+        # Doi tua / tac gia cung lam sach chuyen nhom nen tinh nhu xoa dong cu roi them dong moi
+        f"CREATE TRIGGER IF NOT EXISTS trg_facet_update AFTER UPDATE OF title, author, series, language, publisher, format, rating, pubdate ON book "
+        f"WHEN OLD.title IS NOT NEW.title OR OLD.author IS NOT NEW.author OR {changed} BEGIN\n{delete_body}\n{insert_body}\nEND",
+        # Loc ket hop: (gia tri, user_id) dung duoc cho ca quan tri vien (khong loc theo user)
+        "CREATE INDEX IF NOT EXISTS ix_book_author_user ON book (author, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_language_user ON book (language, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_publisher_user ON book (publisher, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_format_user ON book (format, user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_book_rating_user ON book (rating, user_id)",
+        f"CREATE INDEX IF NOT EXISTS ix_book_year_user ON book (({FACET_SQL['year'].format(row='')}), user_id)",
+    ])
+
+@schema_migration(7, "Bo truyen: index (user_id, series, series_index) de liet ke cac tap theo thu tu")
+def _migration_series_index(conn):
+    _create_indexes(conn, [
+        "CREATE INDEX IF NOT EXISTS ix_book_user_series_index ON book (user_id, series, series_index)",
+        # Quan tri vien xem bo truyen tren toan thu vien
+        "CREATE INDEX IF NOT EXISTS ix_book_series_index ON book (series, series_index)",
+    ])
+
+@schema_migration(8, "Tac vu nen: cot background_job.worker ghi process dang chay tac vu")
+def _migration_job_worker(conn):
+    columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(background_job)")]
+    if 'worker' not in columns:
+        conn.exec_driver_sql("ALTER TABLE background_job ADD COLUMN worker VARCHAR(64)")
+
+# Cot cua book hien trong danh muc (OPDS, bo truyen); doi has_cover / rating... khong tang the he
+GENERATION_BOOK_COLUMNS = ('title', 'author', 'format', 'filename', 'tags', 'description', 'series', 'series_index',
+                           'publisher', 'pubdate', 'language', 'date_added', 'user_id')
+
+def generation_bump_sql(user_id):
+    """Tang the he cua ca thu vien (id 0) va cua user co id la bieu thuc user_id."""
+    return (f"INSERT OR IGNORE INTO library_generation (id, value, updated_at) "
+            f"SELECT {user_id}, 0, CURRENT_TIMESTAMP WHERE {user_id} IS NOT NULL; "
+            f"UPDATE library_generation SET value = value + 1, updated_at = CURRENT_TIMESTAMP WHERE id IN (0, {user_id});")
+
+@schema_migration(9, "The he thu vien theo tung user, chi tang khi cot hien trong danh muc thay doi")
+def _migration_user_generation(conn):
+    conn.exec_driver_sql("UPDATE library_generation SET id = 0 WHERE id = 1 AND NOT EXISTS (SELECT 1 FROM library_generation WHERE id = 0)")
+    conn.exec_driver_sql("INSERT OR IGNORE INTO library_generation (id, value, updated_at) VALUES (0, 0, CURRENT_TIMESTAMP)")
+    for table in ('book', 'book_list', 'book_list_association'):
+        for action in ('insert', 'update', 'delete'):
+            conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS trg_generation_{table}_{action}")
+    list_owner = "(SELECT user_id FROM book_list WHERE id = {row}.book_list_id)"
+    _create_indexes(conn, [
+        f"CREATE TRIGGER trg_generation_book_insert AFTER INSERT ON book BEGIN {generation_bump_sql('NEW.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_delete AFTER DELETE ON book BEGIN {generation_bump_sql('OLD.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_update AFTER UPDATE OF {', '.join(GENERATION_BOOK_COLUMNS)} ON book "
+        f"BEGIN {generation_bump_sql('OLD.user_id')} {generation_bump_sql('NEW.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_list_insert AFTER INSERT ON book_list BEGIN {generation_bump_sql('NEW.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_list_delete AFTER DELETE ON book_list BEGIN {generation_bump_sql('OLD.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_list_update AFTER UPDATE ON book_list "
+        f"BEGIN {generation_bump_sql('OLD.user_id')} {generation_bump_sql('NEW.user_id')} END",
+        f"CREATE TRIGGER trg_generation_book_list_association_insert AFTER INSERT ON book_list_association "
+        f"BEGIN {generation_bump_sql(list_owner.format(row='NEW'))} END",
+        f"CREATE TRIGGER trg_generation_book_list_association_delete AFTER DELETE ON book_list_association "
+        f"BEGIN {generation_bump_sql(list_owner.format(row='OLD'))} END",
+    ])
+
+# Sach (tua + tac gia + user cua dong {row}) con dinh dang khac mang the cua dong tag_count dang xet
+TAG_OTHER_FORMAT_SQL = """EXISTS (SELECT 1 FROM book b JOIN book_tag bt ON bt.book_id = b.id AND bt.tag_id = tag_count.tag_id
+    WHERE b.user_id = {row}.user_id AND b.title = {row}.title AND b.author IS {row}.author AND b.id != {row}.id)"""
+
+@schema_migration(10, "Dem the: cap nhat tag_count khi doi tua / tac gia / chu sach, khong de so dem am")
+def _migration_tag_count_work_update(conn):
+    conn.exec_driver_sql("DROP TRIGGER IF EXISTS trg_book_tag_delete")
+    book_tags = "(SELECT tag_id FROM book_tag WHERE book_id = NEW.id)"
+    _create_indexes(conn, [
+        f"""CREATE TRIGGER trg_book_tag_delete AFTER DELETE ON book_tag
+           BEGIN
+               UPDATE tag_count SET count = MAX(count - 1, 0)
+               WHERE tag_id = OLD.tag_id AND user_id = (SELECT user_id FROM book WHERE id = OLD.book_id)
+                   AND NOT {TAG_WORK_EXISTS_SQL.format(row='OLD')};
+           END""",
+        # Dinh dang chuyen sang sach (tua + tac gia) khac: the cua no roi sach cu, vao sach moi
+        f"""CREATE TRIGGER trg_book_tag_work_update AFTER UPDATE OF title, author, user_id ON book
+           WHEN OLD.title IS NOT NEW.title OR OLD.author IS NOT NEW.author OR OLD.user_id IS NOT NEW.user_id
+           BEGIN
+               UPDATE tag_count SET count = MAX(count - 1, 0)
+               WHERE user_id = OLD.user_id AND tag_id IN {book_tags} AND NOT {TAG_OTHER_FORMAT_SQL.format(row='OLD')};
+               INSERT OR IGNORE INTO tag_count (user_id, tag_id, count) SELECT NEW.user_id, tag_id, 0 FROM book_tag WHERE book_id = NEW.id;
+               UPDATE tag_count SET count = count + 1
+               WHERE user_id = NEW.user_id AND tag_id IN {book_tags} AND NOT {TAG_OTHER_FORMAT_SQL.format(row='NEW')};
+           END""",
+    ])
+    # So dem da lech truoc khi co trigger nay
+    conn.exec_driver_sql("DELETE FROM tag_count")
+    conn.exec_driver_sql(TAG_COUNT_REBUILD_SQL)
+
+def _write_cover_image(img, dest_paths):
+    if img.height > COVER_MAX_HEIGHT:
+        # JPEG: giai ma luon o ti le 1/2, 1/4 hoac 1/8 (van lon hon kich thuoc dich) roi moi LANCZOS
+        img.draft('RGB', (img.width * COVER_MAX_HEIGHT // img.height, COVER_MAX_HEIGHT))
+        ratio = COVER_MAX_HEIGHT / img.height
+        new_width = int(img.width * ratio)
+        img = img.resize((new_width, COVER_MAX_HEIGHT), Image.Resampling.LANCZOS)
+    if img.mode in ("RGBA", "P"):
+        img = img.convert("RGB")
+    for dest_path in dest_paths:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        img.save(dest_path, 'jpeg', quality=80, optimize=True)
+
+def save_cover_image(img, dest_paths):
+    """Thu nho anh bia ve COVER_MAX_HEIGHT, chuyen sang RGB va luu JPEG vao tung duong dan."""
+    with metrics_timer('thuvien_cover_resize_seconds'):
+        _write_cover_image(img, dest_paths)
+
+# Anh bia khi nhap hang loat duoc giai ma / thu nho / nen JPEG song song tren nhieu process
+# (Pillow giu GIL khi LANCZOS va optimize=True nen thread khong giup duoc).
+COVER_POOL_MIN_TASKS = 4 # It anh hon thi xu ly ngay trong process hien tai
+_cover_pool = None
+_cover_pool_workers = 0
+_cover_pool_lock = threading.Lock()
+
+def _get_cover_pool():
+    global _cover_pool, _cover_pool_workers
+    with _cover_pool_lock:
+        if _cover_pool is None:
+            _cover_pool_workers = int(config.get('cover_workers') or 0) or os.cpu_count() or 1
+            # Khong fork: process nay co nhieu thread (tac vu nen, thu muc theo doi, SSE), process con
+            # fork ra co the ket o mot khoa dang bi thread khac giu (vd. _metrics_lock, logging)
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _cover_pool = ProcessPoolExecutor(max_workers=_cover_pool_workers,
+                                              mp_context=multiprocessing.get_context(start_method))
+        return _cover_pool
+
+def _reset_cover_pool():
+    global _cover_pool
+    with _cover_pool_lock:
+        if _cover_pool is not None:
+            _cover_pool.shutdown(wait=False, cancel_futures=True)
+            _cover_pool = None
+
+def _resize_cover_task(source, dest_paths):
+    """
+    Chay trong process con: source la duong dan hoac noi dung (bytes) cua anh goc. Tra ve thoi
+    gian xu ly (giay) de process cha ghi so lieu (so lieu ghi trong process con bi mat).
+    """
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        _write_cover_image(img, dest_paths)
+    return time.perf_counter() - started
+
+def process_covers_in_parallel(tasks, on_progress=None):
+    """
+    Xu ly nhieu anh bia qua process pool. tasks la danh sach (khoa, load_source, dest_paths);
+    load_source() chi duoc goi khi gui viec (so anh dang xu ly co gioi han) nen ca lo anh khong
+    nam trong bo nho cung luc. on_progress(da xong, tong) sau moi anh. Tra ve tap khoa thanh cong.
+    """
+    done_keys = set()
+    finished = 0
+
+    def record(key, error):
+        nonlocal finished
+        if error is None:
+            done_keys.add(key)
+        else:
+            print(f"Không đọc được ảnh bìa {key}: {error}")
+        finished += 1
+        if on_progress:
+            on_progress(finished, len(tasks))
+
+    def run_inline(key, load_source, dest_paths):
+        try:
+            metrics_observe('thuvien_cover_resize_seconds', _resize_cover_task(load_source(), dest_paths))
+            record(key, None)
+        except Exception as e:
+            record(key, e)
+
+    if len(tasks) < COVER_POOL_MIN_TASKS:
+        for task in tasks:
+            run_inline(*task)
+        return done_keys
+
+    pool = _get_cover_pool()
+    in_flight = {}
+    pending_tasks = deque(tasks)
+    while pending_tasks or in_flight:
+        while pending_tasks and len(in_flight) < _cover_pool_workers * 2:
+            key, load_source, dest_paths = pending_tasks.popleft()
+            try:
+                in_flight[pool.submit(_resize_cover_task, load_source(), dest_paths)] = (key, load_source, dest_paths)
+            except BrokenProcessPool:
+                # Process con chet (vd. het bo nho): lam not phan con lai ngay tai day
+                _reset_cover_pool()
+                run_inline(key, load_source, dest_paths)
+                while pending_tasks:
+                    run_inline(*pending_tasks.popleft())
+            except Exception as e:
+                record(key, e)
+        if not in_flight:
+            continue
+        completed, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in completed:
+            task = in_flight.pop(future)
+            try:
+                metrics_observe('thuvien_cover_resize_seconds', future.result())
+                record(task[0], None)
+            except BrokenProcessPool:
+                _reset_cover_pool()
+                run_inline(*task)
+            except Exception as e:
+                record(task[0], e)
+    return done_keys
+
 def get_cover_path(book):
     """Tao duong dan file anh bia tinh cho mot cuon sach."""
     user_cover_dir = os.path.join(app.config['COVER_FOLDER'], str(book.user_id))
@@ -181,34 +731,41 @@ def generate_and_save_cover(book):
         return False
 
     final_cover_path = get_cover_path(book)
-    os.makedirs(os.path.dirname(final_cover_path), exist_ok=True)
+
+    # Noi dung nay da duoc trich xuat anh bia truoc do (co the cua nguoi dung khac)
+    blob = db.session.get(Blob, book.blob_sha256) if book.blob_sha256 else None
+    if blob is not None and blob.has_cover is not None:
+        cached_cover = blob_cover_path(blob.sha256)
+        if not blob.has_cover or os.path.exists(cached_cover):
+            if blob.has_cover:
+                os.makedirs(os.path.dirname(final_cover_path), exist_ok=True)
+                shutil.copyfile(cached_cover, final_cover_path) # Sao chep, khong link: anh bia co the bi sua rieng
+            book.has_cover = bool(blob.has_cover)
+            db.session.commit()
+            return book.has_cover
 
     with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_cover:
         temp_cover_path = tmp_cover.name
 
     try:
-        subprocess.run(
+        run_calibre_tool(
             ["ebook-meta", book_filepath, "--get-cover", temp_cover_path],
             check=True, capture_output=True, timeout=30
         )
 
         if os.path.exists(temp_cover_path) and os.path.getsize(temp_cover_path) > 0:
             with Image.open(temp_cover_path) as img:
-                if img.height > COVER_MAX_HEIGHT:
-                    ratio = COVER_MAX_HEIGHT / img.height
-                    new_width = int(img.width * ratio)
-                    img = img.resize((new_width, COVER_MAX_HEIGHT), Image.Resampling.LANCZOS)
-                
-                if img.mode in ("RGBA", "P"):
-                    img = img.convert("RGB")
-                    
-                img.save(final_cover_path, 'jpeg', quality=80, optimize=True)
+                save_cover_image(img, [final_cover_path] + ([blob_cover_path(blob.sha256)] if blob is not None else []))
             
             book.has_cover = True
+            if blob is not None:
+                blob.has_cover = True
             db.session.commit()
             return True
         else:
             book.has_cover = False
+            if blob is not None:
+                blob.has_cover = False
             db.session.commit()
             return False
 
@@ -221,6 +778,218 @@ def generate_and_save_cover(book):
         if os.path.exists(temp_cover_path):
             os.remove(temp_cover_path)
 
+# --- KHO FILE THEO NOI DUNG (BLOB STORE) ---
+# Moi noi dung sach chi luu mot lan o blobs/<sha256[:2]>/<sha256>.<duoi>. File trong
+# books/<user_id>/ la hard link toi blob nen moi cho doc file cu van dung duoc, con nhieu
+# nguoi tai len cung mot file thi chi ton dung luong mot lan. blob.refcount (so Book tro
+# toi) do trigger trong CSDL cap nhat; blob het tham chieu bi xoa boi collect_unused_blobs().
+# Ket qua ebook-meta va anh bia trich xuat cung duoc luu theo blob de khong chay lai.
+# File trong thu vien khong bao gio duoc ghi de tai cho (no dung chung inode voi blob).
+BLOB_FOLDER = os.path.join(DATA_ROOT, 'blobs')
+BLOB_TMP_FOLDER = os.path.join(BLOB_FOLDER, 'tmp')
+BLOB_GC_GRACE_SECONDS = 3600 # Blob moi luu chua kip gan vao Book thi khong bi don
+
+def blob_path(sha256, ext):
+    return os.path.join(BLOB_FOLDER, sha256[:2], f"{sha256}.{ext}")
+
+def blob_cover_path(sha256):
+    return os.path.join(BLOB_FOLDER, sha256[:2], f"{sha256}.cover.jpg")
+
+def spool_to_blob_store(stream, ext):
+    """Ghi stream vao thu muc tam cua kho, vua ghi vua bam. Tra ve (duong dan tam, sha256, so byte)."""
+    os.makedirs(BLOB_TMP_FOLDER, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=BLOB_TMP_FOLDER, suffix=f".{ext}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+def store_blob(temp_path, sha256, size, ext):
+    """Dua file tam da bam vao kho (hoac bo no neu noi dung da co). Tra ve Blob."""
+    # Cham created_at truoc khi dung lai blob: lenh UPDATE giu khoa ghi SQLite den khi Book moi
+    # duoc commit, va blob vua cham nam trong thoi gian an toan, nen collect_unused_blobs() khong
+    # xoa mat blob refcount 0 ma request nay sap tro toi
+    reused = db.session.execute(
+        db.update(Blob).where(Blob.sha256 == sha256).values(created_at=datetime.utcnow())
+    ).rowcount
+    blob = db.session.get(Blob, sha256, populate_existing=True) if reused else None
+    if blob is not None and os.path.exists(blob_path(sha256, blob.ext)):
+        os.remove(temp_path)
+        metrics_inc('thuvien_blob_dedupe_bytes_total', size)
+        return blob
+
+    ext = blob.ext if blob is not None else ext
+    dest_path = blob_path(sha256, ext)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    os.replace(temp_path, dest_path)
+    # INSERT OR IGNORE: hai request cung luu mot noi dung moi cung luc van an toan
+    db.session.execute(
+        sqlite_insert(Blob).values(sha256=sha256, size=size, ext=ext, refcount=0, created_at=datetime.utcnow())
+        .on_conflict_do_nothing()
+    )
+    return db.session.get(Blob, sha256)
+
+def link_blob_into_library(blob, user_id, filename):
+    """Tao books/<user_id>/<filename> tro toi blob. Tra ve ten file thuc te (them _1, _2... neu trung ten)."""
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
+    os.makedirs(user_folder, exist_ok=True)
+    source = blob_path(blob.sha256, blob.ext)
+    base, ext = os.path.splitext(filename)
+    candidate = filename
+    counter = 1
+    while True:
+        dest = os.path.join(user_folder, candidate)
+        try:
+            try:
+                os.link(source, dest)
+            except FileExistsError:
+                raise
+            except OSError:
+                # He thong file khong ho tro hard link: sao chep (van khong ghi de file da co)
+                with open(source, 'rb') as src, open(dest, 'xb') as out:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+            else:
+                # Hard link dung chung inode nen mang mtime cu cua blob: dat lai de kiem tra
+                # "vua ghi" (recently_modified) cua fsck/GC thay file nay con moi
+                try:
+                    os.utime(dest)
+                except OSError:
+                    pass
+            return candidate
+        except FileExistsError:
+            candidate = f"{base}_{counter}{ext}"
+            counter += 1
+
+def blob_metadata(blob):
+    """Metadata tu ebook-meta cho blob; moi noi dung chi chay ebook-meta mot lan."""
+    if blob.opf_metadata is not None:
+        return json.loads(blob.opf_metadata)
+    try:
+        metadata = read_opf_metadata(blob_path(blob.sha256, blob.ext))
+    except Exception as e:
+        print(f"Cảnh báo: Không thể trích xuất metadata cho blob {blob.sha256[:12]}. Lỗi: {e}.")
+        return {}
+    blob.opf_metadata = json.dumps(metadata, ensure_ascii=False)
+    return metadata
+
+def add_book_from_blob(blob, filename, user_id):
+    """Them sach vao thu vien cua user tu blob da luu. Tra ve None neu user da co sach nay."""
+    metadata = default_metadata(filename)
+    metadata.update(blob_metadata(blob))
+
+    existing_book = Book.query.filter(Book.user_id == user_id, or_(
+        Book.blob_sha256 == blob.sha256,
+        and_(Book.title == metadata.get('title'), Book.author == metadata.get('author'), Book.format == metadata.get('format'))
+    )).first()
+    if existing_book:
+        return None
+
+    stored_filename = link_blob_into_library(blob, user_id, filename)
+    new_book = Book(filename=stored_filename, user_id=user_id, blob_sha256=blob.sha256, **metadata)
+    db.session.add(new_book)
+    return new_book
+
+def collect_unused_blobs():
+    """Xoa blob khong con Book nao tro toi, cung file tam cua cac lan tai len bi ngat giua chung."""
+    cutoff = datetime.utcnow() - timedelta(seconds=BLOB_GC_GRACE_SECONDS)
+    unused = db.session.execute(
+        db.select(Blob.sha256, Blob.ext).where(Blob.refcount <= 0, Blob.created_at < cutoff)
+    ).all()
+    removed = 0
+    for sha256, ext in unused:
+        # Kiem tra lai trong chinh lenh DELETE (store_blob co the vua dung lai blob) va chi xoa file
+        # khi con giu khoa ghi: request dung lai blob phai cho toi khi commit ben duoi
+        deleted = db.session.execute(
+            db.delete(Blob).where(Blob.sha256 == sha256, Blob.refcount <= 0, Blob.created_at < cutoff)
+        ).rowcount
+        if not deleted:
+            continue
+        for path in (blob_path(sha256, ext), blob_cover_path(sha256)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Khong the xoa blob {path}: {e}")
+        removed += 1
+    db.session.commit()
+
+    if os.path.isdir(BLOB_TMP_FOLDER):
+        for entry in os.scandir(BLOB_TMP_FOLDER):
+            try:
+                if entry.stat().st_mtime < time.time() - BLOB_GC_GRACE_SECONDS:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+    return removed
+
+@app.cli.command('dedupe-books')
+@click.option('--batch-size', default=200, show_default=True, help='So sach xu ly moi lan commit.')
+def dedupe_books_command(batch_size):
+    """Dua file sach hien co vao kho theo noi dung, gop cac ban trung nhau (chay lai duoc)."""
+    processed = merged = missing = 0
+    saved_bytes = 0
+    last_id = 0
+    while True:
+        books = (Book.query.filter(Book.blob_sha256.is_(None), Book.id > last_id)
+                 .order_by(Book.id).limit(batch_size).all())
+        if not books:
+            break
+        for book in books:
+            last_id = book.id
+            path = os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id), book.filename)
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            sha256 = file_sha256(path)
+            blob = db.session.get(Blob, sha256)
+            stored = blob_path(sha256, blob.ext) if blob is not None else None
+            if stored and os.path.exists(stored):
+                if not os.path.samefile(stored, path):
+                    # Thay ban sao bang hard link toi blob (doi ten nguyen tu, file luon ton tai)
+                    temp_link = path + '.dedupe'
+                    try:
+                        os.link(stored, temp_link)
+                        os.replace(temp_link, path)
+                        saved_bytes += blob.size
+                        merged += 1
+                    except OSError as e:
+                        print(f"Khong the gop {path}: {e}")
+            else:
+                ext = blob.ext if blob is not None else (os.path.splitext(book.filename)[1][1:].lower() or book.format or 'bin')
+                stored = blob_path(sha256, ext)
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                try:
+                    os.link(path, stored)
+                except OSError:
+                    shutil.copyfile(path, stored)
+                db.session.execute(
+                    sqlite_insert(Blob).values(sha256=sha256, size=os.path.getsize(path), ext=ext, refcount=0,
+                                               created_at=datetime.utcnow())
+                    .on_conflict_do_nothing()
+                )
+                blob = db.session.get(Blob, sha256)
+            # Anh bia da trich xuat cua sach nay dung lai cho cac lan tai len sau
+            cover_path = get_cover_path(book)
+            if book.has_cover and blob.has_cover is None and os.path.exists(cover_path):
+                shutil.copyfile(cover_path, blob_cover_path(sha256))
+                blob.has_cover = True
+            book.blob_sha256 = sha256
+            processed += 1
+        db.session.commit()
+        print(f"Da xu ly {processed} sach (den ID {last_id}), gop {merged} ban trung, tiet kiem {saved_bytes / 1024 / 1024:.1f} MB.")
+
+    print(f"Hoan tat: {processed} sach dua vao kho, {merged} ban trung duoc gop, "
+          f"tiet kiem {saved_bytes / 1024 / 1024:.1f} MB, {missing} sach khong tim thay file.")
+
 def initialize_database():
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['COVER_FOLDER'], exist_ok=True)
@@ -238,6 +1007,7 @@ def initialize_database():
 
     with app.app_context():
         db.create_all()
+        run_schema_migrations()
         if not User.query.filter_by(username=ADMIN_USERNAME).first():
             db.session.add(User(username=ADMIN_USERNAME, password=ADMIN_PASSWORD, is_admin=True, is_active=True))
         if not User.query.filter_by(username=GUEST_USERNAME).first():
@@ -247,6 +1017,26 @@ def initialize_database():
         db.session.commit()
 
 # --- DECORATORS & CONTEXT PROCESSORS ---
+def login_from_basic_auth():
+    """
+    Xac thuc rieng request nay bang header Authorization: Basic (API, may doc OPDS khong giu
+    cookie). Thong tin user chi nam trong g.basic_auth, khong ghi vao session (cookie), nen
+    khong mo duoc cac trang HTML / form quan tri.
+    """
+    auth = request.authorization
+    if not auth or auth.type != 'basic':
+        return False
+    user = User.query.filter_by(username=auth.username).first()
+    if not user or not user.is_active or user.password != (auth.password or ''):
+        return False
+    g.basic_auth = {'logged_in': True, 'is_admin': user.is_admin, 'username': user.username, 'user_id': user.id}
+    return True
+
+def current_auth(key):
+    """logged_in / is_admin / username / user_id cua request: tu Basic auth (g) neu co, khong thi tu session."""
+    basic_auth = g.get('basic_auth')
+    return basic_auth.get(key) if basic_auth is not None else session.get(key)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -256,12 +1046,34 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def download_login_required(f):
+    """Nhu login_required nhung nhan them Basic auth: link tai sach trong OPDS / API dung route nay."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('logged_in') and not login_from_basic_auth():
+            if request.authorization:
+                return Response("Sai tên đăng nhập hoặc mật khẩu.", 401, {'WWW-Authenticate': 'Basic realm="thuvien"'})
+            flash('Bạn cần đăng nhập để xem trang này.', 'danger')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
 def check_book_permission(book_id):
     book = Book.query.get_or_404(book_id)
-    if session.get('is_admin') or (book and book.user_id == session.get('user_id')):
+    if current_auth('is_admin') or (book and book.user_id == current_auth('user_id')):
         return book
     return None
 
+def guest_allowed(permission):
+    """Tai khoan khach chi duoc lam nhung gi GuestPermission cho phep; tai khoan khac luon duoc."""
+    if current_auth('username') != GUEST_USERNAME:
+        return True
+    permissions = GuestPermission.query.first()
+    return bool(permissions and getattr(permissions, permission))
+
+def render_file_browser():
+    return render_template_string(FILE_BROWSER_TEMPLATE, safe_root=SAFE_BROWSING_ROOT.replace('\\', '/'))
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -284,9 +1096,876 @@ def inject_global_vars():
         library_users=library_users,
         GUEST_USERNAME=GUEST_USERNAME,
         ADMIN_USERNAME=ADMIN_USERNAME,
+        bulk_actions=BULK_ACTIONS,
         app_config=load_config() 
     )
 
+# --- THONG KE TRUY VAN SQL THEO REQUEST ---
+_query_recorders = threading.local()
+_IN_LIST_PATTERN = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+def normalize_statement(statement):
+    """Rut gon cau lenh SQL ve 'hinh dang' de nhom cac lan goi giong nhau (bo qua do dai IN (...))."""
+    statement = _IN_LIST_PATTERN.sub('(?...)', statement)
+    return ' '.join(statement.split())
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    shape = normalize_statement(statement)
+
+    if has_app_context() and 'query_stats' in g:
+        g.query_stats['count'] += 1
+        g.query_stats['time'] += elapsed
+        g.query_stats['shapes'][shape] += 1
+
+    for recorder in getattr(_query_recorders, 'stack', []):
+        recorder.append((shape, elapsed))
+
+    slow_query_ms = config.get('slow_query_ms') or 0
+    if slow_query_ms > 0 and elapsed * 1000 >= slow_query_ms and not executemany:
+        log_slow_query(cursor, statement, parameters, shape, elapsed)
+
+@event.listens_for(Engine, "handle_error")
+def _cursor_execute_error(context):
+    # after_cursor_execute khong chay khi cau lenh loi (IntegrityError, database is locked...):
+    # bo moc thoi gian da day vao, neu khong cac lan do sau tren ket noi nay bi lech cap
+    if context.connection is not None and context.statement is not None:
+        starts = context.connection.info.get('query_start_time')
+        if starts:
+            starts.pop()
+
+def find_n_plus_one(shapes, threshold=None):
+    """Tra ve cac cau lenh lap lai >= threshold lan, sap xep giam dan theo so lan."""
+    threshold = threshold or config.get('n_plus_one_threshold', 5)
+    return [(shape, n) for shape, n in shapes.most_common() if n >= threshold]
+
+@app.before_request
+def _start_query_stats():
+    g.query_stats = {'count': 0, 'time': 0.0, 'shapes': Counter(), 'started': time.perf_counter()}
+
+@app.after_request
+def _report_query_stats(response):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+
+    total_ms = (time.perf_counter() - stats['started']) * 1000
+    db_ms = stats['time'] * 1000
+    response.headers.add('Server-Timing', f'db;dur={db_ms:.1f};desc="{stats["count"]} queries"')
+    response.headers.add('Server-Timing', f'app;dur={total_ms:.1f}')
+
+    endpoint = request.endpoint or 'unknown'
+    metrics_observe('thuvien_http_request_duration_seconds', total_ms / 1000, endpoint=endpoint, method=request.method)
+    metrics_inc('thuvien_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    metrics_observe('thuvien_db_time_seconds', stats['time'], endpoint=endpoint)
+    metrics_inc('thuvien_db_queries_total', stats['count'], endpoint=endpoint)
+    flush_metrics()
+
+    suspects = find_n_plus_one(stats['shapes'])
+    budget = config.get('query_budget', 30)
+    if stats['count'] > budget:
+        print(f"Canh bao: {request.method} {request.path} chay {stats['count']} truy van SQL (gioi han {budget}), {db_ms:.1f} ms.")
+    for shape, n in suspects:
+        print(f"Nghi van N+1 tai {request.path}: {n} lan - {shape[:200]}")
+
+    if (config.get('debug_toolbar') and session.get('is_admin') and response.mimetype == 'text/html'
+            and not response.direct_passthrough and response.status_code == 200):
+        body = response.get_data(as_text=True)
+        if '</body>' in body:
+            toolbar = render_template_string(DEBUG_TOOLBAR_TEMPLATE, stats=stats, db_ms=db_ms, total_ms=total_ms, suspects=suspects, budget=budget)
+            response.set_data(body.replace('</body>', toolbar + '</body>', 1))
+    return response
+
+@contextmanager
+def query_budget(max_queries):
+    """
+    Dem truy van SQL trong khoi lenh va bao loi neu vuot qua max_queries.
+    Dung trong pytest:
+        with query_budget(10):
+            client.get('/')
+    """
+    recorded = []
+    if not hasattr(_query_recorders, 'stack'):
+        _query_recorders.stack = []
+    _query_recorders.stack.append(recorded)
+    try:
+        yield recorded
+    finally:
+        _query_recorders.stack.remove(recorded)
+    if len(recorded) > max_queries:
+        shapes = Counter(shape for shape, _ in recorded)
+        details = '\n'.join(f"  {n}x {shape[:200]}" for shape, n in shapes.most_common(10))
+        raise AssertionError(f"Vuot ngan sach truy van: {len(recorded)} > {max_queries}\n{details}")
+
+def assert_endpoint_query_budget(client, url, max_queries, method='get', **kwargs):
+    """Goi mot endpoint bang Flask test client va kiem tra so truy van SQL."""
+    with query_budget(max_queries):
+        response = getattr(client, method)(url, **kwargs)
+    return response
+
+# --- NHAT KY TRUY VAN CHAM (SLOW QUERY LOG) ---
+SLOW_QUERY_LOG_FILE = os.path.join(DATA_ROOT, 'logs', 'slow_queries.log')
+_slow_query_logger = None
+
+def get_slow_query_logger():
+    global _slow_query_logger
+    if _slow_query_logger is None:
+        os.makedirs(os.path.dirname(SLOW_QUERY_LOG_FILE), exist_ok=True)
+        logger = logging.getLogger('thuvien.slow_queries')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        handler = RotatingFileHandler(SLOW_QUERY_LOG_FILE, encoding='utf-8', backupCount=3,
+                                      maxBytes=int(config.get('slow_query_log_max_mb', 5) * 1024 * 1024))
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        _slow_query_logger = logger
+    return _slow_query_logger
+
+def _short_repr(value, limit=200):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+def log_slow_query(cursor, statement, parameters, shape, elapsed):
+    """Ghi mot truy van cham kem tham so, EXPLAIN QUERY PLAN va route dang goi."""
+    plan = []
+    if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        try:
+            explain_cursor = cursor.connection.cursor()
+            explain_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters or ())
+            plan = [row[-1] for row in explain_cursor.fetchall()]
+            explain_cursor.close()
+        except Exception as e:
+            plan = [f"Khong the EXPLAIN: {e}"]
+
+    if isinstance(parameters, dict):
+        params = {k: _short_repr(v) for k, v in parameters.items()}
+    else:
+        params = [_short_repr(v) for v in (parameters or ())]
+
+    entry = {
+        'time': datetime.utcnow().isoformat(timespec='seconds'),
+        'elapsed_ms': round(elapsed * 1000, 2),
+        'route': request.endpoint if has_request_context() else threading.current_thread().name,
+        'path': request.path if has_request_context() else None,
+        'statement': statement,
+        'shape': shape,
+        'parameters': params,
+        'plan': plan,
+    }
+    try:
+        get_slow_query_logger().info(json.dumps(entry, ensure_ascii=False))
+    except OSError as e:
+        print(f"Khong the ghi slow query log: {e}")
+
+def read_slow_query_report(limit=50):
+    """Gop cac dong trong slow query log theo cau lenh, sap xep theo tong thoi gian."""
+    report = {}
+    log_files = [SLOW_QUERY_LOG_FILE] + [f"{SLOW_QUERY_LOG_FILE}.{i}" for i in range(1, 4)]
+    for log_file in log_files:
+        if not os.path.exists(log_file):
+            continue
+        with open(log_file, 'r', encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                item = report.setdefault(entry['shape'], {
+                    'shape': entry['shape'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'routes': set(), 'plan': entry.get('plan') or [], 'parameters': entry.get('parameters'),
+                    'last_seen': entry.get('time')
+                })
+                item['count'] += 1
+                item['total_ms'] += entry['elapsed_ms']
+                if entry['elapsed_ms'] >= item['max_ms']:
+                    item['max_ms'] = entry['elapsed_ms']
+                    item['parameters'] = entry.get('parameters')
+                    item['plan'] = entry.get('plan') or []
+                item['routes'].add(entry.get('route') or '?')
+                item['last_seen'] = max(item['last_seen'] or '', entry.get('time') or '')
+    for item in report.values():
+        item['avg_ms'] = item['total_ms'] / item['count']
+        item['has_scan'] = any(step.startswith('SCAN') for step in item['plan'])
+    return sorted(report.values(), key=lambda i: i['total_ms'], reverse=True)[:limit]
+
+# --- SO LIEU GIAM SAT (PROMETHEUS) ---
+# Moi process (worker) giu so lieu trong bo nho va dinh ky ghi ra metrics/<pid>.<ma worker>.json.
+# /metrics cong don file cua tat ca worker nen an toan khi chay nhieu worker; file cua worker
+# da chet duoc gop vao metrics/aggregate.json roi xoa, nen thu muc khong phinh ra theo thoi gian.
+METRICS_FOLDER = os.path.join(DATA_ROOT, 'metrics')
+METRICS_AGGREGATE_FILE = 'aggregate.json'
+METRICS_FLUSH_INTERVAL = 5 # giay
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+METRICS_INFO = {
+    'thuvien_http_request_duration_seconds': ('histogram', 'Thoi gian xu ly request theo endpoint.'),
+    'thuvien_http_requests_total': ('counter', 'So request theo endpoint va ma trang thai.'),
+    'thuvien_db_time_seconds': ('histogram', 'Tong thoi gian truy van SQL trong mot request.'),
+    'thuvien_db_queries_total': ('counter', 'So truy van SQL theo endpoint.'),
+    'thuvien_calibre_duration_seconds': ('histogram', 'Thoi gian chay ebook-meta / ebook-convert.'),
+    'thuvien_calibre_failures_total': ('counter', 'So lan ebook-meta / ebook-convert that bai.'),
+    'thuvien_cover_resize_seconds': ('histogram', 'Thoi gian thu nho va nen anh bia bang Pillow.'),
+    'thuvien_cover_cache_total': ('counter', 'Truy cap anh bia: hit (co san) hoac miss (phai tao).'),
+    'thuvien_upload_bytes_total': ('counter', 'Tong so byte sach duoc tai len.'),
+    'thuvien_import_bytes_total': ('counter', 'Tong so byte file nhap tu Calibre.'),
+    'thuvien_blob_dedupe_bytes_total': ('counter', 'So byte khong phai luu them vi noi dung da co trong kho blob.'),
+    'thuvien_conversion_cache_total': ('counter', 'Tai sach o dinh dang khac: hit (co san) hoac miss (phai chuyen doi).'),
+    'thuvien_conversion_cache_evictions_total': ('counter', 'So ban chuyen doi bi xoa khoi bo nho dem do vuot dung luong.'),
+    'thuvien_jobs_total': ('counter', 'So tac vu nen ket thuc theo loai va trang thai.'),
+    'thuvien_job_duration_seconds': ('histogram', 'Thoi gian chay tac vu nen (khong tinh thoi gian cho).'),
+}
+_metrics_lock = threading.Lock()
+_metrics_counters = {}
+_metrics_histograms = {}
+_metrics_last_flush = 0.0
+
+def _metric_key(name, labels):
+    return name + '|' + json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+def metrics_inc(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metrics_counters[key] = _metrics_counters.get(key, 0) + value
+
+def metrics_observe(name, value, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        hist = _metrics_histograms.get(key)
+        if hist is None:
+            hist = _metrics_histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                hist['buckets'][i] += 1
+                break
+        hist['sum'] += value
+        hist['count'] += 1
+
+@contextmanager
+def metrics_timer(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics_observe(name, time.perf_counter() - started, **labels)
+
+def flush_metrics(force=False):
+    """Ghi so lieu cua process hien tai ra file (toi da moi METRICS_FLUSH_INTERVAL giay)."""
+    global _metrics_last_flush
+    now = time.time()
+    if not force and now - _metrics_last_flush < METRICS_FLUSH_INTERVAL:
+        return
+    with _metrics_lock:
+        snapshot = {'counters': dict(_metrics_counters),
+                    'histograms': {k: dict(v, buckets=list(v['buckets'])) for k, v in _metrics_histograms.items()}}
+        _metrics_last_flush = now
+    try:
+        os.makedirs(METRICS_FOLDER, exist_ok=True)
+        # Ten file gom ca ma worker (moi lan process khoi dong mot ma) nen pid bi dung lai
+        # (vd. trong container) khong ghi de so lieu cua process cu
+        _write_metrics_file(f"{os.getpid()}.{current_worker_id()}.json", snapshot)
+    except OSError as e:
+        print(f"Khong the ghi file so lieu: {e}")
+
+def _write_metrics_file(name, data):
+    final_path = os.path.join(METRICS_FOLDER, name)
+    tmp_path = final_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, final_path)
+
+def _read_metrics_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _merge_metrics(counters, histograms, data):
+    for key, value in data.get('counters', {}).items():
+        counters[key] = counters.get(key, 0) + value
+    for key, hist in data.get('histograms', {}).items():
+        merged = histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, n in enumerate(hist['buckets'][:len(LATENCY_BUCKETS)]):
+            merged['buckets'][i] += n
+        merged['sum'] += hist['sum']
+        merged['count'] += hist['count']
+
+def _metrics_file_alive(name):
+    """File <pid>.<ma worker>.json con thuoc ve mot process dang chay khong (file kieu cu <pid>.json coi nhu da chet)."""
+    parts = name[:-len('.json')].split('.')
+    return len(parts) == 2 and worker_alive(parts[1])
+
+def compact_metrics():
+    """
+    Gop file so lieu cua cac worker da chet vao aggregate.json roi xoa chung.
+    aggregate.json ghi lai ten cac file da gop ('merged') cho den khi chung bien mat,
+    nen neu bi ngat giua luc ghi va luc xoa thi lan sau cung khong cong hai lan.
+    """
+    if not os.path.isdir(METRICS_FOLDER):
+        return
+    with host_slot('metrics', 1):
+        aggregate_path = os.path.join(METRICS_FOLDER, METRICS_AGGREGATE_FILE)
+        aggregate = _read_metrics_file(aggregate_path) or {}
+        counters, histograms = aggregate.get('counters', {}), aggregate.get('histograms', {})
+        merged = [name for name in aggregate.get('merged', []) if os.path.exists(os.path.join(METRICS_FOLDER, name))]
+        dead = []
+        for entry in os.scandir(METRICS_FOLDER):
+            if not entry.name.endswith('.json') or entry.name == METRICS_AGGREGATE_FILE or entry.name in merged:
+                continue
+            if _metrics_file_alive(entry.name):
+                continue
+            data = _read_metrics_file(entry.path)
+            if data is not None:
+                _merge_metrics(counters, histograms, data)
+            dead.append(entry.name)
+        if not dead and len(merged) == len(aggregate.get('merged', [])):
+            return
+        merged += dead
+        try:
+            _write_metrics_file(METRICS_AGGREGATE_FILE, {'counters': counters, 'histograms': histograms, 'merged': merged})
+        except OSError as e:
+            print(f"Khong the ghi file so lieu tong: {e}")
+            return
+        for name in merged:
+            try:
+                os.remove(os.path.join(METRICS_FOLDER, name))
+            except OSError:
+                pass
+
+def collect_metrics():
+    """Cong don so lieu tu file cua moi worker dang chay va aggregate.json (so lieu cua worker da dung, de counter khong bi giam)."""
+    flush_metrics(force=True)
+    compact_metrics()
+    counters, histograms = {}, {}
+    if not os.path.isdir(METRICS_FOLDER):
+        return counters, histograms
+    aggregate = _read_metrics_file(os.path.join(METRICS_FOLDER, METRICS_AGGREGATE_FILE)) or {}
+    already_merged = set(aggregate.get('merged', []))
+    for entry in os.scandir(METRICS_FOLDER):
+        if not entry.name.endswith('.json') or entry.name in already_merged:
+            continue
+        data = aggregate if entry.name == METRICS_AGGREGATE_FILE else _read_metrics_file(entry.path)
+        if data is not None:
+            _merge_metrics(counters, histograms, data)
+    return counters, histograms
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in items) + '}'
+
+def render_metrics():
+    counters, histograms = collect_metrics()
+    by_name = {}
+    for key, value in counters.items():
+        name, labels = key.split('|', 1)
+        by_name.setdefault(name, []).append((json.loads(labels), value))
+    for key, hist in histograms.items():
+        name, labels = key.split('|', 1)
+        by_name.setdefault(name, []).append((json.loads(labels), hist))
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS_INFO.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(by_name.get(name, []), key=lambda item: json.dumps(item[0], sort_keys=True)):
+            if metric_type == 'histogram':
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS, value['buckets']):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, {'le': '+Inf'})} {value['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+def run_calibre_tool(args, **kwargs):
+    """Chay ebook-meta / ebook-convert qua subprocess.run va ghi nhan thoi gian, so lan loi."""
+    tool = os.path.basename(args[0])
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(args, **kwargs)
+        if result.returncode != 0:
+            metrics_inc('thuvien_calibre_failures_total', tool=tool)
+        return result
+    except Exception:
+        metrics_inc('thuvien_calibre_failures_total', tool=tool)
+        raise
+    finally:
+        metrics_observe('thuvien_calibre_duration_seconds', time.perf_counter() - started, tool=tool)
+
+CALIBRE_PROGRESS_PATTERN = re.compile(r'^\s*(\d{1,3})%\s*(.*)$')
+
+def run_calibre_tool_with_progress(args, on_progress=None, timeout=None):
+    """
+    Chay ebook-convert va doc dan cac dong "NN% ..." ma calibre in ra de bao tien do.
+    on_progress(phan_tram, thong_diep) duoc goi tu thread hien tai, ke ca khi calibre im
+    lang (voi None, None) de co the nem JobCancelled. Tien trinh (ca cac tien trinh con)
+    bi dung khi qua timeout hoac khi on_progress nem ngoai le.
+    Tra ve cac dong output cuoi; nem CalledProcessError neu ma thoat khac 0.
+    """
+    tool = os.path.basename(args[0])
+    started = time.perf_counter()
+    output_tail = deque(maxlen=20)
+    lines = queue.Queue()
+    popen_kwargs = {'start_new_session': True} if os.name == 'posix' else {}
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace', **popen_kwargs)
+    except Exception:
+        metrics_inc('thuvien_calibre_failures_total', tool=tool)
+        metrics_observe('thuvien_calibre_duration_seconds', time.perf_counter() - started, tool=tool)
+        raise
+
+    def read_output():
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read_output, daemon=True).start()
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+            match = CALIBRE_PROGRESS_PATTERN.match(line) if line else None
+            if line.strip():
+                output_tail.append(line.rstrip())
+            if on_progress:
+                if match:
+                    on_progress(min(int(match.group(1)), 100), match.group(2).strip())
+                else:
+                    on_progress(None, None)
+            if timeout and time.perf_counter() - started > timeout:
+                raise subprocess.TimeoutExpired(args, timeout)
+        returncode = proc.wait()
+    except BaseException:
+        if os.name == 'posix':
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        else:
+            proc.kill()
+        proc.wait()
+        metrics_inc('thuvien_calibre_failures_total', tool=tool)
+        raise
+    finally:
+        metrics_observe('thuvien_calibre_duration_seconds', time.perf_counter() - started, tool=tool)
+
+    if returncode != 0:
+        metrics_inc('thuvien_calibre_failures_total', tool=tool)
+        raise subprocess.CalledProcessError(returncode, args, output='\n'.join(output_tail))
+    return '\n'.join(output_tail)
+
+# --- TAC VU NEN (BACKGROUND JOBS) ---
+# Viec nang (chuyen doi dinh dang...) khong chay trong request ma duoc ghi vao bang
+# background_job roi chay trong thread pool rieng cua tung loai tac vu. Trang thai nam
+# trong CSDL nen worker nao cung doc duoc. Moi process giu flock tren locks/worker.<id>.lock
+# suot doi; tac vu 'running' ma process chu khong con giu khoa (bi tat giua chung) duoc dua
+# lai hang doi khi khoi dong va boi thread quet dinh ky moi JOB_SWEEP_SECONDS.
+#
+# Cach them loai tac vu moi:
+#   @job_handler('ten', 'Nhan hien thi', concurrency_setting='ten_concurrency')
+#   def _ten_job(job_id, **params):
+#       report_job_progress(job_id, 50, 'Dang lam...')  # nem JobCancelled neu nguoi dung huy
+#       return {'book_id': ...}                        # luu vao cot result (JSON)
+# va goi enqueue_job('ten', params, user_id, dedupe_key=...) tu route.
+JOB_HANDLERS = {}
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+JOB_PROGRESS_INTERVAL = 2 # giay giua hai lan ghi tien do / heartbeat vao CSDL
+JOB_STALE_SECONDS = 120 # tac vu 'running' chua ghi worker (tu ban cu) khong co heartbeat lau hon muc nay coi nhu worker da chet
+JOB_SWEEP_SECONDS = 30
+LOCKS_FOLDER = os.path.join(DATA_ROOT, 'locks')
+JOB_TMP_FOLDER = os.path.join(DATA_ROOT, 'tmp')
+IMPORTS_FOLDER = os.path.join(DATA_ROOT, 'imports') # File zip cho tac vu nhap, xoa khi xong / huy / bo tac vu loi
+JOB_EVENTS_POLL_SECONDS = 1
+JOB_EVENTS_KEEPALIVE_SECONDS = 15 # Gui dong chu thich de proxy khong dong ket noi SSE dang im lang
+
+try:
+    import fcntl
+except ImportError: # Windows: chi gioi han trong mot process
+    fcntl = None
+
+_job_executors = {}
+_job_semaphores = {}
+_job_state_lock = threading.Lock()
+_job_last_report = {}
+_background_started = False
+_worker_state = {'pid': None, 'id': None, 'lock_file': None}
+
+class JobCancelled(Exception):
+    """Nem ra trong handler khi nguoi dung da yeu cau huy tac vu."""
+
+def job_handler(kind, label, concurrency_setting=None, result_url=None, auto_open=False, retryable=False, on_discard=None):
+    """
+    Dang ky ham xu ly cho mot loai tac vu nen. Cac loai dung chung concurrency_setting
+    cung chia nhau mot gioi han tren ca may. result_url(result) tra ve trang ket qua;
+    auto_open=True thi trang theo doi tu chuyen sang do khi xong (vd. tai file).
+    retryable=True: tac vu loi co the chay lai (cung id, nen giu checkpoint) tu trang theo doi;
+    on_discard(params) don dep (vd. file tam) khi nguoi dung bo tac vu loi thay vi chay lai.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = {'func': func, 'label': label, 'concurrency_setting': concurrency_setting,
+                              'result_url': result_url, 'auto_open': auto_open,
+                              'retryable': retryable, 'on_discard': on_discard}
+        return func
+    return decorator
+
+def job_concurrency(kind):
+    setting = JOB_HANDLERS[kind]['concurrency_setting']
+    return max(1, int(config.get(setting, 1))) if setting else 1
+
+@contextmanager
+def host_slot(name, limit):
+    """
+    Chiem mot trong `limit` cho chay cua `name` tren ca may bang file khoa (flock), de
+    nhieu worker cong lai cung khong vuot gioi han. Cho den khi co cho trong.
+    """
+    if fcntl is None:
+        with _job_state_lock:
+            semaphore = _job_semaphores.setdefault(name, threading.BoundedSemaphore(limit))
+        with semaphore:
+            yield
+        return
+
+    os.makedirs(LOCKS_FOLDER, exist_ok=True)
+    while True:
+        for slot in range(limit):
+            lock_file = open(os.path.join(LOCKS_FOLDER, f"{name}.{slot}.lock"), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(1)
+
+def worker_lock_path(worker_id):
+    return os.path.join(LOCKS_FOLDER, f"worker.{worker_id}.lock")
+
+def current_worker_id():
+    """Ma cua process hien tai; tao moi sau fork. Khoa locks/worker.<ma>.lock duoc giu den khi process ket thuc."""
+    with _job_state_lock:
+        if _worker_state['pid'] != os.getpid():
+            worker_id = uuid.uuid4().hex
+            lock_file = None
+            if fcntl is not None:
+                os.makedirs(LOCKS_FOLDER, exist_ok=True)
+                lock_file = open(worker_lock_path(worker_id), 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _worker_state.update(pid=os.getpid(), id=worker_id, lock_file=lock_file)
+        return _worker_state['id']
+
+def worker_alive(worker_id):
+    """Process worker_id con chay khong: con giu flock tren file khoa cua no (ca khi pid da bi dung lai)."""
+    if worker_id == current_worker_id():
+        return True
+    if fcntl is None: # Windows: chi co mot process chay tac vu
+        return False
+    try:
+        lock_file = open(worker_lock_path(worker_id), 'r+')
+    except FileNotFoundError:
+        return False
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        try:
+            os.remove(worker_lock_path(worker_id))
+        except FileNotFoundError:
+            pass
+        return False
+
+def requeue_orphaned_jobs():
+    """Dua lai hang doi cac tac vu 'running' ma process chay no da chet. Tra ve id cac tac vu da dua lai."""
+    stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    running = db.session.execute(
+        db.select(BackgroundJob.id, BackgroundJob.worker, BackgroundJob.heartbeat_at).where(BackgroundJob.status == 'running')
+    ).all()
+    requeued = []
+    for job_id, worker, heartbeat_at in running:
+        if worker:
+            orphaned = not worker_alive(worker)
+        else:
+            orphaned = heartbeat_at is None or heartbeat_at < stale_before
+        if orphaned and db.session.execute(
+            db.update(BackgroundJob)
+            .where(BackgroundJob.id == job_id, BackgroundJob.status == 'running', BackgroundJob.worker.is_(worker))
+            .values(status='queued', worker=None, message='Đang chờ chạy lại...')
+        ).rowcount:
+            requeued.append(job_id)
+    db.session.commit()
+
+    # File khoa cua process da chet ma khong con tac vu nao tro toi
+    if fcntl is not None and os.path.isdir(LOCKS_FOLDER):
+        for name in os.listdir(LOCKS_FOLDER):
+            if name.startswith('worker.') and name.endswith('.lock'):
+                worker_alive(name[len('worker.'):-len('.lock')])
+    return requeued
+
+def job_sweeper_loop():
+    """Quet dinh ky tac vu cua worker da chet (process khac tat giua chung trong luc process nay dang chay)."""
+    while True:
+        time.sleep(JOB_SWEEP_SECONDS)
+        with app.app_context():
+            try:
+                for job in BackgroundJob.query.filter(BackgroundJob.id.in_(requeue_orphaned_jobs())).all():
+                    if job.kind in JOB_HANDLERS:
+                        submit_job(job)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Loi khi quet tac vu nen: {e}")
+            finally:
+                db.session.remove()
+
+def _get_job_executor(kind):
+    with _job_state_lock:
+        executor = _job_executors.get(kind)
+        if executor is None:
+            executor = _job_executors[kind] = ThreadPoolExecutor(
+                max_workers=job_concurrency(kind), thread_name_prefix=f"job-{kind}")
+        return executor
+
+def submit_job(job):
+    _get_job_executor(job.kind).submit(_run_job, job.id)
+
+def enqueue_job(kind, params, user_id, dedupe_key=None):
+    """Tao tac vu moi, hoac tra ve tac vu cung dedupe_key dang cho/chay (vd. khi F5 lai trang)."""
+    def find_active():
+        return BackgroundJob.query.filter(BackgroundJob.dedupe_key == dedupe_key,
+                                          BackgroundJob.status.in_(ACTIVE_JOB_STATUSES)).first()
+    if dedupe_key:
+        existing = find_active()
+        if existing:
+            return existing
+
+    job = BackgroundJob(kind=kind, user_id=user_id, dedupe_key=dedupe_key,
+                        params=json.dumps(params, ensure_ascii=False), message='Đang chờ...')
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Worker khac vua tao tac vu giong het (unique index uq_background_job_active)
+        db.session.rollback()
+        return find_active()
+    submit_job(job)
+    return job
+
+def report_job_progress(job_id, progress=None, message=None, force=False, details=None):
+    """
+    Ghi tien do va heartbeat (toi da moi JOB_PROGRESS_INTERVAL giay, tru khi force),
+    nem JobCancelled neu nguoi dung da yeu cau huy. details (dict, vd. so sach da them /
+    bo qua / loi) duoc luu vao cot result nhu ket qua tam cho toi khi tac vu xong.
+    """
+    now = time.time()
+    if not force and now - _job_last_report.get(job_id, 0) < JOB_PROGRESS_INTERVAL:
+        return
+    _job_last_report[job_id] = now
+    values = {'heartbeat_at': datetime.utcnow()}
+    if progress is not None:
+        values['progress'] = progress
+    if message:
+        values['message'] = message[:500]
+    if details is not None:
+        values['result'] = json.dumps(details, ensure_ascii=False)
+    db.session.execute(db.update(BackgroundJob).where(BackgroundJob.id == job_id).values(**values))
+    db.session.commit()
+    cancel_requested = db.session.execute(
+        db.select(BackgroundJob.cancel_requested).where(BackgroundJob.id == job_id)
+    ).scalar()
+    if cancel_requested:
+        raise JobCancelled()
+
+def _finish_job(job_id, status, message, result=None):
+    values = {'status': status, 'message': message[:500], 'finished_at': datetime.utcnow(), 'heartbeat_at': datetime.utcnow()}
+    if status == 'done':
+        values['progress'] = 100
+    if result is not None:
+        values['result'] = json.dumps(result, ensure_ascii=False)
+    db.session.execute(db.update(BackgroundJob).where(BackgroundJob.id == job_id).values(**values))
+    db.session.commit()
+
+def _run_job(job_id):
+    with app.app_context():
+        try:
+            job = db.session.get(BackgroundJob, job_id)
+            if job is None or job.status != 'queued' or job.kind not in JOB_HANDLERS:
+                return
+            kind = job.kind
+            params = json.loads(job.params or '{}')
+            db.session.commit() # Ket thuc transaction doc truoc khi cho cho chay
+
+            with host_slot(JOB_HANDLERS[kind]['concurrency_setting'] or kind, job_concurrency(kind)):
+                # Nhan tac vu mot cach nguyen tu: worker khac hoac lenh huy co the da doi trang thai
+                now = datetime.utcnow()
+                claimed = db.session.execute(
+                    db.update(BackgroundJob)
+                    .where(BackgroundJob.id == job_id, BackgroundJob.status == 'queued')
+                    .values(status='running', started_at=now, heartbeat_at=now, worker=current_worker_id(), message='Đang bắt đầu...')
+                ).rowcount
+                db.session.commit()
+                if not claimed:
+                    return
+
+                started = time.perf_counter()
+                try:
+                    result = JOB_HANDLERS[kind]['func'](job_id, **params)
+                    status = 'done'
+                    message = (result or {}).get('message') or 'Hoàn tất.'
+                except JobCancelled:
+                    db.session.rollback()
+                    result, status, message = None, 'cancelled', 'Đã hủy theo yêu cầu.'
+                except subprocess.TimeoutExpired as e:
+                    db.session.rollback()
+                    result, status, message = None, 'failed', f"Quá thời gian cho phép ({int(e.timeout)} giây)."
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Tac vu nen {job_id} ({kind}) that bai: {e}")
+                    result, status, message = None, 'failed', f"Lỗi: {e}"
+                _finish_job(job_id, status, message, result)
+                metrics_inc('thuvien_jobs_total', kind=kind, status=status)
+                metrics_observe('thuvien_job_duration_seconds', time.perf_counter() - started, kind=kind)
+        except Exception as e:
+            print(f"Loi khi chay tac vu nen {job_id}: {e}")
+        finally:
+            _job_last_report.pop(job_id, None)
+            db.session.remove()
+
+def start_background_services():
+    """Chay lai cac tac vu dang cho va tac vu cua worker da chet. Goi mot lan moi process."""
+    global _background_started
+    with _job_state_lock:
+        if _background_started:
+            return
+        _background_started = True
+
+    current_worker_id()
+    requeue_orphaned_jobs()
+    for job in BackgroundJob.query.filter_by(status='queued').order_by(BackgroundJob.id).all():
+        if job.kind in JOB_HANDLERS:
+            submit_job(job)
+    threading.Thread(target=job_sweeper_loop, name='job-sweeper', daemon=True).start()
+    threading.Thread(target=watch_folders_loop, name='watch-folders', daemon=True).start()
+
+@app.before_request
+def _ensure_background_services():
+    if not _background_started:
+        start_background_services()
+
+def check_job_permission(job_id):
+    job = BackgroundJob.query.get_or_404(job_id)
+    if session.get('is_admin') or job.user_id == session.get('user_id'):
+        return job
+    return None
+
+def job_to_dict(job):
+    result = json.loads(job.result) if job.result else None
+    handler = JOB_HANDLERS.get(job.kind, {})
+    result_url = None
+    if job.status == 'done' and result:
+        if handler.get('result_url'):
+            result_url = handler['result_url'](result)
+        elif result.get('book_id'):
+            result_url = url_for('book_detail', book_id=result['book_id'])
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'label': handler.get('label', job.kind),
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'cancel_requested': job.cancel_requested,
+        'result': result,
+        'result_url': result_url,
+        'auto_open': bool(handler.get('auto_open')),
+        'retryable': bool(handler.get('retryable')) and job.status == 'failed',
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+# --- BO NHO DEM CHUYEN DOI KHI TAI VE (CONVERSION CACHE) ---
+# Tai sach o dinh dang chua co (vd. MOBI cho Kindle) khong tao them Book hay file trong
+# thu vien: ban chuyen doi nam o conversion_cache/<sha256[:2]>/<sha256>.<dinh dang>, theo
+# noi dung file goc nen sua sach thi tu dong chuyen doi lai. Tong dung luong gioi han boi
+# conversion_cache_mb; khi vuot thi xoa ban it duoc tai gan day nhat (mtime duoc cap nhat moi lan tai).
+CONVERSION_CACHE_FOLDER = os.path.join(DATA_ROOT, 'conversion_cache')
+FILE_HASH_CACHE_SIZE = 4096 # So duong dan nho ma bam toi da (LRU), moi muc chi vai tram byte
+_file_hash_cache = OrderedDict() # duong dan -> ((kich thuoc, mtime), sha256)
+_file_hash_cache_lock = threading.Lock()
+_conversion_cache_lock = threading.Lock()
+
+def file_sha256(path):
+    """SHA-256 cua file, nho theo (kich thuoc, mtime) de khong doc lai file lon moi lan tai."""
+    st = os.stat(path)
+    signature = (st.st_size, st.st_mtime_ns)
+    with _file_hash_cache_lock:
+        cached = _file_hash_cache.get(path)
+        if cached and cached[0] == signature:
+            _file_hash_cache.move_to_end(path)
+            return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    with _file_hash_cache_lock:
+        _file_hash_cache[path] = (signature, digest.hexdigest())
+        _file_hash_cache.move_to_end(path)
+        # Chi giu FILE_HASH_CACHE_SIZE duong dan dung gan nhat: thu vien lon khong lam bo nho phinh mai
+        while len(_file_hash_cache) > FILE_HASH_CACHE_SIZE:
+            _file_hash_cache.popitem(last=False)
+    return digest.hexdigest()
+
+def conversion_cache_path(source_hash, target_format):
+    return os.path.join(CONVERSION_CACHE_FOLDER, source_hash[:2], f"{source_hash}.{target_format}")
+
+def prune_conversion_cache(keep=None):
+    """Xoa cac ban chuyen doi cu nhat cho den khi tong dung luong duoi conversion_cache_mb."""
+    budget = int(config.get('conversion_cache_mb', 2048)) * 1024 * 1024
+    with _conversion_cache_lock:
+        entries = []
+        total = 0
+        for root, _, files in os.walk(CONVERSION_CACHE_FOLDER):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= budget:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                metrics_inc('thuvien_conversion_cache_evictions_total')
+            except OSError as e:
+                print(f"Khong the xoa ban chuyen doi {path}: {e}")
+
 # -------------------- MAU HTML --------------------
 
 LAYOUT_TEMPLATE = """
@@ -457,6 +2136,8 @@ LAYOUT_TEMPLATE = """
                     <li class="mb-4"><a href="{{ url_for('index') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-home w-6 mr-2"></i> Trang chủ</a></li>
                     <li class="mb-4"><a href="{{ url_for('favorites') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-heart w-6 mr-2 text-red-500"></i> Sách Yêu Thích</a></li>
                     <li class="mb-4"><a href="{{ url_for('bookmarks') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-bookmark w-6 mr-2 text-theme-500"></i> Sách đã đánh dấu</a></li>
+                    <li class="mb-4"><a href="{{ url_for('tag_cloud') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-tags w-6 mr-2"></i> Thẻ</a></li>
+                    <li class="mb-4"><a href="{{ url_for('series_list') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-layer-group w-6 mr-2"></i> Bộ truyện</a></li>
                     
                     <li class="mb-2">
                         <details class="group">
@@ -496,6 +2177,7 @@ LAYOUT_TEMPLATE = """
                     <li class="mt-4 mb-4"><a href="{{ url_for('manage_users') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-users-cog w-6 mr-2"></i> Quản lý User</a></li>
                     <li class="mb-4"><a href="{{ url_for('guest_permissions') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-user-shield w-6 mr-2"></i> Quyền tài khoản Khách</a></li>
                     <li class="mb-4"><a href="{{ url_for('settings') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-cogs w-6 mr-2"></i> Cài đặt</a></li>
+                    <li class="mb-4"><a href="{{ url_for('slow_queries') }}" class="flex items-center p-2 hover:bg-gray-100 dark:hover:bg-gray-700 rounded-lg"><i class="fas fa-stopwatch w-6 mr-2"></i> Truy vấn chậm</a></li>
                     {% endif %}
                 </ul>
             </nav>
@@ -505,7 +2187,7 @@ LAYOUT_TEMPLATE = """
                 <form method="POST" action="/upload" enctype="multipart/form-data" class="mb-2">
                      <label class="block w-full text-center px-3 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700 transition-colors cursor-pointer">
                         <i class="fas fa-upload mr-2"></i> Tải lên sách
-                        <input type="file" name="files[]" class="hidden" multiple onchange="this.form.submit()">
+                        <input type="file" name="files[]" class="hidden" multiple onchange="if (!startChunkedUpload(this)) this.form.submit()">
                     </label>
                 </form>
                 <a href="{{ url_for('import_calibre') }}" class="block w-full text-center px-3 py-2 mt-2 bg-blue-600 text-white rounded-lg hover:bg-blue-700 transition-colors">
@@ -518,7 +2200,7 @@ LAYOUT_TEMPLATE = """
                 <form method="POST" action="/upload" enctype="multipart/form-data" class="mb-2">
                      <label class="block w-full text-center px-3 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700 transition-colors cursor-pointer">
                         <i class="fas fa-upload mr-2"></i> Tải lên sách
-                        <input type="file" name="files[]" class="hidden" multiple onchange="this.form.submit()">
+                        <input type="file" name="files[]" class="hidden" multiple onchange="if (!startChunkedUpload(this)) this.form.submit()">
                     </label>
                 </form>
                 <a href="{{ url_for('import_calibre') }}" class="block w-full text-center px-3 py-2 mt-2 bg-blue-600 text-white rounded-lg hover:bg-blue-700 transition-colors">
@@ -630,6 +2312,88 @@ LAYOUT_TEMPLATE = """
         }
     }
 
+    // Tai len theo tung phan qua /api/uploads: file lon khong bi het thoi gian, mat mang thi
+    // gui tiep tu cho dang do (ke ca sau khi tai lai trang va chon lai cung file).
+    const UPLOAD_RETRIES = 5;
+
+    function startChunkedUpload(input) {
+        if (!window.fetch || !window.localStorage || !Blob.prototype.slice) return false;
+        const files = Array.from(input.files);
+        if (!files.length) return true;
+        const status = document.createElement('p');
+        status.className = 'text-sm text-gray-600 dark:text-gray-300 mt-1 break-words';
+        input.form.after(status);
+        input.disabled = true;
+        (async () => {
+            let added = 0;
+            for (const [i, file] of files.entries()) {
+                try {
+                    const result = await uploadFileInChunks(file, sent => {
+                        status.textContent = `${i + 1}/${files.length} ${file.name}: ${Math.floor(sent * 100 / file.size)}%`;
+                    });
+                    if (!result.duplicate) added++;
+                } catch (e) {
+                    alert('Lỗi khi tải lên ' + file.name + ': ' + e.message);
+                }
+            }
+            status.textContent = `Đã thêm ${added}/${files.length} sách.`;
+            window.location.reload();
+        })();
+        return true;
+    }
+
+    async function uploadJson(url, options) {
+        const response = await fetch(url, options);
+        const data = await response.json();
+        if (!data.success && response.status !== 409) {
+            const error = new Error(data.error || ('HTTP ' + response.status));
+            error.fatal = response.status >= 400 && response.status < 500;
+            throw error;
+        }
+        return data;
+    }
+
+    async function uploadFileInChunks(file, onProgress) {
+        const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+        let upload = null;
+        if (localStorage.getItem(key)) {
+            upload = await uploadJson('/api/uploads/' + localStorage.getItem(key)).catch(() => null);
+        }
+        if (!upload) {
+            upload = await uploadJson('/api/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size }),
+            });
+            localStorage.setItem(key, upload.id);
+        }
+
+        let offset = upload.offset;
+        let failures = 0;
+        onProgress(offset);
+        while (offset < file.size) {
+            try {
+                const data = await uploadJson(`/api/uploads/${upload.id}?offset=${offset}`, {
+                    method: 'PUT',
+                    body: file.slice(offset, offset + upload.chunk_size),
+                });
+                offset = data.offset;
+                failures = 0;
+                onProgress(offset);
+            } catch (e) {
+                if (e.fatal || ++failures > UPLOAD_RETRIES) {
+                    localStorage.removeItem(key);
+                    throw e;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                offset = (await uploadJson('/api/uploads/' + upload.id).catch(() => ({ offset }))).offset;
+            }
+        }
+        const result = await uploadJson(`/api/uploads/${upload.id}/finalize`, { method: 'POST' });
+        localStorage.removeItem(key);
+        return result;
+    }
+
     if (document.getElementById('create-list-form')) {
         document.getElementById('create-list-form').addEventListener('submit', function(e) {
             e.preventDefault();
@@ -686,10 +2450,34 @@ INDEX_TEMPLATE = """
 <hr class="border-gray-200 dark:border-gray-700 my-8">
 {% endif %}
 
+{% if facet_sidebar %}
+<div class="lg:flex lg:gap-6">
+<aside class="lg:w-60 shrink-0 mb-6 lg:mb-0 space-y-5">
+    {% for facet, values in facet_sidebar.items() %}
+    <div>
+        <h3 class="font-bold text-sm text-gray-900 dark:text-white mb-1">{{ facet_labels[facet] }}</h3>
+        <ul class="text-sm space-y-0.5">
+            {% for value, count, active, url in values %}
+            <li>
+                <a href="{{ url }}"
+                   class="flex justify-between gap-2 px-2 py-0.5 rounded {% if active %}bg-theme-100 dark:bg-theme-800 text-theme-800 dark:text-theme-100 font-bold{% else %}text-gray-600 dark:text-gray-400 hover:bg-gray-100 dark:hover:bg-gray-700{% endif %}">
+                    <span class="truncate">{% if active %}<i class="fas fa-times mr-1"></i>{% endif %}{% if facet == 'rating' %}{{ value }} <i class="fas fa-star text-yellow-400"></i>{% else %}{{ value }}{% endif %}</span>
+                    <span class="text-gray-400">{{ count }}</span>
+                </a>
+            </li>
+            {% endfor %}
+        </ul>
+    </div>
+    {% endfor %}
+</aside>
+<div class="flex-1 min-w-0">
+{% endif %}
+
 <div class="flex flex-col sm:flex-row justify-between items-center mb-6">
     <h2 class="text-xl text-gray-900 dark:text-white">{{ page_title or 'Thư viện' }}</h2>
     <form method="GET" action="{{ url_for(request.endpoint, **request.view_args) }}" class="mt-4 sm:mt-0">
         <input type="hidden" name="q" value="{{ query or '' }}">
+        {% for name, values in request.args.lists() if name not in ('q', 'sort', 'page') %}{% for value in values %}<input type="hidden" name="{{ name }}" value="{{ value }}">{% endfor %}{% endfor %}
         <select name="sort" onchange="this.form.submit()" class="bg-white dark:bg-gray-800 border border-gray-300 dark:border-gray-600 rounded-lg px-3 py-2 focus:outline-none focus:ring-2 focus:ring-theme-500">
             <option value="title_asc" {% if sort == 'title_asc' %}selected{% endif %}>Sắp xếp: Tựa đề (A-Z)</option>
             <option value="title_desc" {% if sort == 'title_desc' %}selected{% endif %}>Sắp xếp: Tựa đề (Z-A)</option>
@@ -698,12 +2486,18 @@ INDEX_TEMPLATE = """
             <option value="rating_desc" {% if sort == 'rating_desc' %}selected{% endif %}>Sắp xếp: Đánh giá (Cao nhất)</option>
             <option value="date_desc" {% if sort == 'date_desc' %}selected{% endif %}>Sắp xếp: Mới thêm gần đây</option>
         </select>
+        {% if pagination.items %}
+        <button type="button" onclick="toggleBulkMode()" class="ml-2 px-3 py-2 bg-white dark:bg-gray-800 border border-gray-300 dark:border-gray-600 rounded-lg hover:bg-gray-100 dark:hover:bg-gray-700">
+            <i class="fas fa-check-square mr-1"></i> Chọn nhiều
+        </button>
+        {% endif %}
     </form>
 </div>
 
 <div class="grid grid-cols-3 sm:grid-cols-4 md:grid-cols-5 lg:grid-cols-6 xl:grid-cols-7 gap-4 md:gap-6">
     {% for book in pagination.items %}
-        <div class="book-card group bg-white dark:bg-gray-800 rounded-lg overflow-hidden shadow-md hover:shadow-lg dark:hover:shadow-theme-800/20 transition-shadow duration-300">
+        <div class="book-card group relative bg-white dark:bg-gray-800 rounded-lg overflow-hidden shadow-md hover:shadow-lg dark:hover:shadow-theme-800/20 transition-shadow duration-300">
+            <input type="checkbox" value="{{ book.id }}" onchange="updateBulkCount()" class="bulk-select hidden absolute top-2 left-2 z-10 w-5 h-5 accent-theme-600">
             <a href="{{ url_for('book_detail', book_id=book.id) }}">
                  <div class="cover-container">
                     <img src="{{ url_for('cover', book_id=book.id) }}"
@@ -738,25 +2532,101 @@ INDEX_TEMPLATE = """
         </div>
     {% endfor %}
 </div>
+{% if facet_sidebar %}</div></div>{% endif %}
 
 <!-- Phan trang -->
 <div class="flex justify-center mt-10">
     <nav class="flex items-center space-x-1 sm:space-x-2">
-        <a href="{{ url_for(request.endpoint, page=pagination.prev_num, q=query, sort=sort, **request.view_args) if pagination.has_prev else '#' }}" class="px-3 py-2 sm:px-4 bg-white dark:bg-gray-700 rounded-lg {% if not pagination.has_prev %}opacity-50 cursor-not-allowed{% else %}hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">
+        <a href="{{ url_for(request.endpoint, **dict(request.args.to_dict(flat=False), page=pagination.prev_num, q=query, sort=sort, **request.view_args)) if pagination.has_prev else '#' }}" class="px-3 py-2 sm:px-4 bg-white dark:bg-gray-700 rounded-lg {% if not pagination.has_prev %}opacity-50 cursor-not-allowed{% else %}hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">
             <i class="fas fa-arrow-left"></i>
         </a>
         {% for p in pagination.iter_pages(left_edge=1, right_edge=1, left_current=1, right_current=1) %}
             {% if p %}
-                <a href="{{ url_for(request.endpoint, page=p, q=query, sort=sort, **request.view_args) }}" class="px-3 py-2 sm:px-4 rounded-lg {% if p == pagination.page %}bg-theme-600 text-white{% else %}bg-white dark:bg-gray-700 hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">{{ p }}</a>
+                <a href="{{ url_for(request.endpoint, **dict(request.args.to_dict(flat=False), page=p, q=query, sort=sort, **request.view_args)) }}" class="px-3 py-2 sm:px-4 rounded-lg {% if p == pagination.page %}bg-theme-600 text-white{% else %}bg-white dark:bg-gray-700 hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">{{ p }}</a>
             {% else %}
                 <span class="px-3 py-2 sm:px-4 text-gray-500 hidden sm:inline">...</span>
             {% endif %}
         {% endfor %}
-        <a href="{{ url_for(request.endpoint, page=pagination.next_num, q=query, sort=sort, **request.view_args) if pagination.has_next else '#' }}" class="px-3 py-2 sm:px-4 bg-white dark:bg-gray-700 rounded-lg {% if not pagination.has_next %}opacity-50 cursor-not-allowed{% else %}hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">
+        <a href="{{ url_for(request.endpoint, **dict(request.args.to_dict(flat=False), page=pagination.next_num, q=query, sort=sort, **request.view_args)) if pagination.has_next else '#' }}" class="px-3 py-2 sm:px-4 bg-white dark:bg-gray-700 rounded-lg {% if not pagination.has_next %}opacity-50 cursor-not-allowed{% else %}hover:bg-gray-200 dark:hover:bg-gray-600{% endif %}">
             <i class="fas fa-arrow-right"></i>
         </a>
     </nav>
 </div>
+
+<!-- Thanh thao tac hang loat -->
+<div id="bulk-bar" class="hidden fixed bottom-0 inset-x-0 z-40 bg-white dark:bg-gray-800 border-t border-gray-200 dark:border-gray-700 shadow-lg p-3">
+    <div class="max-w-screen-xl mx-auto flex flex-wrap items-center gap-2">
+        <span id="bulk-count" class="font-bold text-gray-900 dark:text-white mr-2">0 sách</span>
+        <button type="button" onclick="selectAllBulk()" class="px-3 py-2 bg-gray-200 dark:bg-gray-700 rounded-lg">Chọn cả trang</button>
+        <select id="bulk-action" onchange="updateBulkInputs()" class="px-3 py-2 bg-gray-100 dark:bg-gray-700 rounded-lg border border-gray-300 dark:border-gray-600">
+            {% for name, label in bulk_actions.items() %}<option value="{{ name }}">{{ label }}</option>{% endfor %}
+        </select>
+        <input id="bulk-value" type="text" class="px-3 py-2 bg-gray-100 dark:bg-gray-700 rounded-lg border border-gray-300 dark:border-gray-600">
+        <input id="bulk-start-index" type="number" min="0" placeholder="Đánh số từ tập (tùy chọn)" class="hidden px-3 py-2 bg-gray-100 dark:bg-gray-700 rounded-lg border border-gray-300 dark:border-gray-600">
+        <select id="bulk-list" class="hidden px-3 py-2 bg-gray-100 dark:bg-gray-700 rounded-lg border border-gray-300 dark:border-gray-600">
+            {% for book_list in user_book_lists %}<option value="{{ book_list.id }}">{{ book_list.name }}</option>{% endfor %}
+        </select>
+        <button type="button" onclick="applyBulkAction()" class="px-4 py-2 bg-theme-600 text-white font-bold rounded-lg hover:bg-theme-700">Áp dụng</button>
+        <button type="button" onclick="toggleBulkMode()" class="px-3 py-2 text-gray-500 hover:text-gray-800 dark:hover:text-white">Hủy</button>
+    </div>
+</div>
+
+<script>
+function bulkSelected() {
+    return Array.from(document.querySelectorAll('.bulk-select:checked')).map(box => parseInt(box.value));
+}
+
+function toggleBulkMode() {
+    const bar = document.getElementById('bulk-bar');
+    const enabled = bar.classList.toggle('hidden') === false;
+    document.querySelectorAll('.bulk-select').forEach(box => {
+        box.classList.toggle('hidden', !enabled);
+        if (!enabled) box.checked = false;
+    });
+    updateBulkInputs();
+    updateBulkCount();
+}
+
+function selectAllBulk() {
+    document.querySelectorAll('.bulk-select').forEach(box => box.checked = true);
+    updateBulkCount();
+}
+
+function updateBulkCount() {
+    document.getElementById('bulk-count').textContent = bulkSelected().length + ' sách';
+}
+
+function updateBulkInputs() {
+    const action = document.getElementById('bulk-action').value;
+    const value = document.getElementById('bulk-value');
+    const placeholders = { add_tags: 'Thẻ, cách nhau bởi dấu phẩy', remove_tags: 'Thẻ, cách nhau bởi dấu phẩy', rating: 'Số sao (0-5)', series: 'Tên bộ truyện (để trống để bỏ)' };
+    value.classList.toggle('hidden', !(action in placeholders));
+    value.placeholder = placeholders[action] || '';
+    document.getElementById('bulk-start-index').classList.toggle('hidden', action !== 'series');
+    document.getElementById('bulk-list').classList.toggle('hidden', !action.endsWith('_list'));
+}
+
+async function applyBulkAction() {
+    const bookIds = bulkSelected();
+    const action = document.getElementById('bulk-action').value;
+    if (!bookIds.length) return alert('Chưa chọn sách nào.');
+    if (action === 'delete' && !confirm(`Xóa ${bookIds.length} sách cùng tất cả định dạng?`)) return;
+    const response = await fetch('{{ url_for('bulk_books') }}', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            action: action,
+            book_ids: bookIds,
+            value: document.getElementById('bulk-value').value,
+            start_index: document.getElementById('bulk-start-index').value,
+            list_id: document.getElementById('bulk-list').value,
+        }),
+    });
+    const data = await response.json().catch(() => ({ error: 'HTTP ' + response.status }));
+    if (!data.success) return alert(data.error);
+    window.location.reload();
+}
+</script>
 """
 
 BOOK_DETAIL_TEMPLATE = """
@@ -816,6 +2686,13 @@ BOOK_DETAIL_TEMPLATE = """
                             </div>
                         </div>
                         {% endfor %}
+                        {% set present_formats = all_formats|map(attribute='format')|list %}
+                        {% for fmt in convert_formats if fmt not in present_formats %}
+                        <a href="{{ url_for('read', book_id=(epub_book or book).id, format=fmt) }}" title="Chuyển đổi khi tải, không thêm vào thư viện" class="flex items-center justify-between px-4 py-2 text-sm text-gray-500 dark:text-gray-400 hover:bg-gray-100 dark:hover:bg-gray-600">
+                            <span>{{ fmt.upper() }} <span class="text-xs">(chuyển đổi)</span></span>
+                            <i class="fas fa-download text-blue-500"></i>
+                        </a>
+                        {% endfor %}
                     </div>
                 </div>
             </details>
@@ -860,7 +2737,7 @@ BOOK_DETAIL_TEMPLATE = """
             <div><strong class="text-gray-500 dark:text-gray-400">Ngôn ngữ:</strong> {{ book.language or 'N/A' }}</div>
             {% if book.series %}
             <div>
-                <strong class="text-gray-500 dark:text-gray-400">Bộ truyện:</strong> <a href="{{ url_for('index', q=book.series) }}" class="hover:text-theme-600 dark:hover:text-theme-400">{{ book.series }}</a>
+                <strong class="text-gray-500 dark:text-gray-400">Bộ truyện:</strong> <a href="{{ url_for('series_detail', name=book.series) }}" class="hover:text-theme-600 dark:hover:text-theme-400">{{ book.series }}</a>
                 <strong class="ml-4">Tập số:</strong> {{ book.series_index | int }}
             </div>
             {% endif %}
@@ -870,7 +2747,7 @@ BOOK_DETAIL_TEMPLATE = """
         <div class="flex flex-wrap gap-2">
             {% for tag in (book.tags or '').split(',') %}
                 {% if tag.strip() %}
-                <a href="{{ url_for('index', q=tag.strip()) }}" class="bg-gray-200 dark:bg-gray-700 text-gray-600 dark:text-gray-300 text-sm px-3 py-1 rounded-full hover:bg-theme-100 dark:hover:bg-theme-800 hover:text-theme-800 dark:hover:text-theme-200 transition-colors">{{ tag.strip() }}</a>
+                <a href="{{ url_for('index', tag=tag.strip()) }}" class="bg-gray-200 dark:bg-gray-700 text-gray-600 dark:text-gray-300 text-sm px-3 py-1 rounded-full hover:bg-theme-100 dark:hover:bg-theme-800 hover:text-theme-800 dark:hover:text-theme-200 transition-colors">{{ tag.strip() }}</a>
                 {% endif %}
             {% endfor %}
         </div>
@@ -1595,75 +3472,26 @@ EPUB_READER_TEMPLATE = """
 </html>
 """
 
-SETTINGS_TEMPLATE = """
-<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8 max-w-3xl mx-auto">
-    <h2 class="text-2xl font-bold mb-6 text-gray-900 dark:text-white">Cài đặt Hệ thống</h2>
-    <form id="settings-form" method="POST" action="{{ url_for('settings') }}">
-        <!-- Tên Thư viện -->
-        <div class="mb-6">
-            <label for="library_name" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Tên Thư viện</label>
-            <input name="library_name" id="library_name" value="{{ app_config.library_name }}" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
-            <p class="text-gray-500 text-sm mt-2">Tên sẽ hiển thị ở đầu trang.</p>
+# Modal chon thu muc tren may chu (qua /api/browse, chi admin). Render rieng roi chen vao
+# trang bang {{ file_browser|safe }}; nut mo modal goi openFileBrowser('<id o nhap>').
+FILE_BROWSER_TEMPLATE = """
+<!-- Modal Trinh duyet File -->
+<div id="file-browser-modal" class="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4 hidden">
+    <div class="bg-gray-800 rounded-lg p-4 max-w-2xl w-full h-3/4 flex flex-col">
+        <h3 id="current-path-display" class="text-xl font-bold text-white mb-2"></h3>
+        <div id="directory-list" class="flex-grow bg-gray-900 rounded-lg p-2 overflow-y-auto">
+            <!-- Content will be injected by JS -->
         </div>
-
-        <!-- Cai dat Thu muc Du lieu -->
-        <div class="mb-6">
-            <label for="data_path" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Đường dẫn Thư mục Dữ liệu</label>
-            <div class="flex">
-                <input name="data_path" id="data_path" value="{{ app_config.data_path }}" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-l-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
-                <button onclick="toggleModal('file-browser-modal', true); fetchDirectories('{{ safe_root }}');" type="button" class="px-4 py-2 bg-gray-500 hover:bg-gray-600 text-white rounded-r-lg">
-                    <i class="fas fa-folder-open"></i>
-                </button>
-            </div>
-            <p class="text-gray-500 text-sm mt-2">Nơi lưu trữ cơ sở dữ liệu, sách và ảnh bìa. <strong>Thay đổi yêu cầu khởi động lại ứng dụng để có hiệu lực.</strong></p>
+        <div class="flex justify-end space-x-4 mt-4">
+            <button onclick="toggleModal('file-browser-modal', false)" type="button" class="px-4 py-2 bg-gray-600 rounded-lg hover:bg-gray-500">Hủy</button>
+            <button onclick="selectPath()" type="button" class="px-4 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700">Chọn Thư mục này</button>
         </div>
+    </div>
+</div>
 
-        <!-- Cai dat Giao dien -->
-        <div class="grid grid-cols-1 md:grid-cols-2 gap-6 mb-6">
-            <div>
-                <label for="theme" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Giao diện</label>
-                <select name="theme" id="theme" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
-                    <option value="dark" {% if app_config.theme == 'dark' %}selected{% endif %}>Tối</option>
-                    <option value="light" {% if app_config.theme == 'light' %}selected{% endif %}>Sáng</option>
-                </select>
-            </div>
-            <div>
-                <label for="theme_color" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Màu chủ đề</label>
-                <select name="theme_color" id="theme_color" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
-                    <option value="cyan" {% if app_config.theme_color == 'cyan' %}selected{% endif %}>Cyan</option>
-                    <option value="blue" {% if app_config.theme_color == 'blue' %}selected{% endif %}>Blue</option>
-                    <option value="emerald" {% if app_config.theme_color == 'emerald' %}selected{% endif %}>Emerald</option>
-                    <option value="rose" {% if app_config.theme_color == 'rose' %}selected{% endif %}>Rose</option>
-                    <option value="indigo" {% if app_config.theme_color == 'indigo' %}selected{% endif %}>Indigo</option>
-                    <option value="violet" {% if app_config.theme_color == 'violet' %}selected{% endif %}>Violet</option>
-                    <option value="fuchsia" {% if app_config.theme_color == 'fuchsia' %}selected{% endif %}>Fuchsia</option>
-                    <option value="orange" {% if app_config.theme_color == 'orange' %}selected{% endif %}>Orange</option>
-                </select>
-            </div>
-        </div>
-
-        <button type="submit" onclick="saveSettingsAndSubmit()" class="w-full px-4 py-3 bg-theme-600 text-white font-bold rounded-lg hover:bg-theme-700 transition-colors">
-            <i class="fas fa-save mr-2"></i> Lưu Cài đặt
-        </button>
-    </form>
-
-    <!-- Modal Trinh duyet File -->
-    <div id="file-browser-modal" class="fixed inset-0 bg-black bg-opacity-75 flex items-center justify-center z-50 p-4 hidden">
-        <div class="bg-gray-800 rounded-lg p-4 max-w-2xl w-full h-3/4 flex flex-col">
-            <h3 id="current-path-display" class="text-xl font-bold text-white mb-2"></h3>
-            <div id="directory-list" class="flex-grow bg-gray-900 rounded-lg p-2 overflow-y-auto">
-                <!-- Content will be injected by JS -->
-            </div>
-            <div class="flex justify-end space-x-4 mt-4">
-                <button onclick="toggleModal('file-browser-modal', false)" type="button" class="px-4 py-2 bg-gray-600 rounded-lg hover:bg-gray-500">Hủy</button>
-                <button onclick="selectPath()" type="button" class="px-4 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700">Chọn Thư mục này</button>
-            </div>
-        </div>
-    </div>
-</div>
-
-<script>
-let currentPath = '{{ safe_root }}';
+<script>
+let currentPath = '{{ safe_root }}';
+let browserTargetId = null;
 
 function fetchDirectories(path) {
     const dirList = document.getElementById('directory-list');
@@ -1717,11 +3545,141 @@ function browse(dir) {
     fetchDirectories(newPath);
 }
 
+function openFileBrowser(targetId) {
+    browserTargetId = targetId;
+    toggleModal('file-browser-modal', true);
+    fetchDirectories(document.getElementById(targetId).value || '{{ safe_root }}');
+}
+
 function selectPath() {
-    document.getElementById('data_path').value = currentPath;
+    document.getElementById(browserTargetId).value = currentPath;
     toggleModal('file-browser-modal', false);
 }
+</script>
+"""
+
+SETTINGS_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8 max-w-3xl mx-auto">
+    <h2 class="text-2xl font-bold mb-6 text-gray-900 dark:text-white">Cài đặt Hệ thống</h2>
+    <form id="settings-form" method="POST" action="{{ url_for('settings') }}">
+        <!-- Tên Thư viện -->
+        <div class="mb-6">
+            <label for="library_name" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Tên Thư viện</label>
+            <input name="library_name" id="library_name" value="{{ app_config.library_name }}" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
+            <p class="text-gray-500 text-sm mt-2">Tên sẽ hiển thị ở đầu trang.</p>
+        </div>
+
+        <!-- Cai dat Thu muc Du lieu -->
+        <div class="mb-6">
+            <label for="data_path" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Đường dẫn Thư mục Dữ liệu</label>
+            <div class="flex">
+                <input name="data_path" id="data_path" value="{{ app_config.data_path }}" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-l-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
+                <button onclick="openFileBrowser('data_path')" type="button" class="px-4 py-2 bg-gray-500 hover:bg-gray-600 text-white rounded-r-lg">
+                    <i class="fas fa-folder-open"></i>
+                </button>
+            </div>
+            <p class="text-gray-500 text-sm mt-2">Nơi lưu trữ cơ sở dữ liệu, sách và ảnh bìa. <strong>Thay đổi yêu cầu khởi động lại ứng dụng để có hiệu lực.</strong></p>
+        </div>
+
+        <!-- Cai dat Giao dien -->
+        <div class="grid grid-cols-1 md:grid-cols-2 gap-6 mb-6">
+            <div>
+                <label for="theme" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Giao diện</label>
+                <select name="theme" id="theme" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
+                    <option value="dark" {% if app_config.theme == 'dark' %}selected{% endif %}>Tối</option>
+                    <option value="light" {% if app_config.theme == 'light' %}selected{% endif %}>Sáng</option>
+                </select>
+            </div>
+            <div>
+                <label for="theme_color" class="block text-gray-600 dark:text-gray-400 font-bold mb-2">Màu chủ đề</label>
+                <select name="theme_color" id="theme_color" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
+                    <option value="cyan" {% if app_config.theme_color == 'cyan' %}selected{% endif %}>Cyan</option>
+                    <option value="blue" {% if app_config.theme_color == 'blue' %}selected{% endif %}>Blue</option>
+                    <option value="emerald" {% if app_config.theme_color == 'emerald' %}selected{% endif %}>Emerald</option>
+                    <option value="rose" {% if app_config.theme_color == 'rose' %}selected{% endif %}>Rose</option>
+                    <option value="indigo" {% if app_config.theme_color == 'indigo' %}selected{% endif %}>Indigo</option>
+                    <option value="violet" {% if app_config.theme_color == 'violet' %}selected{% endif %}>Violet</option>
+                    <option value="fuchsia" {% if app_config.theme_color == 'fuchsia' %}selected{% endif %}>Fuchsia</option>
+                    <option value="orange" {% if app_config.theme_color == 'orange' %}selected{% endif %}>Orange</option>
+                </select>
+            </div>
+        </div>
+
+        <button type="submit" onclick="saveSettingsAndSubmit()" class="w-full px-4 py-3 bg-theme-600 text-white font-bold rounded-lg hover:bg-theme-700 transition-colors">
+            <i class="fas fa-save mr-2"></i> Lưu Cài đặt
+        </button>
+    </form>
 
+    <!-- Thu muc theo doi -->
+    <div class="mt-8 pt-6 border-t border-gray-200 dark:border-gray-700">
+        <h3 class="text-lg font-bold mb-2 text-gray-900 dark:text-white">Thư mục theo dõi</h3>
+        <p class="text-gray-500 text-sm mb-4">Sách chép vào các thư mục này được tự động nhập (kèm metadata và ảnh bìa) vào thư viện của người được chọn.</p>
+        {% for folder in watch_folders %}
+        <div class="flex flex-wrap items-center gap-2 mb-2 p-3 bg-gray-100 dark:bg-gray-700 rounded-lg text-sm">
+            <div class="flex-1 min-w-0">
+                <p class="font-mono truncate text-gray-900 dark:text-white">{{ folder.path }}</p>
+                <p class="text-gray-500 dark:text-gray-400">
+                    {{ 'Toàn thư viện' if folder.user.is_admin else folder.user.username }} ·
+                    đã nhập {{ watch_stats.get((folder.id, 'ingested'), 0) }}, trùng {{ watch_stats.get((folder.id, 'duplicate'), 0) }}, lỗi {{ watch_stats.get((folder.id, 'failed'), 0) }}
+                    {% if folder.last_scan_at %}· quét lúc {{ folder.last_scan_at.strftime('%d/%m/%Y %H:%M') }}{% endif %}
+                </p>
+            </div>
+            <form method="POST" action="{{ url_for('rescan_watch_folder', folder_id=folder.id) }}">
+                <button type="submit" class="px-3 py-1 bg-gray-500 hover:bg-gray-600 text-white rounded-lg" title="Quét lại"><i class="fas fa-sync"></i></button>
+            </form>
+            <form method="POST" action="{{ url_for('delete_watch_folder', folder_id=folder.id) }}" onsubmit="return confirm('Ngừng theo dõi thư mục này?')">
+                <button type="submit" class="px-3 py-1 bg-red-600 hover:bg-red-700 text-white rounded-lg" title="Ngừng theo dõi"><i class="fas fa-trash"></i></button>
+            </form>
+        </div>
+        {% endfor %}
+        <form method="POST" action="{{ url_for('add_watch_folder') }}" class="flex flex-col md:flex-row gap-2 mt-4">
+            <div class="flex flex-1">
+                <input name="path" id="watch_path" required placeholder="Đường dẫn thư mục" class="w-full px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-l-lg border border-gray-300 dark:border-gray-600">
+                <button onclick="openFileBrowser('watch_path')" type="button" class="px-4 py-2 bg-gray-500 hover:bg-gray-600 text-white rounded-r-lg"><i class="fas fa-folder-open"></i></button>
+            </div>
+            <select name="user_id" class="px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600">
+                <option value="{{ session.get('user_id') }}">Toàn thư viện</option>
+                {% for user in library_users %}<option value="{{ user.id }}">{{ user.username }}</option>{% endfor %}
+            </select>
+            <button type="submit" class="px-4 py-2 bg-theme-600 text-white font-bold rounded-lg hover:bg-theme-700"><i class="fas fa-plus mr-1"></i> Thêm</button>
+        </form>
+    </div>
+
+    <!-- Tao lai anh bia hang loat -->
+    <form method="POST" action="{{ url_for('start_cover_backfill') }}" class="mt-8 pt-6 border-t border-gray-200 dark:border-gray-700">
+        <h3 class="text-lg font-bold mb-2 text-gray-900 dark:text-white">Tạo lại ảnh bìa</h3>
+        <p class="text-gray-500 text-sm mb-4">Chạy nền, song song và tiếp tục được nếu bị ngắt. Cũng có thể chạy bằng lệnh <code>flask --app app backfill-covers</code>.</p>
+        <div class="grid grid-cols-1 md:grid-cols-3 gap-4 mb-4">
+            <select name="filter" class="px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600">
+                <option value="missing">Sách chưa có ảnh bìa</option>
+                <option value="failed">Sách tạo ảnh bìa thất bại</option>
+                <option value="all">Tất cả sách</option>
+            </select>
+            <input type="date" name="older_than" title="Chỉ ảnh bìa cũ hơn ngày này" class="px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600">
+            <label class="flex items-center gap-2 text-gray-600 dark:text-gray-400"><input type="checkbox" name="dry_run" value="1"> Chỉ đếm (chạy thử)</label>
+        </div>
+        <button type="submit" class="w-full px-4 py-2 bg-gray-600 text-white font-bold rounded-lg hover:bg-gray-700 transition-colors">
+            <i class="fas fa-images mr-2"></i> Bắt đầu
+        </button>
+    </form>
+    <!-- Kiem tra tinh toan ven thu vien -->
+    <form method="POST" action="{{ url_for('start_library_fsck') }}" class="mt-8 pt-6 border-t border-gray-200 dark:border-gray-700">
+        <h3 class="text-lg font-bold mb-2 text-gray-900 dark:text-white">Kiểm tra thư viện</h3>
+        <p class="text-gray-500 text-sm mb-4">Đối chiếu CSDL với file sách, ảnh bìa và kho blob. Báo cáo đầy đủ: lệnh <code>flask --app app fsck --output report.json</code>.</p>
+        <label class="flex items-center gap-2 mb-2 text-gray-600 dark:text-gray-400"><input type="checkbox" name="verify_hashes" value="1"> Băm lại nội dung file (chậm)</label>
+        <div class="grid grid-cols-1 md:grid-cols-2 gap-2 mb-4">
+            {% for name, label in fsck_repairs.items() %}
+            <label class="flex items-center gap-2 text-gray-600 dark:text-gray-400"><input type="checkbox" name="repairs" value="{{ name }}"> {{ label }}</label>
+            {% endfor %}
+        </div>
+        <button type="submit" class="w-full px-4 py-2 bg-gray-600 text-white font-bold rounded-lg hover:bg-gray-700 transition-colors">
+            <i class="fas fa-stethoscope mr-2"></i> Kiểm tra
+        </button>
+    </form>
+    {{ file_browser|safe }}
+</div>
+
+<script>
 function saveSettingsAndSubmit() {
     // Update localStorage immediately for instant UI feedback on theme
     const themeSelect = document.getElementById('theme');
@@ -1735,6 +3693,78 @@ function saveSettingsAndSubmit() {
 </script>
 """
 
+DEBUG_TOOLBAR_TEMPLATE = """
+<details id="debug-toolbar" class="fixed bottom-2 right-2 z-50 max-w-xl text-xs bg-gray-900 text-gray-100 rounded-lg shadow-xl opacity-90">
+    <summary class="cursor-pointer px-3 py-2 {% if stats.count > budget or suspects %}text-yellow-400{% endif %}">
+        <i class="fas fa-database mr-1"></i> {{ stats.count }} truy vấn · {{ '%.1f'|format(db_ms) }} ms DB · {{ '%.1f'|format(total_ms) }} ms tổng
+    </summary>
+    <div class="px-3 pb-3 max-h-80 overflow-y-auto">
+        {% if suspects %}
+        <p class="font-bold text-yellow-400 mt-2">Nghi vấn N+1</p>
+        <ul>
+            {% for shape, n in suspects %}
+            <li class="font-mono mt-1"><span class="text-yellow-400">{{ n }}x</span> {{ shape }}</li>
+            {% endfor %}
+        </ul>
+        {% endif %}
+        <p class="font-bold mt-2">Các câu lệnh</p>
+        <ul>
+            {% for shape, n in stats.shapes.most_common() %}
+            <li class="font-mono mt-1">{{ n }}x {{ shape }}</li>
+            {% endfor %}
+        </ul>
+    </div>
+</details>
+"""
+
+SLOW_QUERY_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-4 md:p-6 mx-auto">
+    <div class="flex flex-col sm:flex-row justify-between items-start sm:items-center mb-6 gap-4">
+        <h2 class="text-2xl font-bold text-gray-900 dark:text-white">Truy vấn chậm</h2>
+        <form method="POST" action="{{ url_for('clear_slow_queries') }}" onsubmit="return confirm('Xóa toàn bộ nhật ký truy vấn chậm?')">
+            <button type="submit" class="text-sm px-3 py-2 rounded-lg bg-red-600 hover:bg-red-700 text-white"><i class="fas fa-trash mr-1"></i> Xóa nhật ký</button>
+        </form>
+    </div>
+    {% if threshold <= 0 %}
+    <p class="p-4 mb-6 rounded-lg bg-yellow-500/10 border-l-4 border-yellow-500 text-yellow-800 dark:text-yellow-300">
+        Nhật ký đang tắt. Đặt <code>slow_query_ms</code> lớn hơn 0 trong config.json và khởi động lại để bật.
+    </p>
+    {% else %}
+    <p class="text-gray-500 dark:text-gray-400 mb-6">Ghi lại các truy vấn chậm hơn {{ threshold }} ms. Sắp xếp theo tổng thời gian.</p>
+    {% endif %}
+    <div class="space-y-4">
+        {% for item in report %}
+        <details class="bg-gray-100 dark:bg-gray-700 rounded-lg p-4">
+            <summary class="cursor-pointer">
+                <div class="flex flex-wrap gap-x-6 gap-y-1 text-sm">
+                    <span><strong>{{ '%.0f'|format(item.total_ms) }} ms</strong> tổng</span>
+                    <span>{{ item.count }} lần</span>
+                    <span>TB {{ '%.1f'|format(item.avg_ms) }} ms</span>
+                    <span>Tối đa {{ '%.1f'|format(item.max_ms) }} ms</span>
+                    <span class="text-gray-500 dark:text-gray-400">{{ item.routes|join(', ') }}</span>
+                    {% if item.has_scan %}<span class="px-2 rounded-full bg-red-600 text-white text-xs">SCAN</span>{% endif %}
+                </div>
+                <p class="font-mono text-xs mt-2 text-gray-600 dark:text-gray-300 truncate">{{ item.shape }}</p>
+            </summary>
+            <div class="mt-4 text-xs font-mono space-y-3">
+                <pre class="whitespace-pre-wrap">{{ item.shape }}</pre>
+                <div><strong>Tham số (lần chậm nhất):</strong> {{ item.parameters }}</div>
+                <div>
+                    <strong>EXPLAIN QUERY PLAN:</strong>
+                    <ul class="list-disc pl-6">
+                        {% for step in item.plan %}<li class="{% if step.startswith('SCAN') %}text-red-500{% endif %}">{{ step }}</li>{% endfor %}
+                    </ul>
+                </div>
+                <div class="text-gray-500">Lần cuối: {{ item.last_seen }}</div>
+            </div>
+        </details>
+        {% else %}
+        <p class="text-gray-500 dark:text-gray-400">Chưa có truy vấn chậm nào được ghi lại.</p>
+        {% endfor %}
+    </div>
+</div>
+"""
+
 # Mau moi cho trang quan ly ke sach (thay the modal)
 LIST_MANAGER_PAGE_TEMPLATE = """
 <div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8 max-w-lg mx-auto">
@@ -1745,7 +3775,7 @@ LIST_MANAGER_PAGE_TEMPLATE = """
         <div class="space-y-3 max-h-80 overflow-y-auto mb-6 pr-2">
             {% for list in all_user_lists %}
             <label class="flex items-center p-3 bg-gray-100 dark:bg-gray-700 rounded-lg cursor-pointer hover:bg-gray-200 dark:hover:bg-gray-600 transition-colors">
-                <input type="checkbox" name="list_ids" value="{{ list.id }}" class="h-5 w-5 rounded bg-gray-300 dark:bg-gray-900 border-gray-400 dark:border-gray-600 text-theme-600 focus:ring-theme-500" {% if list.id in book_list_ids %}checked{% endif %}>
+                <input type="checkbox" name="list_ids" value="{{ list.id }}" onchange="toggleShelf(this)" class="h-5 w-5 rounded bg-gray-300 dark:bg-gray-900 border-gray-400 dark:border-gray-600 text-theme-600 focus:ring-theme-500" {% if list.id in book_list_ids %}checked{% endif %}>
                 <span class="ml-4 text-gray-800 dark:text-gray-300">{{ list.name }}</span>
             </label>
             {% else %}
@@ -1768,6 +3798,99 @@ LIST_MANAGER_PAGE_TEMPLATE = """
         </div>
     </form>
 </div>
+<script>
+// Luu ngay khi tick / bo tick; nut "Luu thay doi" van dung duoc neu khong co JavaScript
+async function toggleShelf(box) {
+    box.disabled = true;
+    try {
+        const response = await fetch(`/lists/${box.value}/toggle/{{ book.id }}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ member: box.checked }),
+        });
+        const data = await response.json();
+        if (!data.success) throw new Error(data.message);
+        box.checked = data.member;
+    } catch (e) {
+        box.checked = !box.checked;
+        alert('Lỗi khi cập nhật kệ sách: ' + e.message);
+    } finally {
+        box.disabled = false;
+    }
+}
+</script>
+"""
+
+TAG_CLOUD_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8">
+    <h2 class="text-2xl font-bold mb-6 text-gray-900 dark:text-white">Thẻ</h2>
+    <div class="flex flex-wrap items-baseline gap-x-4 gap-y-2">
+        {% for name, count in tags %}
+        {% set weight = (count / largest) %}
+        <a href="{{ url_for('index', tag=name) }}" title="{{ count }} sách"
+           class="{% if weight > 0.66 %}text-2xl font-bold{% elif weight > 0.33 %}text-xl{% elif weight > 0.1 %}text-base{% else %}text-sm{% endif %} text-theme-600 dark:text-theme-400 hover:underline">
+            {{ name }} <span class="text-xs text-gray-400">({{ count }})</span>
+        </a>
+        {% else %}
+        <p class="text-gray-500 dark:text-gray-400">Chưa có thẻ nào.</p>
+        {% endfor %}
+    </div>
+</div>
+"""
+
+SERIES_LIST_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8">
+    <div class="flex flex-col sm:flex-row justify-between items-center mb-6 gap-4">
+        <h2 class="text-2xl font-bold text-gray-900 dark:text-white">Bộ truyện <span class="text-base font-normal text-gray-400">({{ series|length }})</span></h2>
+        <form method="GET" action="{{ url_for('series_list') }}">
+            <input type="search" name="q" value="{{ series_query }}" placeholder="Tìm bộ truyện..." class="px-3 py-2 bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg border border-gray-300 dark:border-gray-600 focus:outline-none focus:ring-2 focus:ring-theme-500">
+        </form>
+    </div>
+    <div class="grid grid-cols-1 sm:grid-cols-2 lg:grid-cols-3 gap-4">
+        {% for s in series %}
+        <a href="{{ url_for('series_detail', name=s.name) }}" class="flex gap-3 p-3 rounded-lg bg-gray-50 dark:bg-gray-700 hover:bg-gray-100 dark:hover:bg-gray-600">
+            <img src="{{ url_for('cover', book_id=s.cover_id) }}" class="w-12 h-16 object-cover rounded" loading="lazy" alt=""
+                 onerror="this.onerror=null; this.src='{{ url_for('static', filename='default_cover.jpg') }}';">
+            <div class="min-w-0">
+                <p class="font-bold text-gray-900 dark:text-white truncate">{{ s.name }}</p>
+                <p class="text-sm text-gray-500 dark:text-gray-400">{{ s.volumes }} tập{% if s.last %} · đến tập {{ s.last }}{% endif %}</p>
+                {% if s.missing %}<p class="text-xs text-yellow-600 dark:text-yellow-400"><i class="fas fa-exclamation-triangle"></i> Thiếu {{ s.missing }} tập</p>{% endif %}
+            </div>
+        </a>
+        {% else %}
+        <p class="text-gray-500 dark:text-gray-400">Chưa có bộ truyện nào.</p>
+        {% endfor %}
+    </div>
+</div>
+"""
+
+SERIES_DETAIL_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8">
+    <a href="{{ url_for('series_list') }}" class="text-sm text-theme-600 dark:text-theme-400 hover:underline"><i class="fas fa-arrow-left"></i> Bộ truyện</a>
+    <h2 class="text-2xl font-bold mt-2 mb-1 text-gray-900 dark:text-white">{{ name }}</h2>
+    <p class="text-gray-500 dark:text-gray-400 mb-4">{{ volumes|length }} tập</p>
+    {% if missing_count %}
+    <div class="mb-4 p-3 rounded-lg bg-yellow-50 dark:bg-yellow-900 text-yellow-800 dark:text-yellow-200 text-sm">
+        <i class="fas fa-exclamation-triangle"></i> Thiếu {{ missing_count }} tập: {{ missing }}
+    </div>
+    {% endif %}
+    {% if duplicates %}
+    <div class="mb-4 p-3 rounded-lg bg-red-50 dark:bg-red-900 text-red-800 dark:text-red-200 text-sm">
+        <i class="fas fa-clone"></i> Trùng số tập: {{ duplicates|join(', ') }}
+    </div>
+    {% endif %}
+    <div class="grid grid-cols-2 sm:grid-cols-4 md:grid-cols-6 gap-4">
+        {% for v in volumes %}
+        <a href="{{ url_for('book_detail', book_id=v.id) }}" class="group">
+            <img src="{{ url_for('cover', book_id=v.id) }}" class="w-full aspect-[2/3] object-cover rounded-lg shadow group-hover:opacity-80" loading="lazy" alt="{{ v.title }}"
+                 onerror="this.onerror=null; this.src='{{ url_for('static', filename='default_cover.jpg') }}';">
+            <p class="mt-1 text-sm font-bold text-gray-900 dark:text-white">Tập {{ v.series_index if v.series_index is not none else '?' }}</p>
+            <p class="text-xs text-gray-500 dark:text-gray-400 truncate">{{ v.title }}</p>
+            <p class="text-xs text-gray-400 uppercase">{{ v.formats }}</p>
+        </a>
+        {% endfor %}
+    </div>
+</div>
 """
 
 # Mau moi cho trang chuyen doi (thay the modal)
@@ -1780,7 +3903,7 @@ CONVERT_PAGE_TEMPLATE = """
     
     <form action="{{ url_for('convert_book', book_id=book.id) }}" method="POST">
         <select name="target_format" class="w-full bg-gray-100 dark:bg-gray-700 text-gray-900 dark:text-white rounded-lg p-3 mb-6 focus:outline-none focus:ring-2 focus:ring-theme-500">
-            {% for fmt in ['epub', 'mobi', 'pdf', 'azw3'] %}
+            {% for fmt in convert_formats %}
                 {% if fmt != book.format %}
                     <option value="{{ fmt }}">{{ fmt.upper() }}</option>
                 {% endif %}
@@ -1795,6 +3918,94 @@ CONVERT_PAGE_TEMPLATE = """
 """
 
 
+# Trang theo doi tac vu nen (chuyen doi, nhap sach...). Tu cap nhat qua /api/jobs/<id>/events (SSE) hoac /api/jobs/<id>.
+JOB_STATUS_TEMPLATE = """
+<div class="bg-white dark:bg-gray-800 rounded-xl shadow-md p-8 max-w-md mx-auto" id="job-card" data-status-url="{{ url_for('job_status_api', job_id=job.id) }}" data-events-url="{{ url_for('job_events', job_id=job.id) }}">
+    {% if job.status in ['queued', 'running'] %}<noscript><meta http-equiv="refresh" content="3"></noscript>{% endif %}
+    <h2 class="text-2xl font-bold mb-2 text-gray-900 dark:text-white">{{ info.label }}</h2>
+    {% if book %}<p class="text-lg text-gray-500 dark:text-gray-400 mb-6 truncate">{{ book.title }}</p>{% endif %}
+
+    <div class="w-full bg-gray-200 dark:bg-gray-700 rounded-full h-4 mb-3 overflow-hidden">
+        <div id="job-progress" class="h-4 bg-theme-600 transition-all duration-500" style="width: {{ info.progress }}%"></div>
+    </div>
+    <div class="flex justify-between text-sm text-gray-600 dark:text-gray-300 mb-6">
+        <span id="job-message">{{ info.message or '' }}</span>
+        <span id="job-percent">{{ info.progress }}%</span>
+    </div>
+    <p id="job-counts" class="text-sm text-gray-600 dark:text-gray-300 -mt-4 mb-6 {% if not (info.result and 'added' in info.result) %}hidden{% endif %}">
+        {% if info.result and 'added' in info.result %}Đã thêm {{ info.result.added }} · Bỏ qua {{ info.result.skipped }} · Lỗi {{ info.result.failed }}{% endif %}
+    </p>
+
+    <div class="flex flex-col sm:flex-row gap-4">
+        {% if book %}<a href="{{ url_for('book_detail', book_id=book.id) }}" class="w-full sm:w-auto text-center px-4 py-2 bg-gray-500 text-white rounded-lg hover:bg-gray-600">Quay lại sách</a>{% endif %}
+        <form id="job-cancel" method="POST" action="{{ url_for('cancel_job', job_id=job.id) }}" class="w-full sm:flex-1 {% if job.status not in ['queued', 'running'] %}hidden{% endif %}">
+            <button type="submit" class="w-full px-4 py-2 bg-red-600 text-white rounded-lg hover:bg-red-700">Hủy tác vụ</button>
+        </form>
+        <a id="job-result" href="{{ info.result_url or '#' }}" class="w-full sm:flex-1 text-center px-4 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700 {% if not info.result_url %}hidden{% endif %}">Xem kết quả</a>
+    </div>
+    <div id="job-retry" class="flex flex-col sm:flex-row gap-4 mt-4 {% if not info.retryable %}hidden{% endif %}">
+        <form method="POST" action="{{ url_for('retry_job', job_id=job.id) }}" class="w-full sm:flex-1">
+            <button type="submit" class="w-full px-4 py-2 bg-theme-600 text-white rounded-lg hover:bg-theme-700">Chạy lại (tiếp tục từ chỗ dừng)</button>
+        </form>
+        <form method="POST" action="{{ url_for('discard_job', job_id=job.id) }}" class="w-full sm:flex-1">
+            <button type="submit" class="w-full px-4 py-2 bg-gray-500 text-white rounded-lg hover:bg-gray-600">Bỏ tác vụ</button>
+        </form>
+    </div>
+</div>
+<script>
+(function() {
+    const card = document.getElementById('job-card');
+    const bar = document.getElementById('job-progress');
+    const percent = document.getElementById('job-percent');
+    const message = document.getElementById('job-message');
+    const cancelForm = document.getElementById('job-cancel');
+    const resultLink = document.getElementById('job-result');
+    const counts = document.getElementById('job-counts');
+    const retryForms = document.getElementById('job-retry');
+
+    function render(job) {
+        bar.style.width = job.progress + '%';
+        percent.textContent = job.progress + '%';
+        if (job.result && 'added' in job.result) {
+            counts.textContent = `Đã thêm ${job.result.added} · Bỏ qua ${job.result.skipped} · Lỗi ${job.result.failed}`;
+            counts.classList.remove('hidden');
+        }
+        message.textContent = job.cancel_requested && job.status === 'running' ? 'Đang hủy...' : (job.message || '');
+        if (job.status === 'failed') bar.classList.replace('bg-theme-600', 'bg-red-600');
+        const active = job.status === 'queued' || job.status === 'running';
+        cancelForm.classList.toggle('hidden', !active);
+        retryForms.classList.toggle('hidden', !job.retryable);
+        if (job.result_url) {
+            if (job.auto_open && !resultLink.dataset.opened) {
+                resultLink.dataset.opened = '1';
+                window.location.href = job.result_url;
+            }
+            resultLink.href = job.result_url;
+            resultLink.classList.remove('hidden');
+        }
+        return active;
+    }
+
+    function poll() {
+        fetch(card.dataset.statusUrl, {headers: {'Accept': 'application/json'}})
+            .then(r => r.json())
+            .then(job => { if (render(job)) setTimeout(poll, 1500); })
+            .catch(() => setTimeout(poll, 5000));
+    }
+
+    function subscribe() {
+        // Nhan tien do qua SSE; trinh duyet cu hoac ket noi bi cat thi quay ve hoi dinh ky
+        const source = new EventSource(card.dataset.eventsUrl);
+        source.addEventListener('progress', e => render(JSON.parse(e.data)));
+        source.addEventListener('end', () => source.close());
+        source.onerror = () => { source.close(); setTimeout(poll, 1000); };
+    }
+
+    {% if job.status in ['queued', 'running'] %}if (window.EventSource) subscribe(); else setTimeout(poll, 1000);{% endif %}
+})();
+</script>
+"""
+
 # -------------------- ROUTES (Cac duong dan cua ung dung) --------------------
 
 @app.route('/')
@@ -1802,6 +4013,7 @@ CONVERT_PAGE_TEMPLATE = """
 def index():
     page = request.args.get('page', 1, type=int)
     query_str = request.args.get('q', '').strip()
+    tag = request.args.get('tag', '').strip()
     sort_option = request.args.get('sort', 'title_asc')
     user_id = session.get('user_id')
     is_admin = session.get('is_admin')
@@ -1810,12 +4022,18 @@ def index():
         base_books_query = Book.query
     else:
         base_books_query = Book.query.filter_by(user_id=user_id)
+    facets = selected_facets()
+    if facets:
+        base_books_query = base_books_query.filter(*facet_conditions(facets))
+    if tag:
+        # Loc truoc khi gom nhom: sach co the o bat ky dinh dang nao (giong cach dem cua tag_count)
+        base_books_query = base_books_query.filter(Book.id.in_(tag_book_ids(tag)))
 
     subquery = base_books_query.with_entities(db.func.min(Book.id).label("min_id")).group_by(Book.title, Book.author).subquery()
     books_query = Book.query.join(subquery, Book.id == subquery.c.min_id)
 
     random_books = []
-    if not query_str and page == 1:
+    if not query_str and not tag and not facets and page == 1:
         random_books = books_query.order_by(func.random()).limit(5).all()
 
     if query_str:
@@ -1869,7 +4087,9 @@ def index():
         book.is_bookmarked = (book.title, book.author) in bookmarked_set
         book.is_favorited = (book.title, book.author) in favorited_set
 
-    index_content = render_template_string(INDEX_TEMPLATE, pagination=pagination, query=query_str, sort=sort_option, page_title="Thư viện", random_books=random_books, is_admin=is_admin)
+    page_title = f"Thẻ: {tag}" if tag else "Thư viện"
+    index_content = render_template_string(INDEX_TEMPLATE, pagination=pagination, query=query_str, sort=sort_option, page_title=page_title, random_books=random_books, is_admin=is_admin,
+                                           facet_sidebar=facet_sidebar(facets), facet_labels=FACETS)
     return render_template_string(LAYOUT_TEMPLATE, content=index_content, query=query_str)
 
 @app.route('/library/<int:user_id>')
@@ -1925,7 +4145,7 @@ def favorites():
             flash('Tài khoản khách không có quyền truy cập trang này.', 'danger')
             return redirect(url_for('index'))
 
-    favorited_book_ids = db.session.query(Favorite.book_id).filter_by(user_id=user_id).subquery()
+    favorited_book_ids = db.select(Favorite.book_id).where(Favorite.user_id == user_id)
     
     subquery = db.session.query(db.func.min(Book.id).label("min_id")) \
         .filter(Book.id.in_(favorited_book_ids)) \
@@ -1938,9 +4158,11 @@ def favorites():
 
     pagination = books_query.paginate(page=page, per_page=BOOKS_PER_PAGE, error_out=False)
 
+    page_ids = [book.id for book in pagination.items]
+    bookmarked_ids = set(db.session.scalars(db.select(BookMark.book_id).where(BookMark.user_id == user_id, BookMark.book_id.in_(page_ids))))
     for book in pagination.items:
         book.is_favorited = True
-        book.is_bookmarked = BookMark.query.filter_by(user_id=user_id, book_id=book.id).first() is not None
+        book.is_bookmarked = book.id in bookmarked_ids
 
     index_content = render_template_string(INDEX_TEMPLATE, pagination=pagination, query='', sort=sort_option, page_title="Sách Yêu Thích", is_admin=session.get('is_admin'))
     return render_template_string(LAYOUT_TEMPLATE, content=index_content, query='')
@@ -1959,7 +4181,7 @@ def bookmarks():
             flash('Tài khoản khách không có quyền truy cập trang này.', 'danger')
             return redirect(url_for('index'))
 
-    bookmarked_book_ids = db.session.query(BookMark.book_id).filter_by(user_id=user_id).subquery()
+    bookmarked_book_ids = db.select(BookMark.book_id).where(BookMark.user_id == user_id)
     
     subquery = db.session.query(db.func.min(Book.id).label("min_id")) \
         .filter(Book.id.in_(bookmarked_book_ids)) \
@@ -1972,9 +4194,11 @@ def bookmarks():
         
     pagination = books_query.paginate(page=page, per_page=BOOKS_PER_PAGE, error_out=False)
 
+    page_ids = [book.id for book in pagination.items]
+    favorited_ids = set(db.session.scalars(db.select(Favorite.book_id).where(Favorite.user_id == user_id, Favorite.book_id.in_(page_ids))))
     for book in pagination.items:
         book.is_bookmarked = True
-        book.is_favorited = Favorite.query.filter_by(user_id=user_id, book_id=book.id).first() is not None
+        book.is_favorited = book.id in favorited_ids
 
 
     index_content = render_template_string(INDEX_TEMPLATE, pagination=pagination, query='', sort=sort_option, page_title="Sách Đã Đánh Dấu", is_admin=session.get('is_admin'))
@@ -2101,19 +4325,25 @@ def parse_opf(opf_content):
     except Exception: pass
     return metadata
 
-def extract_metadata(filepath):
-    default_metadata = {
-        'title': os.path.splitext(os.path.basename(filepath))[0], 
+def default_metadata(filename):
+    return {
+        'title': os.path.splitext(os.path.basename(filename))[0], 
         'author': "Chưa rõ", 
-        'format': os.path.splitext(filepath)[1][1:].lower(),
+        'format': os.path.splitext(filename)[1][1:].lower(),
         'language': 'Tiếng Việt'
     }
+
+def read_opf_metadata(filepath):
+    result = run_calibre_tool(["ebook-meta", "--to-opf", filepath], capture_output=True, text=True, check=True, encoding='utf-8', errors='ignore')
+    return parse_opf(result.stdout)
+
+def extract_metadata(filepath):
+    metadata = default_metadata(filepath)
     try:
-        result = subprocess.run(["ebook-meta", "--to-opf", filepath], capture_output=True, text=True, check=True, encoding='utf-8', errors='ignore')
-        default_metadata.update(parse_opf(result.stdout))
+        metadata.update(read_opf_metadata(filepath))
     except Exception as e:
         print(f"Cảnh báo: Không thể trích xuất metadata cho {os.path.basename(filepath)}. Lỗi: {e}.")
-    return default_metadata
+    return metadata
 
 @app.route('/upload', methods=['POST'])
 @login_required
@@ -2130,26 +4360,27 @@ def upload():
         return redirect(request.url)
 
     user_id = session.get('user_id')
-    user_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
-    os.makedirs(user_upload_folder, exist_ok=True)
+    used = user_storage_used(user_id)
     
     newly_added_books = []
     warning_count = 0
     for file in files:
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(user_upload_folder, filename)
-            file.save(filepath)
-            metadata = extract_metadata(filepath)
-            
-            existing_book = Book.query.filter_by(title=metadata.get('title'), author=metadata.get('author'), format=metadata.get('format'), user_id=user_id).first()
-            if existing_book:
+            # Bam trong luc ghi; noi dung da co trong kho thi khong luu them va khong chay lai ebook-meta
+            temp_path, sha256, size = spool_to_blob_store(file.stream, os.path.splitext(filename)[1][1:].lower())
+            metrics_inc('thuvien_upload_bytes_total', size)
+            error = ingest_limit_error(user_id, size, used)
+            if error:
+                os.remove(temp_path)
+                flash(f'{filename}: {error}', 'danger')
+                continue
+            used += size
+            blob = store_blob(temp_path, sha256, size, os.path.splitext(filename)[1][1:].lower())
+            new_book = add_book_from_blob(blob, filename, user_id)
+            if new_book is None:
                 warning_count += 1
-                os.remove(filepath)
                 continue
-
-            new_book = Book(filename=filename, user_id=user_id, **metadata)
-            db.session.add(new_book)
             newly_added_books.append(new_book)
     
     db.session.commit() # Commit de sach co ID
@@ -2163,14 +4394,234 @@ def upload():
     if warning_count > 0: flash(f'{warning_count} sách đã tồn tại và được bỏ qua.', 'warning')
     return redirect(url_for('index'))
 
+# --- TAI LEN THEO TUNG PHAN (CHUNKED UPLOAD) ---
+# Giao thuc cho file lon, tiep tuc duoc khi mat ket noi:
+#   POST   /api/uploads                  {"filename", "size"}  -> {"id", "offset", "chunk_size"}
+#   PUT    /api/uploads/<id>?offset=N    than request la cac byte tu vi tri N -> {"offset"}
+#   GET    /api/uploads/<id>             -> {"offset"} de biet can gui tiep tu dau
+#   POST   /api/uploads/<id>/finalize    {"sha256"} (tuy chon) -> {"book_id"}
+#   DELETE /api/uploads/<id>             huy phien tai len
+# File dang tai nam o blobs/uploads/<id>.part (cung o dia voi kho blob nen hoan tat chi la doi ten).
+UPLOAD_PARTS_FOLDER = os.path.join(BLOB_FOLDER, 'uploads')
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_SESSION_TTL_HOURS = 24
+_upload_hashers = {} # id -> (offset, doi tuong sha256) de bam dan theo tung phan trong process nay
+
+def upload_part_path(upload_id):
+    return os.path.join(UPLOAD_PARTS_FOLDER, f"{upload_id}.part")
+
+def user_storage_used(user_id):
+    """Tong dung luong sach cua user (theo noi dung trong kho) cong cac phien tai len dang do."""
+    stored = db.session.query(func.coalesce(func.sum(Blob.size), 0)).filter(
+        Blob.sha256.in_(db.session.query(Book.blob_sha256).filter(Book.user_id == user_id))
+    ).scalar()
+    pending = db.session.query(func.coalesce(func.sum(UploadSession.total_size), 0)).filter(
+        UploadSession.user_id == user_id
+    ).scalar()
+    return stored + pending
+
+def ingest_limit_error(user_id, size, used=None):
+    """
+    Kiem tra upload_max_mb / user_quota_mb cho mot file sach `size` byte sap nhap cho user_id;
+    tra ve thong bao loi hoac None. Moi duong nhap sach deu goi ham nay. used: dung luong da
+    dung neu nguoi goi tu cong don (nhap nhieu file, Book chua ghi xuong CSDL).
+    """
+    max_mb = int(config.get('upload_max_mb', 2048))
+    if size > max_mb * 1024 * 1024:
+        return f"File vượt quá giới hạn {max_mb} MB."
+    quota_mb = int(config.get('user_quota_mb', 0))
+    if quota_mb:
+        if used is None:
+            used = user_storage_used(user_id)
+        if used + size > quota_mb * 1024 * 1024:
+            return f"Vượt quá dung lượng {quota_mb} MB cho mỗi người dùng."
+    return None
+
+def purge_expired_uploads():
+    cutoff = datetime.utcnow() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    for upload_session in UploadSession.query.filter(UploadSession.updated_at < cutoff).all():
+        _upload_hashers.pop(upload_session.id, None)
+        try:
+            os.remove(upload_part_path(upload_session.id))
+        except FileNotFoundError:
+            pass
+        db.session.delete(upload_session)
+    db.session.commit()
+
+def upload_sha256(upload_session):
+    """Trang thai bam toi upload_session.received; tinh lai tu file neu phan truoc do do worker khac nhan."""
+    cached = _upload_hashers.get(upload_session.id)
+    if cached and cached[0] == upload_session.received:
+        return cached[1]
+    digest = hashlib.sha256()
+    remaining = upload_session.received
+    with open(upload_part_path(upload_session.id), 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    _upload_hashers[upload_session.id] = (upload_session.received, digest)
+    return digest
+
+def get_upload_session(upload_id):
+    upload_session = db.session.get(UploadSession, upload_id)
+    if upload_session is None or upload_session.user_id != session.get('user_id'):
+        return None
+    return upload_session
+
+def upload_session_to_dict(upload_session):
+    return {'success': True, 'id': upload_session.id, 'filename': upload_session.filename,
+            'size': upload_session.total_size, 'offset': upload_session.received, 'chunk_size': UPLOAD_CHUNK_SIZE}
+
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+def create_upload_session():
+    if session.get('username') == GUEST_USERNAME:
+        permissions = GuestPermission.query.first()
+        if not permissions or not permissions.can_upload_books:
+            return jsonify(success=False, error="Tài khoản khách không có quyền tải lên."), 403
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    try:
+        total_size = int(data.get('size'))
+    except (TypeError, ValueError):
+        total_size = -1
+    if not filename or not allowed_file(filename):
+        return jsonify(success=False, error="Định dạng file không được hỗ trợ."), 400
+    if total_size <= 0:
+        return jsonify(success=False, error="Kích thước file không hợp lệ."), 400
+
+    purge_expired_uploads()
+    user_id = session.get('user_id')
+    error = ingest_limit_error(user_id, total_size)
+    if error:
+        return jsonify(success=False, error=error), 413
+
+    upload_session = UploadSession(id=uuid.uuid4().hex, user_id=user_id, filename=filename, total_size=total_size)
+    os.makedirs(UPLOAD_PARTS_FOLDER, exist_ok=True)
+    open(upload_part_path(upload_session.id), 'wb').close()
+    db.session.add(upload_session)
+    db.session.commit()
+    return jsonify(upload_session_to_dict(upload_session)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_session_status(upload_id):
+    upload_session = get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify(success=False, error="Không tìm thấy phiên tải lên."), 404
+    return jsonify(upload_session_to_dict(upload_session))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    upload_session = get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify(success=False, error="Không tìm thấy phiên tải lên."), 404
+    offset = request.args.get('offset', type=int)
+    if offset != upload_session.received:
+        # Client gui lai phan da nhan (hoac nhay coc): bao vi tri dung de gui tiep
+        return jsonify(dict(upload_session_to_dict(upload_session), success=False, error="Sai vị trí.")), 409
+
+    digest = upload_sha256(upload_session).copy()
+    written = 0
+    too_large = False
+    try:
+        with open(upload_part_path(upload_id), 'r+b') as f:
+            f.seek(offset)
+            while True:
+                chunk = request.stream.read(1024 * 1024)
+                if not chunk:
+                    break
+                if offset + written + len(chunk) > upload_session.total_size:
+                    too_large = True
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                written += len(chunk)
+    except ClientDisconnected:
+        pass # Giu lai phan da nhan, client hoi GET de tiep tuc
+
+    # Chi tang vi tri neu chua co request khac ghi cung doan nay
+    advanced = db.session.execute(
+        db.update(UploadSession)
+        .where(UploadSession.id == upload_id, UploadSession.received == offset)
+        .values(received=offset + written, updated_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    db.session.refresh(upload_session)
+    if advanced:
+        _upload_hashers[upload_id] = (offset + written, digest)
+        metrics_inc('thuvien_upload_bytes_total', written)
+    if too_large:
+        return jsonify(dict(upload_session_to_dict(upload_session), success=False, error="Dữ liệu vượt quá kích thước đã khai báo.")), 413
+    return jsonify(upload_session_to_dict(upload_session))
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    upload_session = get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify(success=False, error="Không tìm thấy phiên tải lên."), 404
+    if upload_session.received != upload_session.total_size:
+        return jsonify(dict(upload_session_to_dict(upload_session), success=False, error="Chưa nhận đủ dữ liệu.")), 409
+
+    try:
+        sha256 = upload_sha256(upload_session).hexdigest()
+    except FileNotFoundError:
+        # Mot lenh finalize khac vua dua file vao kho
+        return jsonify(success=False, error="Phiên tải lên đã được hoàn tất."), 409
+    expected = (request.get_json(silent=True) or {}).get('sha256')
+    if expected and expected.lower() != sha256:
+        return jsonify(success=False, error="Mã SHA-256 không khớp, hãy tải lên lại."), 422
+
+    filename, total_size, user_id = upload_session.filename, upload_session.total_size, upload_session.user_id
+    # Nhan phien mot cach nguyen tu: hai lenh finalize dong thoi chi mot lenh xoa duoc dong nay
+    # (lenh kia cho khoa ghi roi nhan 0 dong), nen file .part chi bi dua vao kho mot lan
+    claimed = db.session.execute(
+        db.delete(UploadSession).where(UploadSession.id == upload_id, UploadSession.received == UploadSession.total_size)
+    ).rowcount
+    if not claimed:
+        db.session.rollback()
+        return jsonify(success=False, error="Phiên tải lên đã được hoàn tất."), 409
+    blob = store_blob(upload_part_path(upload_id), sha256, total_size, os.path.splitext(filename)[1][1:].lower())
+    book = add_book_from_blob(blob, filename, user_id)
+    _upload_hashers.pop(upload_id, None)
+    db.session.commit()
+
+    if book is None:
+        return jsonify(success=True, duplicate=True, message="Sách đã tồn tại và được bỏ qua.")
+    generate_and_save_cover(book)
+    return jsonify(success=True, book_id=book.id, url=url_for('book_detail', book_id=book.id))
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    upload_session = get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify(success=False, error="Không tìm thấy phiên tải lên."), 404
+    _upload_hashers.pop(upload_id, None)
+    try:
+        os.remove(upload_part_path(upload_id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(upload_session)
+    db.session.commit()
+    return jsonify(success=True)
+
 @app.route('/cover/<int:book_id>')
 def cover(book_id):
     book = Book.query.get_or_404(book_id)
     cover_path = get_cover_path(book)
 
     if os.path.exists(cover_path):
+        metrics_inc('thuvien_cover_cache_total', result='hit')
         return send_file(cover_path, mimetype='image/jpeg')
 
+    metrics_inc('thuvien_cover_cache_total', result='miss')
     if generate_and_save_cover(book):
         return send_file(cover_path, mimetype='image/jpeg')
     
@@ -2194,7 +4645,7 @@ def cover_original(book_id):
         with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_cover:
             temp_cover_path = tmp_cover.name
         
-        subprocess.run(
+        run_calibre_tool(
             ["ebook-meta", book_filepath, "--get-cover", temp_cover_path],
             check=True, capture_output=True, timeout=30
         )
@@ -2207,16 +4658,44 @@ def cover_original(book_id):
         return redirect(url_for('static', filename='default_cover.jpg'))
 
 @app.route('/read/<int:book_id>')
-@login_required
+@download_login_required
 def read(book_id):
     book = check_book_permission(book_id)
     if not book:
         flash('Bạn không có quyền đọc sách này.', 'danger')
         return redirect(url_for('index'))
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id), book.filename)
-    if os.path.exists(filepath):
+    if not os.path.exists(filepath):
+        return "File không tồn tại", 404
+
+    target_format = request.args.get('format', '').lower()
+    if not target_format or target_format == book.format:
         return send_file(filepath, as_attachment=True)
-    return "File không tồn tại", 404
+
+    # Dinh dang da co trong thu vien thi tai ban do
+    existing = Book.query.filter_by(title=book.title, author=book.author, user_id=book.user_id, format=target_format).first()
+    if existing:
+        return redirect(url_for('read', book_id=existing.id))
+    if target_format not in CONVERT_TARGET_FORMATS:
+        flash('Định dạng tải về không hợp lệ.', 'warning')
+        return redirect(url_for('book_detail', book_id=book.id))
+
+    source_hash = file_sha256(filepath)
+    cache_path = conversion_cache_path(source_hash, target_format)
+    download_name = f"{os.path.splitext(book.filename)[0]}.{target_format}"
+    if os.path.exists(cache_path):
+        metrics_inc('thuvien_conversion_cache_total', result='hit')
+        try:
+            os.utime(cache_path) # Danh dau vua dung cho LRU
+        except OSError:
+            pass
+        return send_file(cache_path, as_attachment=True, download_name=download_name)
+
+    metrics_inc('thuvien_conversion_cache_total', result='miss')
+    job = enqueue_job('convert_download', {'book_id': book.id, 'target_format': target_format},
+                      user_id=current_auth('user_id'),
+                      dedupe_key=f"convert_download:{current_auth('user_id')}:{source_hash}:{target_format}")
+    return redirect(url_for('job_status', job_id=job.id))
 
 @app.route('/delete_format/<int:book_id>', methods=['POST'])
 @login_required
@@ -2244,6 +4723,7 @@ def delete_format(book_id):
     # Delete from DB
     db.session.delete(book_to_delete)
     db.session.commit()
+    collect_unused_blobs()
 
     flash(f'Đã xóa định dạng {book_to_delete.format.upper()}.', 'success')
 
@@ -2317,7 +4797,7 @@ def book_detail(book_id):
 
     related_books = Book.query.filter(Book.id != book.id, Book.user_id == book.user_id, or_(Book.author == book.author, Book.series == book.series)).limit(6).all()
     
-    detail_content = render_template_string(BOOK_DETAIL_TEMPLATE, book=book, all_formats=all_formats, epub_book=epub_book, is_bookmarked=is_bookmarked, is_favorited=is_favorited, related_books=related_books)
+    detail_content = render_template_string(BOOK_DETAIL_TEMPLATE, book=book, all_formats=all_formats, epub_book=epub_book, is_bookmarked=is_bookmarked, is_favorited=is_favorited, related_books=related_books, convert_formats=CONVERT_TARGET_FORMATS)
     return render_template_string(LAYOUT_TEMPLATE, content=detail_content, query='')
 
 @app.route('/edit/<int:book_id>', methods=['GET', 'POST'])
@@ -2387,17 +4867,8 @@ def edit(book_id):
 
             try:
                 with Image.open(tmp_upload_path) as img:
-                    if img.height > COVER_MAX_HEIGHT:
-                        ratio = COVER_MAX_HEIGHT / img.height
-                        new_width = int(img.width * ratio)
-                        img = img.resize((new_width, COVER_MAX_HEIGHT), Image.Resampling.LANCZOS)
-                    if img.mode in ("RGBA", "P"):
-                        img = img.convert("RGB")
-                    
+                    save_cover_image(img, [get_cover_path(book) for book in books_to_update])
                     for book in books_to_update:
-                        final_cover_path = get_cover_path(book)
-                        os.makedirs(os.path.dirname(final_cover_path), exist_ok=True)
-                        img.save(final_cover_path, 'jpeg', quality=80, optimize=True)
                         book.has_cover = True
             except Exception as e:
                 flash(f'Lỗi khi xử lý ảnh bìa mới: {e}', 'danger')
@@ -2432,6 +4903,7 @@ def delete(book_id):
         db.session.delete(book)
             
     db.session.commit()
+    collect_unused_blobs()
     flash(f'Đã xóa sách "{book_rep.title}" và tất cả định dạng.', 'success')
     return redirect(url_for('index'))
 
@@ -2506,6 +4978,408 @@ def rate_book(book_id):
             flash("Giá trị đánh giá không hợp lệ.", 'danger')
     return redirect(url_for('book_detail', book_id=book_id))
 
+# --- THE (TAG) CHUAN HOA ---
+# Book.tags van la chuoi "a, b" (form sua, OPF, Calibre); bang book_tag la ban chuan hoa de
+# loc dung the bang index va dem so sach theo the (tag_count, trigger cap nhat tung dong).
+# Book them / sua qua ORM duoc dong bo tu dong khi flush; cau lenh Core ghi vao Book (nhap
+# hang loat, thao tac hang loat) phai goi sync_book_tags() voi cac id da ghi.
+def split_tags(value):
+    tags = []
+    for tag in (value or '').split(','):
+        tag = tag.strip()[:200]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def sync_book_tags(book_ids, session=None):
+    """Cap nhat book_tag theo Book.tags hien tai cua cac sach (chi them / xoa phan khac nhau)."""
+    session = session or db.session
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), 500):
+        chunk = book_ids[start:start + 500]
+        wanted = {(book_id, name) for book_id, tags in session.execute(db.select(Book.id, Book.tags).where(Book.id.in_(chunk)))
+                  for name in split_tags(tags)}
+        names = {name for _, name in wanted}
+        if names:
+            session.execute(sqlite_insert(Tag.__table__).on_conflict_do_nothing(), [{'name': name} for name in names])
+        tag_ids = dict(session.execute(db.select(Tag.__table__.c.name, Tag.__table__.c.id).where(Tag.__table__.c.name.in_(names))).all()) if names else {}
+        wanted = {(book_id, tag_ids[name]) for book_id, name in wanted}
+        current = set(session.execute(
+            db.select(book_tag.c.book_id, book_tag.c.tag_id).where(book_tag.c.book_id.in_(chunk))).all())
+        removed = current - wanted
+        added = wanted - current
+        if removed:
+            session.execute(
+                db.delete(book_tag).where(book_tag.c.book_id == db.bindparam('b_id'), book_tag.c.tag_id == db.bindparam('t_id')),
+                [{'b_id': book_id, 't_id': tag_id} for book_id, tag_id in removed])
+        if added:
+            session.execute(db.insert(book_tag), [{'book_id': book_id, 'tag_id': tag_id} for book_id, tag_id in added])
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_flushed_book_tags(session, flush_context):
+    book_ids = [obj.id for obj in session.new if isinstance(obj, Book)]
+    book_ids += [obj.id for obj in session.dirty
+                 if isinstance(obj, Book) and db.inspect(obj).attrs.tags.history.has_changes()]
+    if book_ids:
+        sync_book_tags(book_ids, session)
+
+def tag_book_ids(name):
+    """SELECT id cac sach co dung the nay (tra qua index cua tag va book_tag)."""
+    return db.select(book_tag.c.book_id).join(Tag, Tag.id == book_tag.c.tag_id).where(Tag.name == name)
+
+def tag_counts():
+    """[(the, so sach)] trong pham vi nguoi dung hien tai thay duoc, doc tu tag_count."""
+    total = func.sum(TagCount.count)
+    query = (db.select(Tag.name, total).join(TagCount, TagCount.tag_id == Tag.id)
+             .group_by(Tag.id).having(total > 0).order_by(Tag.name))
+    if not current_auth('is_admin'):
+        query = query.where(TagCount.user_id == current_auth('user_id'))
+    return db.session.execute(query).all()
+
+@app.cli.command('rebuild-tags')
+def rebuild_tags_command():
+    """Dong bo lai book_tag tu cot Book.tags va tinh lai tag_count (sau khi sua CSDL bang tay)."""
+    book_ids = db.session.scalars(db.select(Book.id)).all()
+    sync_book_tags(book_ids)
+    db.session.execute(db.delete(TagCount))
+    db.session.execute(db.text(TAG_COUNT_REBUILD_SQL))
+    db.session.execute(db.delete(Tag).where(Tag.id.not_in(db.select(book_tag.c.tag_id))))
+    db.session.commit()
+    print(f"Da dong bo the cho {len(book_ids)} sach.")
+
+@app.route('/tags')
+@login_required
+def tag_cloud():
+    counts = tag_counts()
+    largest = max((count for _, count in counts), default=1)
+    content = render_template_string(TAG_CLOUD_TEMPLATE, tags=counts, largest=largest)
+    return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
+
+# --- LOC THEO THUOC TINH (FACETS) ---
+# Thanh loc ben trai trang chu: ?author=...&format=epub&format=pdf (cung thuoc tinh la HOAC,
+# khac thuoc tinh la VA). Chua loc thi so dem doc tu facet_count (trigger cap nhat); dang loc
+# thi dem tren tap sach da loc, von duoc chon qua index cua tung thuoc tinh.
+FACETS = {
+    'author': 'Tác giả',
+    'series': 'Bộ truyện',
+    'language': 'Ngôn ngữ',
+    'publisher': 'Nhà xuất bản',
+    'format': 'Định dạng',
+    'rating': 'Đánh giá',
+    'year': 'Năm xuất bản',
+}
+FACET_TOP_VALUES = 10
+
+def facet_expression(facet):
+    return db.literal_column(FACET_SQL[facet].format(row='book.'))
+
+def selected_facets():
+    """{facet: [gia tri, ...]} tu query string."""
+    return {facet: values for facet in FACETS if (values := [v for v in request.args.getlist(facet) if v])}
+
+def facet_conditions(selected):
+    return [facet_expression(facet).in_(values) for facet, values in selected.items()]
+
+def facet_url(selected, facet, value):
+    """URL trang hien tai sau khi bat / tat mot gia tri loc."""
+    args = request.args.to_dict(flat=False)
+    values = [v for v in selected.get(facet, []) if v != value]
+    args[facet] = values if value in selected.get(facet, []) else values + [value]
+    args.pop('page', None)
+    return url_for(request.endpoint, **args, **request.view_args)
+
+def facet_sidebar(selected):
+    """{facet: [(gia tri, so sach, dang chon, url)]}: FACET_TOP_VALUES gia tri nhieu sach nhat cung cac gia tri dang chon."""
+    if selected:
+        # Dem tren cac sach da loc (moi sach tua + tac gia tinh mot lan), ca bay thuoc tinh trong mot truy van
+        user_filter = db.true() if session.get('is_admin') else Book.user_id == session.get('user_id')
+        works = db.union_all(*[
+            db.select(Book.user_id, Book.title, Book.author, db.literal(facet).label('facet'), facet_expression(facet).label('value'))
+            .where(user_filter, *facet_conditions(selected)).distinct()
+            for facet in FACETS
+        ]).subquery()
+        counts = (db.select(works.c.facet, works.c.value, func.count().label('total'))
+                  .where(works.c.value != None, works.c.value != '').group_by(works.c.facet, works.c.value))
+    else:
+        counts = (db.select(FacetCount.facet, FacetCount.value, func.sum(FacetCount.count).label('total'))
+                  .where(FacetCount.count > 0).group_by(FacetCount.facet, FacetCount.value))
+        if not session.get('is_admin'):
+            counts = counts.where(FacetCount.user_id == session.get('user_id'))
+    counts = counts.subquery()
+    ranked = db.select(counts, func.row_number().over(
+        partition_by=counts.c.facet, order_by=(counts.c.total.desc(), counts.c.value)).label('rank')).subquery()
+    rows = db.session.execute(db.select(ranked.c.facet, ranked.c.value, ranked.c.total)
+                              .where(ranked.c.rank <= FACET_TOP_VALUES).order_by(ranked.c.facet, ranked.c.rank)).all()
+
+    grouped = {}
+    for facet, value, total in rows:
+        grouped.setdefault(facet, []).append((str(value), total))
+    result = {}
+    for facet in FACETS:
+        values = grouped.get(facet, [])
+        shown = {value for value, _ in values}
+        values += [(value, 0) for value in selected.get(facet, []) if value not in shown]
+        if values:
+            result[facet] = [(value, total, value in selected.get(facet, []), facet_url(selected, facet, value))
+                             for value, total in values]
+    return result
+
+@app.cli.command('rebuild-facets')
+def rebuild_facets_command():
+    """Tinh lai bang facet_count tu bang book."""
+    with db.engine.begin() as conn:
+        rebuild_facet_counts(conn)
+    print("Da tinh lai so dem bo loc.")
+
+# --- BO TRUYEN ---
+# /series liet ke moi bo truyen kem so tap va so tap con thieu; /series/<ten> hien cac tap theo
+# series_index (index ix_book_user_series_index). Bang tong hop duoc giu trong bo nho theo
+# library_generation nen chi tinh lai khi bang book thay doi.
+SERIES_SUMMARY_CACHE_SIZE = 256 # So user (pham vi) nho danh sach bo truyen toi da (LRU)
+_series_summary_cache = OrderedDict() # user_id (None = quan tri vien) -> (generation, danh sach bo truyen)
+_series_summary_cache_lock = threading.Lock()
+
+def series_summaries():
+    """[{'name', 'volumes', 'last', 'missing', 'cover_id'}] theo ten, trong pham vi user hien tai."""
+    scope = None if session.get('is_admin') else session.get('user_id')
+    generation = library_generation()[0]
+    with _series_summary_cache_lock:
+        cached = _series_summary_cache.get(scope)
+        if cached and cached[0] == generation:
+            _series_summary_cache.move_to_end(scope)
+            return cached[1]
+    # Anh bia: dinh dang id nho nhat cua tap co series_index nho nhat (cot tran Book.id khi co ca
+    # max() va min() lay tu dong bat ky). Khong dung has_cover vi doi has_cover (cover() tao anh
+    # bia luc can) khong tang the he thu vien
+    first = db.aliased(Book)
+    first_conditions = [first.series == Book.series, first.series_index.is_(func.min(Book.series_index))]
+    if scope is not None:
+        first_conditions.append(first.user_id == scope)
+    cover_id = db.select(func.min(first.id)).where(*first_conditions).scalar_subquery()
+    # Tap thieu dem nhu series_volumes: cac so 1..tap cuoi khong co (bo qua tap 0 / NULL)
+    numbered = func.count(case((Book.series_index >= 1, Book.series_index)).distinct())
+    query = (db.select(Book.series, func.count(Book.series_index.distinct()), func.max(Book.series_index),
+                       numbered, cover_id)
+             .where(Book.series != None, Book.series != '').group_by(Book.series).order_by(Book.series))
+    if scope is not None:
+        query = query.where(Book.user_id == scope)
+    summaries = []
+    for name, volumes, last, numbered_volumes, first_id in db.session.execute(query):
+        last = max(last or 0, 0)
+        summaries.append({'name': name, 'volumes': volumes, 'last': last,
+                          'missing': last - numbered_volumes, 'cover_id': first_id})
+    with _series_summary_cache_lock:
+        _series_summary_cache[scope] = (generation, summaries)
+        _series_summary_cache.move_to_end(scope)
+        while len(_series_summary_cache) > SERIES_SUMMARY_CACHE_SIZE:
+            _series_summary_cache.popitem(last=False)
+    return summaries
+
+def series_volumes(name):
+    """Cac tap (moi sach tua + tac gia mot dong) theo series_index, va danh sach so tap con thieu tu 1 den tap cuoi."""
+    query = (db.select(func.min(Book.id).label('id'), Book.title, Book.author, Book.series_index,
+                       func.group_concat(Book.format.distinct()).label('formats'))
+             .where(Book.series == name).group_by(Book.series_index, Book.title, Book.author)
+             .order_by(Book.series_index, Book.title))
+    if not session.get('is_admin'):
+        query = query.where(Book.user_id == session.get('user_id'))
+    volumes = db.session.execute(query).all()
+    present = {volume.series_index for volume in volumes}
+    last = max((index or 0 for index in present), default=0)
+    missing = [index for index in range(1, last + 1) if index not in present]
+    return volumes, missing
+
+def compress_ranges(numbers):
+    """[1, 2, 3, 7, 9, 10] -> '1-3, 7, 9-10'."""
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ', '.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+@app.route('/series')
+@login_required
+def series_list():
+    summaries = series_summaries()
+    query_str = request.args.get('q', '').strip()
+    if query_str:
+        needle = remove_diacritics(query_str)
+        summaries = [s for s in summaries if needle in remove_diacritics(s['name'])]
+    content = render_template_string(SERIES_LIST_TEMPLATE, series=summaries, series_query=query_str)
+    return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
+
+@app.route('/series/<path:name>')
+@login_required
+def series_detail(name):
+    volumes, missing = series_volumes(name)
+    if not volumes:
+        flash('Không tìm thấy bộ truyện.', 'warning')
+        return redirect(url_for('series_list'))
+    duplicates = sorted(index for index, count in Counter(v.series_index for v in volumes).items() if count > 1)
+    content = render_template_string(SERIES_DETAIL_TEMPLATE, name=name, volumes=volumes,
+                                     missing=compress_ranges(missing), missing_count=len(missing), duplicates=duplicates)
+    return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
+
+# --- THAO TAC HANG LOAT (CHON NHIEU SACH) ---
+# POST /api/books/bulk {"action", "book_ids", "value"}: book_ids la sach dai dien (nhu tren luoi),
+# moi thao tac ap dung cho moi dinh dang cung tua / tac gia, bang mot vai cau UPDATE / DELETE /
+# INSERT ... SELECT trong mot giao dich thay vi lap qua tung sach. Xoa file va anh bia chay nen.
+BULK_ACTIONS = {
+    'delete': 'Xóa sách',
+    'add_tags': 'Thêm thẻ',
+    'remove_tags': 'Bỏ thẻ',
+    'rating': 'Đánh giá',
+    'series': 'Đặt bộ truyện',
+    'add_to_list': 'Thêm vào kệ',
+    'remove_from_list': 'Bỏ khỏi kệ',
+}
+BULK_GUEST_PERMISSIONS = {'delete': 'can_delete_books', 'rating': 'can_rate', 'add_tags': 'can_edit_books',
+                          'remove_tags': 'can_edit_books', 'series': 'can_edit_books'}
+BULK_MAX_BOOKS = 5000
+BULK_FILE_BATCH_SIZE = 500
+
+def selected_work_ids(book_ids):
+    """SELECT id cua moi dinh dang thuoc cac sach da chon ma nguoi dung hien tai duoc phep sua."""
+    selected = db.aliased(Book)
+    query = (db.select(Book.id)
+             .join(selected, and_(selected.user_id == Book.user_id, selected.title == Book.title,
+                                  selected.author.is_(Book.author)))
+             .where(selected.id.in_(book_ids)))
+    if not current_auth('is_admin'):
+        query = query.where(selected.user_id == current_auth('user_id'))
+    return query
+
+def bulk_update_tags(target_ids, add=(), remove=()):
+    """
+    Them / bo the cho cac sach target_ids. So khop dung nhu split_tags va bang tag (phan biet
+    hoa thuong, moi kieu dau phay), chi ghi lai cac dong thuc su doi. Tra ve id cac dong da doi.
+    """
+    changes = []
+    for book_id, tags in db.session.execute(db.select(Book.id, Book.tags).where(Book.id.in_(target_ids))):
+        current = split_tags(tags)
+        updated = [tag for tag in current if tag not in remove] + [tag for tag in add if tag not in current]
+        if updated != current:
+            changes.append({'b_id': book_id, 'b_tags': ', '.join(updated) or None})
+    if changes:
+        books = Book.__table__
+        db.session.execute(db.update(books).where(books.c.id == db.bindparam('b_id')).values(tags=db.bindparam('b_tags')), changes)
+    return [change['b_id'] for change in changes]
+
+def add_to_shelves(list_ids, format_ids):
+    """INSERT ... SELECT moi cap (sach, ke) con thieu; list_ids / format_ids la danh sach id hoac cau SELECT."""
+    return db.session.execute(
+        sqlite_insert(book_list_association).from_select(
+            ['book_id', 'book_list_id'],
+            db.select(Book.id, BookList.id).join(BookList, db.true())
+            .where(Book.id.in_(format_ids), BookList.id.in_(list_ids)))
+        .on_conflict_do_nothing()
+    ).rowcount
+
+def remove_from_shelves(list_ids, format_ids):
+    return db.session.execute(
+        db.delete(book_list_association)
+        .where(book_list_association.c.book_list_id.in_(list_ids), book_list_association.c.book_id.in_(format_ids))
+    ).rowcount
+
+@job_handler('remove_book_files', 'Xóa file sách')
+def _remove_book_files_job(job_id, paths):
+    removed = 0
+    for start in range(0, len(paths), BULK_FILE_BATCH_SIZE):
+        for path in paths[start:start + BULK_FILE_BATCH_SIZE]:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Khong the xoa {path}: {e}")
+        report_job_progress(job_id, int(min(start + BULK_FILE_BATCH_SIZE, len(paths)) * 100 / len(paths)),
+                            f"Đã xử lý {min(start + BULK_FILE_BATCH_SIZE, len(paths))}/{len(paths)} file...")
+    blobs = collect_unused_blobs()
+    return {'removed': removed, 'blobs': blobs, 'message': f"Đã xóa {removed} file, dọn {blobs} blob."}
+
+@app.route('/api/books/bulk', methods=['POST'])
+@login_required
+def bulk_books():
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    value = data.get('value')
+    try:
+        requested_ids = [int(book_id) for book_id in data.get('book_ids') or []]
+    except (TypeError, ValueError):
+        requested_ids = []
+    book_ids = sorted(set(requested_ids))
+    if action not in BULK_ACTIONS:
+        return jsonify(success=False, error="Thao tác không hợp lệ."), 400
+    if action in BULK_GUEST_PERMISSIONS and not guest_allowed(BULK_GUEST_PERMISSIONS[action]):
+        return jsonify(success=False, error="Tài khoản khách không được phép."), 403
+    if not book_ids or len(book_ids) > BULK_MAX_BOOKS:
+        return jsonify(success=False, error=f"Hãy chọn từ 1 đến {BULK_MAX_BOOKS} sách."), 400
+
+    user_id = session.get('user_id')
+    target_ids = selected_work_ids(book_ids)
+    job_id = None
+    if action == 'delete':
+        rows = db.session.execute(db.select(Book.id, Book.user_id, Book.filename).where(Book.id.in_(target_ids))).all()
+        paths = []
+        for book_id, owner_id, filename in rows:
+            paths.append(os.path.join(app.config['UPLOAD_FOLDER'], str(owner_id), filename))
+            paths.append(os.path.join(app.config['COVER_FOLDER'], str(owner_id), f"{book_id}.jpg"))
+        delete_book_rows([book_id for book_id, _, _ in rows])
+        affected = len(rows)
+    elif action in ('add_tags', 'remove_tags'):
+        tags = split_tags(value)
+        if not tags:
+            return jsonify(success=False, error="Chưa nhập thẻ."), 400
+        changed = bulk_update_tags(target_ids, **{'add' if action == 'add_tags' else 'remove': tags})
+        sync_book_tags(changed)
+        affected = len(changed)
+    elif action == 'rating':
+        try:
+            rating = int(value)
+        except (TypeError, ValueError):
+            rating = -1
+        if not 0 <= rating <= 5:
+            return jsonify(success=False, error="Giá trị đánh giá không hợp lệ."), 400
+        affected = db.session.execute(db.update(Book).where(Book.id.in_(target_ids)).values(rating=rating)).rowcount
+    elif action == 'series':
+        series = (value or '').strip() or None
+        values = {'series': series}
+        start_index = data.get('start_index')
+        if series and start_index not in (None, ''):
+            # Danh so tap theo thu tu da chon; cac dinh dang cua cung mot sach chung mot so tap
+            try:
+                start_index = int(start_index)
+            except (TypeError, ValueError):
+                return jsonify(success=False, error="Tập số không hợp lệ."), 400
+            works = dict((book_id, (title, author)) for book_id, title, author in db.session.execute(
+                db.select(Book.id, Book.title, Book.author).where(Book.id.in_(book_ids))))
+            numbering = {}
+            for book_id in requested_ids:
+                if book_id in works:
+                    numbering.setdefault(works[book_id], start_index + len(numbering))
+            values['series_index'] = case(
+                *[(and_(Book.title == title, Book.author.is_(author)), number) for (title, author), number in numbering.items()],
+                else_=Book.series_index)
+        affected = db.session.execute(db.update(Book).where(Book.id.in_(target_ids)).values(**values)).rowcount
+    else:
+        book_list = BookList.query.filter_by(id=data.get('list_id'), user_id=user_id).first()
+        if book_list is None:
+            return jsonify(success=False, error="Không tìm thấy kệ sách."), 404
+        if action == 'add_to_list':
+            affected = add_to_shelves([book_list.id], target_ids)
+        else:
+            affected = remove_from_shelves([book_list.id], target_ids)
+    db.session.commit()
+
+    if action == 'delete' and paths:
+        job_id = enqueue_job('remove_book_files', {'paths': paths}, user_id).id
+    message = f"{BULK_ACTIONS[action]}: đã cập nhật {affected} file sách."
+    flash(message, 'success')
+    return jsonify(success=True, affected=affected, job_id=job_id, message=message)
+
 @app.route('/manage_users')
 @login_required
 def manage_users():
@@ -2591,8 +5465,12 @@ def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], str(user_id)), ignore_errors=True)
     shutil.rmtree(os.path.join(app.config['COVER_FOLDER'], str(user_id)), ignore_errors=True)
+    watch_folder_ids = db.session.query(WatchFolder.id).filter(WatchFolder.user_id == user_id)
+    WatchedFile.query.filter(WatchedFile.folder_id.in_(watch_folder_ids)).delete(synchronize_session=False)
+    WatchFolder.query.filter_by(user_id=user_id).delete(synchronize_session=False)
     db.session.delete(user)
     db.session.commit()
+    collect_unused_blobs()
     flash(f'Đã xóa người dùng {user.username}.', 'success')
     return redirect(url_for('manage_users'))
 
@@ -2610,130 +5488,1196 @@ def import_calibre():
                 <input type="file" name="calibre_zip" class="hidden" accept=".zip" required onchange="this.form.submit()">
             </label>
         </form>
+        {% if session.get('is_admin') %}
+        <hr class="my-8 border-gray-200 dark:border-gray-700">
+        <h3 class="text-lg font-semibold mb-2 text-gray-900 dark:text-white">Nhập trực tiếp thư mục thư viện Calibre</h3>
+        <p class="text-gray-500 dark:text-gray-400 mb-4">Chọn thư mục chứa <code>metadata.db</code> trên máy chủ. Sách được nhập trong nền, không cần nén thành .zip.</p>
+        <form method="POST" action="{{ url_for('import_calibre_library_route') }}" class="flex gap-2">
+            <input type="text" id="calibre_library_path" name="library_path" required class="flex-1 px-3 py-2 bg-gray-50 dark:bg-gray-700 border border-gray-300 dark:border-gray-600 rounded-lg text-gray-900 dark:text-white">
+            <button type="button" onclick="openFileBrowser('calibre_library_path')" class="px-4 py-2 bg-gray-200 dark:bg-gray-600 text-gray-800 dark:text-white rounded-lg"><i class="fas fa-folder-open"></i></button>
+            <button type="submit" class="px-4 py-2 bg-blue-600 text-white font-semibold rounded-lg hover:bg-blue-700">Nhập</button>
+        </form>
+        {{ file_browser|safe }}
+        {% endif %}
     </div>
     """
-    content = render_template_string(IMPORT_TEMPLATE)
+    content = render_template_string(IMPORT_TEMPLATE, file_browser=render_file_browser() if session.get('is_admin') else '')
     return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
 
+def group_calibre_zip_entries(zip_ref):
+    """Nhom cac muc trong zip theo thu muc sach (thu muc co metadata.opf) ma khong giai nen."""
+    folders = {}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        folder, name = posixpath.split(info.filename)
+        folders.setdefault(folder, {})[name] = info
+    return {folder: entries for folder, entries in folders.items() if 'metadata.opf' in entries}
+
+CALIBRE_IMPORT_BATCH_SIZE = 500 # So Book ghi moi lan executemany + commit khi nhap hang loat
+
+def existing_book_keys(user_id):
+    """Tap (title, author, format) cua moi sach cua user, de kiem tra trung lap khong can truy van tung file."""
+    return set(db.session.query(Book.title, Book.author, Book.format).filter(Book.user_id == user_id))
+
+def bulk_insert_books(pending, user_id, load_cover, on_cover_progress=None):
+    """
+    Ghi cac dong Book dang cho bang mot lenh executemany roi commit. pending la danh sach
+    (dong Book, khoa anh bia hoac None, blob); anh bia cua moi khoa chi duoc giai ma mot lan
+    (load_cover(khoa) tra ve duong dan hoac bytes), song song qua process pool, va luu cho
+    moi dinh dang vua them. Xoa pending khi xong.
+    """
+    if not pending:
+        return
+    # sort_by_parameter_order: id tra ve theo dung thu tu pending (executemany co the chia lo)
+    book_ids = db.session.execute(db.insert(Book).returning(Book.id, sort_by_parameter_order=True),
+                                  [row for row, _, _ in pending]).scalars().all()
+    sync_book_tags(book_ids)
+
+    covers = {}
+    for book_id, (_, cover_key, blob) in zip(book_ids, pending):
+        if cover_key is not None:
+            covers.setdefault(cover_key, []).append((book_id, blob))
+    tasks = []
+    for cover_key, items in covers.items():
+        dest_paths = [os.path.join(app.config['COVER_FOLDER'], str(user_id), f"{book_id}.jpg") for book_id, _ in items]
+        # Blob dung chung giua nhieu sach trong lo chi can mot ban anh bia
+        new_blobs = list({blob.sha256: blob for _, blob in items if blob.has_cover is None}.values())
+        dest_paths += [blob_cover_path(blob.sha256) for blob in new_blobs]
+        tasks.append((cover_key, lambda cover_key=cover_key: load_cover(cover_key), dest_paths))
+    with metrics_timer('thuvien_import_covers_seconds'):
+        done_keys = process_covers_in_parallel(tasks, on_cover_progress)
+
+    with_cover = []
+    for cover_key in done_keys:
+        items = covers[cover_key]
+        with_cover.extend(book_id for book_id, _ in items)
+        for _, blob in items:
+            if blob.has_cover is None:
+                blob.has_cover = True
+    if with_cover:
+        db.session.execute(db.update(Book).where(Book.id.in_(with_cover)).values(has_cover=True))
+    db.session.commit()
+    pending.clear()
+
+def import_calibre_zip(zip_ref, user_id, job_id=None, on_progress=None):
+    """
+    Nhap zip 'Luu vao dia' cua Calibre: doc metadata.opf trong bo nho, chep tung file sach
+    thang tu zip vao kho blob va dua cover.jpg thang vao bo thu nho anh, khong giai nen ra
+    dia. Kiem tra trung lap bang tap khoa nap mot lan (ca voi sach trung nhau trong chinh
+    file zip), Book ghi theo lo CALIBRE_IMPORT_BATCH_SIZE.
+    Neu co job_id, moi thu muc sach duoc ghi checkpoint cung transaction voi cac Book cua no:
+    chay lai tac vu (sau khi khoi dong lai) bo qua cac thu muc da xong.
+    on_progress(da xu ly, tong, tieu de, counts). Tra ve dict dem added / skipped / failed.
+    """
+    counts = {'added': 0, 'skipped': 0, 'failed': 0}
+    finished_folders = set()
+    if job_id is not None:
+        for checkpoint in ImportCheckpoint.query.filter_by(job_id=job_id):
+            finished_folders.add(checkpoint.entry)
+            counts['added'] += checkpoint.added
+            counts['skipped'] += checkpoint.skipped
+            counts['failed'] += checkpoint.failed
+    known_keys = existing_book_keys(user_id)
+    used = user_storage_used(user_id)
+    pending = [] # (dong Book, thu muc co cover.jpg hoac None, blob)
+    pending_checkpoints = []
+    load_cover = lambda folder: zip_ref.read(posixpath.join(folder, 'cover.jpg'))
+
+    def flush():
+        if pending_checkpoints:
+            db.session.execute(db.insert(ImportCheckpoint), pending_checkpoints)
+            pending_checkpoints.clear()
+        bulk_insert_books(pending, user_id, load_cover)
+        db.session.commit()
+
+    folders = group_calibre_zip_entries(zip_ref)
+    for done, (folder, entries) in enumerate(folders.items(), 1):
+        if folder in finished_folders:
+            continue
+        linked_paths = []
+        folder_rows = []
+        folder_keys = set()
+        folder_counts = {'added': 0, 'skipped': 0, 'failed': 0}
+        folder_size = 0
+        metadata = {}
+        try:
+            metadata = parse_opf(zip_ref.read(entries['metadata.opf']).decode('utf-8', errors='ignore'))
+            if not metadata.get('title'):
+                metadata['title'] = posixpath.basename(folder)
+            cover_key = folder if 'cover.jpg' in entries else None
+
+            # Savepoint: thu muc loi chi bo phan blob cua no, cac thu muc dang cho ghi van giu
+            with db.session.begin_nested():
+                for name, info in entries.items():
+                    ext = name.rsplit('.', 1)[-1].lower()
+                    key = (metadata.get('title'), metadata.get('author'), ext)
+                    if ext not in ALLOWED_EXTENSIONS:
+                        continue
+                    if key in known_keys or key in folder_keys:
+                        folder_counts['skipped'] += 1
+                        continue
+                    error = ingest_limit_error(user_id, info.file_size, used + folder_size)
+                    if error:
+                        folder_counts['failed'] += 1
+                        print(f"Bỏ qua {name} tại {folder}: {error}")
+                        continue
+                    folder_size += info.file_size
+
+                    safe_base = secure_filename(f"{metadata.get('author', 'Unknown')}_{metadata.get('title', 'Untitled')}_{datetime.now().timestamp()}")
+                    with zip_ref.open(info) as source_file:
+                        temp_path, sha256, size = spool_to_blob_store(source_file, ext)
+                    blob = store_blob(temp_path, sha256, size, ext)
+                    new_filename = link_blob_into_library(blob, user_id, f"{safe_base}.{ext}")
+                    linked_paths.append(os.path.join(app.config['UPLOAD_FOLDER'], str(user_id), new_filename))
+
+                    folder_keys.add(key)
+                    folder_rows.append(({
+                        'filename': new_filename, 'title': metadata.get('title'), 'author': metadata.get('author', 'Chưa rõ'),
+                        'format': ext, 'tags': metadata.get('tags'), 'description': metadata.get('description'),
+                        'series': metadata.get('series'), 'series_index': metadata.get('series_index', 1),
+                        'publisher': metadata.get('publisher'), 'pubdate': metadata.get('pubdate'),
+                        'language': metadata.get('language') or 'Tiếng Việt', 'user_id': user_id, 'rating': 0,
+                        'blob_sha256': blob.sha256, 'has_cover': False, # Se cap nhat sau
+                        'date_added': datetime.utcnow(),
+                    }, cover_key, blob))
+            folder_counts['added'] = len(folder_rows)
+        except Exception as e:
+            for path in linked_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            folder_rows = []
+            folder_keys = set()
+            folder_size = 0
+            folder_counts = {'added': 0, 'skipped': 0, 'failed': 1}
+            print(f"Lỗi khi xử lý sách từ Calibre import: {e} tại {folder}")
+
+        known_keys |= folder_keys
+        used += folder_size
+        pending.extend(folder_rows)
+        for name, value in folder_counts.items():
+            counts[name] += value
+        if job_id is not None:
+            pending_checkpoints.append(dict(folder_counts, job_id=job_id, entry=folder))
+        if len(pending) >= CALIBRE_IMPORT_BATCH_SIZE or len(pending_checkpoints) >= CALIBRE_IMPORT_BATCH_SIZE:
+            flush()
+        if on_progress:
+            on_progress(done, len(folders), metadata.get('title') or folder, counts)
+    flush()
+    return counts
+
+def import_summary(counts):
+    return f"Đã thêm {counts['added']}, bỏ qua {counts['skipped']} (đã có), lỗi {counts['failed']}."
+
+def remove_import_zip(zip_path):
+    try:
+        os.remove(zip_path)
+    except FileNotFoundError:
+        pass
+
+@job_handler('calibre_zip_import', 'Nhập từ Calibre', result_url=lambda result: url_for('index'),
+             retryable=True, on_discard=lambda params: remove_import_zip(params['zip_path']))
+def _calibre_zip_import_job(job_id, zip_path, user_id):
+    # File zip chi xoa khi xong hoac bi huy: neu loi (CSDL bi khoa, het dia...) hay process chet
+    # giua chung thi chay lai tac vu tiep tuc tu checkpoint tren chinh file do
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            counts = import_calibre_zip(
+                zip_ref, user_id, job_id=job_id,
+                on_progress=lambda done, total, title, counts: report_job_progress(
+                    job_id, int(done * 100 / max(total, 1)), f"{done}/{total}: {title}", details=counts)
+            )
+    except JobCancelled:
+        remove_import_zip(zip_path)
+        raise
+    remove_import_zip(zip_path)
+    counts['message'] = import_summary(counts) if sum(counts.values()) else "Không tìm thấy sách hợp lệ nào trong file zip."
+    return counts
+
 @app.route('/process_calibre_import', methods=['POST'])
 @login_required
 def process_calibre_import():
-    success_count = 0   # <-- Khởi tạo ngay từ đầu
-    warning_count = 0
-    error_count = 0
+    """Luu file zip roi tra ve ngay: viec nhap chay trong tac vu nen (xem /jobs/<id> hoac /api/jobs/<id>/events)."""
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    def fail(message, status=400):
+        if wants_json:
+            return jsonify(success=False, error=message), status
+        flash(message, 'danger')
+        return redirect(url_for('import_calibre'))
+
     if session.get('username') == GUEST_USERNAME:
         permissions = GuestPermission.query.first()
         if not permissions or not permissions.can_upload_books:
-            flash('Tài khoản khách không có quyền nhập sách.', 'danger')
-            return redirect(url_for('import_calibre'))
+            return fail('Tài khoản khách không có quyền nhập sách.', 403)
 
     zip_file = request.files.get('calibre_zip')
     if not zip_file or zip_file.filename == '':
-        flash('Không có file nào được chọn.', 'danger')
-        return redirect(url_for('import_calibre'))
+        return fail('Không có file nào được chọn.')
     if not zip_file.filename.lower().endswith('.zip'):
-        flash('Chỉ chấp nhận file .zip.', 'danger')
+        return fail('Chỉ chấp nhận file .zip.')
+
+    os.makedirs(IMPORTS_FOLDER, exist_ok=True)
+    zip_path = os.path.join(IMPORTS_FOLDER, f"{uuid.uuid4().hex}.zip")
+    zip_file.save(zip_path)
+    metrics_inc('thuvien_import_bytes_total', os.path.getsize(zip_path))
+    if not zipfile.is_zipfile(zip_path):
+        os.remove(zip_path)
+        return fail('File zip không hợp lệ hoặc bị hỏng.')
+
+    user_id = session.get('user_id')
+    job = enqueue_job('calibre_zip_import', {'zip_path': zip_path, 'user_id': user_id}, user_id)
+    if wants_json:
+        return jsonify(success=True, job_id=job.id, status_url=url_for('job_status_api', job_id=job.id),
+                       events_url=url_for('job_events', job_id=job.id)), 202
+    return redirect(url_for('job_status', job_id=job.id))
+
+# Doc thu vien Calibre bang mot truy van: moi sach mot dong, tac gia / the / bo truyen /
+# danh gia / nha xuat ban / ngon ngu / gioi thieu lay bang subquery tren cac bang lien ket.
+CALIBRE_BOOKS_QUERY = """
+SELECT b.id, b.title, b.path, b.has_cover, b.pubdate, b.series_index,
+    (SELECT GROUP_CONCAT(a.name, ' & ') FROM books_authors_link l JOIN authors a ON a.id = l.author WHERE l.book = b.id) AS authors,
+    (SELECT GROUP_CONCAT(t.name, ', ') FROM books_tags_link l JOIN tags t ON t.id = l.tag WHERE l.book = b.id) AS tags,
+    (SELECT s.name FROM books_series_link l JOIN series s ON s.id = l.series WHERE l.book = b.id) AS series,
+    (SELECT r.rating FROM books_ratings_link l JOIN ratings r ON r.id = l.rating WHERE l.book = b.id) AS rating,
+    (SELECT p.name FROM books_publishers_link l JOIN publishers p ON p.id = l.publisher WHERE l.book = b.id) AS publisher,
+    (SELECT g.lang_code FROM books_languages_link l JOIN languages g ON g.id = l.lang_code WHERE l.book = b.id
+        ORDER BY l.item_order LIMIT 1) AS language,
+    (SELECT c.text FROM comments c WHERE c.book = b.id) AS description
+FROM books b
+ORDER BY b.id
+"""
+
+def read_calibre_library(library_path):
+    """Doc metadata va danh sach file cua moi sach tu metadata.db (mo chi doc, Calibre van chay duoc)."""
+    db_path = os.path.join(library_path, 'metadata.db')
+    conn = sqlite3.connect('file:' + urllib.parse.quote(db_path) + '?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        formats = {}
+        for row in conn.execute("SELECT book, format, name FROM data ORDER BY book, format"):
+            formats.setdefault(row['book'], []).append((row['format'].lower(), row['name']))
+
+        books = []
+        for row in conn.execute(CALIBRE_BOOKS_QUERY):
+            pubdate = row['pubdate'] or ''
+            books.append({
+                'calibre_id': row['id'],
+                'path': row['path'],
+                'has_cover': bool(row['has_cover']),
+                'formats': formats.get(row['id'], []),
+                'metadata': {
+                    'title': row['title'] or 'Untitled',
+                    'author': row['authors'] or 'Chưa rõ',
+                    'tags': row['tags'],
+                    'series': row['series'],
+                    'series_index': int(row['series_index'] or 1),
+                    'rating': (row['rating'] or 0) // 2, # Calibre luu 0-10 (nua sao)
+                    'publisher': row['publisher'],
+                    # Calibre dung nam 101 cho "khong ro ngay"
+                    'pubdate': pubdate.replace(' ', 'T') if pubdate and not pubdate.startswith('0101') else None,
+                    'language': row['language'],
+                    'description': row['description'],
+                },
+            })
+        return books
+    finally:
+        conn.close()
+
+def import_calibre_library(library_path, user_id, on_progress=None, on_cover_progress=None):
+    """
+    Nhap truc tiep tu thu muc thu vien Calibre: metadata doc gop tu metadata.db, file sach
+    sao chep (va bam) thang vao kho blob, Book duoc ghi theo lo CALIBRE_IMPORT_BATCH_SIZE.
+    Khong hard link file cua Calibre vi Calibre co the ghi de noi dung khi nhung metadata.
+    Tra ve dict dem so sach da them / bo qua / loi. Chay lai sau khi bi ngat thi cac sach da
+    nhap tu nhien bi bo qua nhu sach trung.
+    """
+    entries = read_calibre_library(library_path)
+    known_keys = existing_book_keys(user_id)
+    known_blobs = {sha256 for (sha256,) in db.session.query(Book.blob_sha256).filter(Book.user_id == user_id)}
+    used = user_storage_used(user_id)
+    counts = {'added': 0, 'skipped': 0, 'failed': 0}
+    total = sum(len(entry['formats']) for entry in entries) or 1
+    done = 0
+    pending = [] # (dong Book, duong dan cover.jpg hoac None, blob)
+    load_cover = lambda cover_src: cover_src
+
+    for entry in entries:
+        metadata = entry['metadata']
+        for fmt, name in entry['formats']:
+            done += 1
+            if on_progress:
+                on_progress(done, total, metadata['title'], counts)
+            key = (metadata['title'], metadata['author'], fmt)
+            if fmt not in ALLOWED_EXTENSIONS or key in known_keys:
+                counts['skipped'] += 1
+                continue
+            source_path = os.path.join(library_path, entry['path'], f"{name}.{fmt}")
+            try:
+                error = ingest_limit_error(user_id, os.path.getsize(source_path), used)
+                if error:
+                    counts['failed'] += 1
+                    print(f"Bỏ qua {source_path}: {error}")
+                    continue
+                with open(source_path, 'rb') as source_file:
+                    temp_path, sha256, size = spool_to_blob_store(source_file, fmt)
+                blob = store_blob(temp_path, sha256, size, fmt)
+                if blob.sha256 in known_blobs:
+                    counts['skipped'] += 1
+                    continue
+                filename = link_blob_into_library(blob, user_id, secure_filename(f"{name}.{fmt}") or f"book.{fmt}")
+            except OSError as e:
+                counts['failed'] += 1
+                print(f"Lỗi khi nhập {source_path}: {e}")
+                continue
+            if blob.opf_metadata is None:
+                # Lan sau co nguoi tai len dung file nay thi khong can chay ebook-meta
+                blob.opf_metadata = json.dumps(
+                    {k: v for k, v in metadata.items() if v is not None and k != 'rating'}, ensure_ascii=False)
+            known_keys.add(key)
+            known_blobs.add(blob.sha256)
+            used += blob.size
+            cover_src = os.path.join(library_path, entry['path'], 'cover.jpg') if entry['has_cover'] else None
+            pending.append((dict(metadata, filename=filename, format=fmt, user_id=user_id,
+                                 language=metadata['language'] or 'Tiếng Việt', blob_sha256=blob.sha256,
+                                 has_cover=False, date_added=datetime.utcnow()), cover_src, blob))
+            counts['added'] += 1
+            if len(pending) >= CALIBRE_IMPORT_BATCH_SIZE:
+                bulk_insert_books(pending, user_id, load_cover, on_cover_progress)
+    bulk_insert_books(pending, user_id, load_cover, on_cover_progress)
+    return counts
+
+@job_handler('calibre_library_import', 'Nhập thư viện Calibre',
+             result_url=lambda result: url_for('index'))
+def _calibre_library_import_job(job_id, library_path, user_id):
+    counts = import_calibre_library(
+        library_path, user_id,
+        on_progress=lambda done, total, title, counts: report_job_progress(
+            job_id, int(done * 100 / total), f"{done}/{total}: {title}", details=counts),
+        on_cover_progress=lambda done, total: report_job_progress(job_id, None, f"Ảnh bìa {done}/{total}")
+    )
+    counts['message'] = import_summary(counts)
+    return counts
+
+@app.route('/import_calibre_library', methods=['POST'])
+@login_required
+def import_calibre_library_route():
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('import_calibre'))
+
+    library_path = os.path.abspath(os.path.normpath(request.form.get('library_path', '').strip() or '.'))
+    safe_root_norm = os.path.abspath(os.path.normpath(SAFE_BROWSING_ROOT))
+    if not library_path.startswith(safe_root_norm):
+        flash('Truy cập bị từ chối.', 'danger')
+        return redirect(url_for('import_calibre'))
+    if not os.path.isfile(os.path.join(library_path, 'metadata.db')):
+        flash('Thư mục đã chọn không phải thư viện Calibre (không có metadata.db).', 'warning')
         return redirect(url_for('import_calibre'))
 
     user_id = session.get('user_id')
-    user_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(user_id))
-    os.makedirs(user_upload_folder, exist_ok=True)
-    
-    temp_dir = tempfile.mkdtemp()
-    
-    newly_added_books_with_covers = []
-    warning_count = 0
-    error_count = 0
-    
+    job = enqueue_job('calibre_library_import', {'library_path': library_path, 'user_id': user_id},
+                      user_id, dedupe_key=f"calibre_library:{user_id}:{library_path}")
+    return redirect(url_for('job_status', job_id=job.id))
+
+# --- THU MUC THEO DOI (WATCH FOLDERS) ---
+# Sach tha vao thu muc theo doi duoc tu dong nhap vao thu vien cua chu thu muc (thu muc
+# "toan thu vien" thuoc admin). Bang watched_file la chi muc (duong dan, size, mtime, sha256)
+# cua moi file da xet: lan quet sau chi bam va nhap file moi hoac da doi. Tren Linux dung
+# inotify (qua ctypes, khong can thu vien ngoai) nen chi cac file co su kien moi bi xet; noi
+# khac (hoac khi inotify het watch) quay ve quet dinh ky bang os.scandir (moi file mot stat).
+# Chi mot process tren may chay vong theo doi (host_slot), process khac cho de thay the.
+WATCH_EVENT_WAIT_SECONDS = 2 # Duong dan phai yen (khong co su kien, mtime khong doi) trong khoang nay moi duoc xet
+WATCH_SETTLE_SECONDS = 10 # Khi quet dinh ky, file vua sua gan day co the dang duoc chep: de lan sau
+WATCH_MAX_EVENT_PATHS = 200 # Nhieu duong dan co su kien hon the nay thi quet ca cay cho nhanh
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
     try:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class InotifyWatcher:
+    """Theo doi de quy cac cay thu muc bang inotify; moi thu muc con mot watch."""
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.watches = {} # wd -> (folder_id, duong dan thu muc)
+
+    def add_tree(self, folder_id, root):
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_INOTIFY_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"inotify_add_watch {dirpath}: {os.strerror(errno)}")
+            self.watches[wd] = (folder_id, dirpath)
+
+    def read_events(self, timeout):
+        """Cho toi da timeout giay. Tra ve danh sach (folder_id, duong dan, mask); folder_id None = tran hang doi."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 256 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].split(b'\0', 1)[0]
+            offset += _INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, None, mask))
+            elif mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                folder_id, dir_path = self.watches[wd]
+                events.append((folder_id, os.path.join(dir_path, os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def walk_watch_folder(root):
+    """Liet ke (duong dan, size, mtime_ns) cua cac file sach trong cay thu muc bang os.scandir (bo qua file an)."""
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and allowed_file(entry.name):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+        except OSError as e:
+            print(f"Khong doc duoc thu muc theo doi {current}: {e}")
+
+def ingest_watched_file(folder, path, size, mtime_ns):
+    """Nhap mot file tu thu muc theo doi (sao chep vao kho, metadata, anh bia) va cap nhat chi muc."""
+    rel_path = os.path.relpath(path, folder.path).replace(os.sep, '/')
+    ext = os.path.splitext(path)[1][1:].lower()
+    book = None
+    sha256 = None
+    error = ingest_limit_error(folder.user_id, size)
+    if error:
+        # Ghi 'failed' kem size / mtime hien tai: chi thu lai khi file thay doi
+        print(f"Khong nhap duoc {path}: {error}")
+        status = 'failed'
+    else:
+        try:
+            # Sao chep chu khong hard link: nguoi dung co the sua / xoa file trong thu muc theo doi
+            with open(path, 'rb') as source_file:
+                temp_path, sha256, stored_size = spool_to_blob_store(source_file, ext)
+            blob = store_blob(temp_path, sha256, stored_size, ext)
+            book = add_book_from_blob(blob, secure_filename(os.path.basename(path)) or f"book.{ext}", folder.user_id)
+            status = 'ingested' if book else 'duplicate'
+            db.session.commit()
+        except OSError as e:
+            db.session.rollback()
+            print(f"Khong nhap duoc {path}: {e}")
+            status = 'failed'
+    if book is not None:
+        generate_and_save_cover(book)
+    db.session.execute(
+        sqlite_insert(WatchedFile).values(
+            folder_id=folder.id, path=rel_path, size=size, mtime_ns=mtime_ns, sha256=sha256,
+            status=status, book_id=book.id if book else None, scanned_at=datetime.utcnow()
+        ).on_conflict_do_update(
+            index_elements=['folder_id', 'path'],
+            set_={'size': size, 'mtime_ns': mtime_ns, 'sha256': sha256, 'status': status,
+                  'book_id': book.id if book else None, 'scanned_at': datetime.utcnow()}
+        )
+    )
+    db.session.commit()
+    metrics_inc('thuvien_watch_files_total', status=status)
+    return status
 
-        for root, dirs, files in os.walk(temp_dir):
-            if 'metadata.opf' in files:
-                opf_path = os.path.join(root, 'metadata.opf')
+def scan_watch_folder(folder, paths=None):
+    """
+    Dong bo chi muc voi dia va nhap file moi / da doi. paths=None: quet ca cay; paths: chi xet
+    cac duong dan nay (tu su kien inotify; thu muc thi xet ca cay con). File con dang duoc ghi
+    (mtime qua moi hoac size / mtime doi trong luc xet) thi bo qua. File bien mat chi bi xoa
+    khoi chi muc, sach da nhap van giu. Tra ve (so file da nhap, cac duong dan can xet lai).
+    """
+    if paths is None:
+        candidates = walk_watch_folder(folder.path)
+        index = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 db.session.query(WatchedFile.path, WatchedFile.size, WatchedFile.mtime_ns).filter_by(folder_id=folder.id)}
+        settle_before = time.time_ns() - WATCH_SETTLE_SECONDS * 1_000_000_000
+    else:
+        candidates = []
+        for path in paths:
+            if os.path.isdir(path):
+                candidates.extend(walk_watch_folder(path))
+            elif allowed_file(os.path.basename(path)):
                 try:
-                    with open(opf_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        opf_content = f.read()
-                    
-                    metadata = parse_opf(opf_content)
-                    if not metadata.get('title'):
-                        metadata['title'] = os.path.basename(root)
-
-                    cover_source_path = os.path.join(root, 'cover.jpg') if 'cover.jpg' in files else None
-                    
-                    for file in files:
-                        ext = file.rsplit('.', 1)[-1].lower()
-                        if ext in ALLOWED_EXTENSIONS:
-                            existing_book = Book.query.filter_by(
-                                title=metadata.get('title'),
-                                author=metadata.get('author'),
-                                format=ext,
-                                user_id=user_id
-                            ).first()
-                            if existing_book:
-                                warning_count += 1
+                    stat = os.stat(path)
+                    candidates.append((path, stat.st_size, stat.st_mtime_ns))
+                except FileNotFoundError:
+                    pass
+        rel_paths = [os.path.relpath(path, folder.path).replace(os.sep, '/') for path in paths]
+        index = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 db.session.query(WatchedFile.path, WatchedFile.size, WatchedFile.mtime_ns)
+                 .filter(WatchedFile.folder_id == folder.id,
+                         or_(WatchedFile.path.in_(rel_paths),
+                             *[WatchedFile.path.startswith(p + '/', autoescape=True) for p in rel_paths]))}
+        settle_before = time.time_ns() - WATCH_EVENT_WAIT_SECONDS * 1_000_000_000
+    db.session.commit() # Khong giu transaction doc trong luc bam / nhap
+
+    seen = set()
+    ingested = 0
+    deferred = []
+    for path, size, mtime_ns in candidates:
+        rel_path = os.path.relpath(path, folder.path).replace(os.sep, '/')
+        seen.add(rel_path)
+        if index.get(rel_path) == (size, mtime_ns):
+            continue
+        if mtime_ns > settle_before:
+            deferred.append(path)
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            deferred.append(path)
+            continue
+        if ingest_watched_file(folder, path, size, mtime_ns) == 'ingested':
+            ingested += 1
+
+    gone = [rel_path for rel_path in index if rel_path not in seen]
+    for start in range(0, len(gone), 500):
+        WatchedFile.query.filter(WatchedFile.folder_id == folder.id, WatchedFile.path.in_(gone[start:start + 500])).delete(synchronize_session=False)
+    db.session.execute(db.update(WatchFolder).where(WatchFolder.id == folder.id).values(last_scan_at=datetime.utcnow()))
+    db.session.commit()
+    return ingested, deferred
+
+def watch_folders_loop():
+    """Vong lap cua thread theo doi thu muc (mot thread cho ca may, xem host_slot)."""
+    with host_slot('watch_folders', 1):
+        libc = _load_inotify()
+        watcher = None
+        watched = None # {folder_id: path} dang duoc inotify theo doi
+        last_full_scan = {}
+        pending = {} # folder_id -> {duong dan co su kien: thoi diem su kien cuoi}
+        while True:
+            with app.app_context():
+                try:
+                    folders = {folder.id: folder for folder in WatchFolder.query.filter_by(enabled=True)}
+                    current = {folder_id: folder.path for folder_id, folder in folders.items()}
+                    if libc is not None and current != watched:
+                        if watcher is not None:
+                            watcher.close()
+                        try:
+                            watcher = InotifyWatcher(libc)
+                            for folder_id, path in current.items():
+                                watcher.add_tree(folder_id, path)
+                        except OSError as e:
+                            print(f"Khong dung duoc inotify ({e}), chuyen sang quet dinh ky.")
+                            if watcher is not None:
+                                watcher.close()
+                            watcher = None
+                            libc = None
+                        watched = current
+                        pending = {}
+                        last_full_scan = {} # Bu cac thay doi khi chua theo doi
+
+                    poll_seconds = int(config.get('watch_poll_seconds') or 60)
+                    for folder_id, folder in folders.items():
+                        if not os.path.isdir(folder.path):
+                            continue
+                        full_scan_due = (folder.rescan_requested or folder_id not in last_full_scan
+                                         or len(pending.get(folder_id, ())) > WATCH_MAX_EVENT_PATHS
+                                         or (watcher is None and time.time() - last_full_scan[folder_id] >= poll_seconds))
+                        if full_scan_due:
+                            pending.pop(folder_id, None)
+                            _, deferred = scan_watch_folder(folder)
+                            folder.rescan_requested = False
+                            db.session.commit()
+                            last_full_scan[folder_id] = time.time()
+                        else:
+                            # Chi xet duong dan da yen WATCH_EVENT_WAIT_SECONDS, con lai doi vong sau
+                            quiet_before = time.time() - WATCH_EVENT_WAIT_SECONDS
+                            events = pending.get(folder_id, {})
+                            ready = [path for path, last_event in events.items() if last_event <= quiet_before]
+                            if not ready:
                                 continue
-                            
-                            source_book_path = os.path.join(root, file)
-                            safe_base = secure_filename(f"{metadata.get('author', 'Unknown')}_{metadata.get('title', 'Untitled')}_{datetime.now().timestamp()}")
-                            new_filename = f"{safe_base}.{ext}"
-                            dest_book_path = os.path.join(user_upload_folder, new_filename)
-                            shutil.copy2(source_book_path, dest_book_path)
-
-                            new_book_data = {
-                                'filename': new_filename, 'title': metadata.get('title'), 'author': metadata.get('author', 'Chưa rõ'),
-                                'format': ext, 'tags': metadata.get('tags'), 'description': metadata.get('description'),
-                                'series': metadata.get('series'), 'series_index': metadata.get('series_index', 1),
-                                'publisher': metadata.get('publisher'), 'pubdate': metadata.get('pubdate'),
-                                'language': metadata.get('language') or 'Tiếng Việt', 'user_id': user_id, 'rating': 0,
-                                'has_cover': False # Se cap nhat sau
-                            }
-                            new_book = Book(**{k: v for k, v in new_book_data.items() if v is not None})
-                            db.session.add(new_book)
-                            newly_added_books_with_covers.append((new_book, cover_source_path))
-
+                            for path in ready:
+                                del events[path]
+                            _, deferred = scan_watch_folder(folder, ready)
+                        if watcher is not None:
+                            # File dang duoc chep: xet lai khi yen (quet dinh ky se khong chay lai khi co inotify)
+                            pending.setdefault(folder_id, {}).update(dict.fromkeys(deferred, time.time()))
+
+                    if watcher is None:
+                        time.sleep(WATCH_EVENT_WAIT_SECONDS)
+                        continue
+                    for folder_id, path, mask in watcher.read_events(WATCH_EVENT_WAIT_SECONDS):
+                        if folder_id is None: # Tran hang doi su kien: quet lai toan bo
+                            last_full_scan = {}
+                            continue
+                        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                            watcher.add_tree(folder_id, path)
+                        elif mask & IN_CREATE:
+                            continue # File vua tao con rong / dang ghi: cho IN_CLOSE_WRITE
+                        pending.setdefault(folder_id, {})[path] = time.time()
                 except Exception as e:
-                    error_count += 1
-                    print(f"Lỗi khi xử lý sách từ Calibre import: {e} tại {root}")
-        
-        db.session.commit()
+                    db.session.rollback()
+                    print(f"Loi trong vong theo doi thu muc: {e}")
+                    time.sleep(WATCH_EVENT_WAIT_SECONDS)
+                finally:
+                    db.session.remove()
 
-        success_count = 0
-        for book, cover_src in newly_added_books_with_covers:
-            if cover_src and os.path.exists(cover_src):
-                final_cover_path = get_cover_path(book)
-                os.makedirs(os.path.dirname(final_cover_path), exist_ok=True)
-                with Image.open(cover_src) as img:
-                    if img.height > COVER_MAX_HEIGHT:
-                        ratio = COVER_MAX_HEIGHT / img.height
-                        new_width = int(img.width * ratio)
-                        img = img.resize((new_width, COVER_MAX_HEIGHT), Image.Resampling.LANCZOS)
-                    if img.mode in ("RGBA", "P"): img = img.convert("RGB")
-                    img.save(final_cover_path, 'jpeg', quality=80, optimize=True)
-                    book.has_cover = True
-            success_count += 1
+@app.route('/admin/watch_folders', methods=['POST'])
+@login_required
+def add_watch_folder():
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('index'))
+    path = os.path.abspath(os.path.normpath(request.form.get('path', '').strip() or '.'))
+    safe_root_norm = os.path.abspath(os.path.normpath(SAFE_BROWSING_ROOT))
+    if not path.startswith(safe_root_norm) or not os.path.isdir(path):
+        flash('Thư mục không hợp lệ hoặc nằm ngoài vùng được phép.', 'danger')
+        return redirect(url_for('settings'))
+    owner = db.session.get(User, request.form.get('user_id', type=int) or session.get('user_id'))
+    if owner is None or owner.username == GUEST_USERNAME:
+        flash('Người dùng không hợp lệ.', 'danger')
+        return redirect(url_for('settings'))
+    if WatchFolder.query.filter_by(path=path).first():
+        flash('Thư mục này đã được theo dõi.', 'warning')
+        return redirect(url_for('settings'))
+    db.session.add(WatchFolder(path=path, user_id=owner.id))
+    db.session.commit()
+    flash(f'Đã thêm thư mục theo dõi {path}. Sách mới sẽ được nhập tự động.', 'success')
+    return redirect(url_for('settings'))
+
+@app.route('/admin/watch_folders/<int:folder_id>/scan', methods=['POST'])
+@login_required
+def rescan_watch_folder(folder_id):
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('index'))
+    db.session.execute(db.update(WatchFolder).where(WatchFolder.id == folder_id).values(rescan_requested=True))
+    db.session.commit()
+    flash('Thư mục sẽ được quét lại trong giây lát.', 'info')
+    return redirect(url_for('settings'))
+
+@app.route('/admin/watch_folders/<int:folder_id>/delete', methods=['POST'])
+@login_required
+def delete_watch_folder(folder_id):
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('index'))
+    WatchedFile.query.filter_by(folder_id=folder_id).delete(synchronize_session=False)
+    WatchFolder.query.filter_by(id=folder_id).delete(synchronize_session=False)
+    db.session.commit()
+    flash('Đã ngừng theo dõi thư mục (sách đã nhập vẫn được giữ).', 'success')
+    return redirect(url_for('settings'))
+
+# --- TAO LAI ANH BIA HANG LOAT (COVER BACKFILL) ---
+# Tao lai anh bia cho ca thu vien (hoac mot phan) song song, thay vi doi cover() tao dan
+# tung cuon khi co nguoi xem. Duyet sach theo id tang dan tung lo; sau moi lo ghi checkpoint
+# (id lon nhat da xong) nen chay lai se tiep tuc tu do. Dung qua lenh
+# `flask --app app backfill-covers` hoac tac vu nen 'cover_backfill' (trang Cai dat).
+#   missing: sach chua co file anh bia      failed: sach co has_cover = False
+#   all: moi sach (trich xuat lai tu file sach, khong dung anh bia luu theo blob)
+# older_than: chi lay sach co file anh bia cu hon ngay nay (hoac chua co).
+COVER_BACKFILL_FILTERS = ('missing', 'failed', 'all')
+COVER_BACKFILL_BATCH_SIZE = 200
+COVER_BACKFILL_CHECKPOINT = os.path.join(DATA_ROOT, 'cover_backfill.json')
+
+def cover_backfill_query(filter_name, owner_id=None):
+    query = db.session.query(Book.id, Book.user_id)
+    if filter_name == 'failed':
+        query = query.filter(Book.has_cover.is_(False))
+    if owner_id:
+        query = query.filter(Book.user_id == owner_id)
+    return query
+
+def regenerate_cover(book_id, stale_before=None):
+    """
+    Tao lai anh bia mot cuon sach (chay trong thread cua pool, app context rieng).
+    Anh bia luu theo blob chi duoc dung lai neu moi hon stale_before. Tra ve ten bo dem ket qua.
+    """
+    with app.app_context():
+        try:
+            book = db.session.get(Book, book_id)
+            if book is None:
+                return 'missing_file'
+            if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id), book.filename)):
+                return 'missing_file'
+            blob = db.session.get(Blob, book.blob_sha256) if book.blob_sha256 else None
+            if blob is not None and blob.has_cover is not None:
+                cached_cover = blob_cover_path(blob.sha256)
+                fresh = (blob.has_cover and os.path.exists(cached_cover)
+                         and (stale_before is None or os.path.getmtime(cached_cover) >= stale_before))
+                if not fresh:
+                    blob.has_cover = None # Trich xuat lai tu file sach
+            return 'generated' if generate_and_save_cover(book) else 'no_cover'
+        except Exception as e:
+            print(f"Loi khi tao lai anh bia cho book ID {book_id}: {e}")
+            return 'failed'
+        finally:
+            db.session.remove()
+
+def backfill_covers(filter_name='missing', older_than=None, workers=0, dry_run=False, owner_id=None,
+                    stats=None, on_batch=None):
+    """
+    Tao lai anh bia cho cac sach khop bo loc. stats tu lan chay truoc (checkpoint) thi tiep tuc
+    sau stats['last_id'] va cong don. on_batch(stats) sau moi lo. dry_run chi dem, khong tao.
+    Tra ve stats: checked, selected, generated, no_cover, failed, missing_file, elapsed, last_id.
+    """
+    stats = dict(stats or {})
+    for name in ('last_id', 'checked', 'selected', 'generated', 'no_cover', 'failed', 'missing_file'):
+        stats.setdefault(name, 0)
+    stats.setdefault('elapsed', 0.0)
+    stats['total'] = stats['checked'] + cover_backfill_query(filter_name, owner_id).filter(Book.id > stats['last_id']).count()
+    if older_than is not None:
+        stale_before = older_than.timestamp()
+    else:
+        stale_before = time.time() if filter_name == 'all' else None
+    workers = workers or int(config.get('cover_backfill_workers') or 0) or os.cpu_count() or 1
+    base_elapsed = stats['elapsed']
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cover-backfill') as pool:
+        while True:
+            rows = (cover_backfill_query(filter_name, owner_id).filter(Book.id > stats['last_id'])
+                    .order_by(Book.id).limit(COVER_BACKFILL_BATCH_SIZE).all())
+            db.session.commit() # Ket thuc transaction doc, cac thread ghi tu do
+            if not rows:
+                break
+            selected = []
+            for book_id, user_id in rows:
+                cover_path = os.path.join(app.config['COVER_FOLDER'], str(user_id), f"{book_id}.jpg")
+                try:
+                    cover_mtime = os.path.getmtime(cover_path)
+                except OSError:
+                    cover_mtime = None
+                if filter_name == 'missing' and cover_mtime is not None:
+                    continue
+                if older_than is not None and cover_mtime is not None and cover_mtime >= stale_before:
+                    continue
+                selected.append(book_id)
+
+            stats['checked'] += len(rows)
+            stats['selected'] += len(selected)
+            if not dry_run:
+                for outcome in pool.map(lambda book_id: regenerate_cover(book_id, stale_before), selected):
+                    stats[outcome] += 1
+            stats['last_id'] = rows[-1][0]
+            stats['elapsed'] = round(base_elapsed + time.perf_counter() - started, 1)
+            if on_batch:
+                on_batch(stats)
+    return stats
+
+def cover_backfill_summary(stats, dry_run=False):
+    if dry_run:
+        return f"Thử: {stats['selected']}/{stats['checked']} sách cần tạo lại ảnh bìa."
+    processed = stats['generated'] + stats['no_cover'] + stats['failed'] + stats['missing_file']
+    rate = processed / stats['elapsed'] if stats['elapsed'] else 0
+    return (f"Đã xét {stats['checked']}/{stats['total']}, tạo {stats['generated']}, không có bìa {stats['no_cover']}, "
+            f"lỗi {stats['failed']}, thiếu file {stats['missing_file']} ({rate:.1f} sách/giây).")
+
+@job_handler('cover_backfill', 'Tạo lại ảnh bìa')
+def _cover_backfill_job(job_id, filter_name, older_than=None, workers=0, dry_run=False, owner_id=None):
+    # Tac vu bi ngat (khoi dong lai) thi ket qua tam la checkpoint de chay tiep
+    job = db.session.get(BackgroundJob, job_id)
+    previous = json.loads(job.result) if job.result and not dry_run else None
+    stats = backfill_covers(
+        filter_name, datetime.fromisoformat(older_than) if older_than else None, workers, dry_run, owner_id,
+        stats=previous,
+        on_batch=lambda stats: report_job_progress(
+            job_id, int(stats['checked'] * 100 / max(stats['total'], 1)),
+            cover_backfill_summary(stats, dry_run), force=True, details=stats)
+    )
+    stats['message'] = cover_backfill_summary(stats, dry_run)
+    return stats
+
+@app.cli.command('backfill-covers')
+@click.option('--filter', 'filter_name', type=click.Choice(COVER_BACKFILL_FILTERS), default='missing', show_default=True,
+              help='missing: chua co anh bia; failed: has_cover = False; all: moi sach.')
+@click.option('--older-than', type=click.DateTime(formats=['%Y-%m-%d']), help='Chi tao lai anh bia cu hon ngay nay.')
+@click.option('--workers', default=0, help='So sach xu ly dong thoi (0 = cover_backfill_workers trong config).')
+@click.option('--user-id', type=int, help='Chi xu ly sach cua nguoi dung nay.')
+@click.option('--dry-run', is_flag=True, help='Chi dem so sach can tao lai.')
+@click.option('--restart', is_flag=True, help='Bo qua checkpoint cua lan chay truoc.')
+def backfill_covers_command(filter_name, older_than, workers, user_id, dry_run, restart):
+    """Tao lai anh bia hang loat, song song, tiep tuc duoc neu bi ngat."""
+    options = {'filter': filter_name, 'older_than': older_than.isoformat() if older_than else None, 'user_id': user_id}
+    previous = None
+    if not restart and not dry_run and os.path.exists(COVER_BACKFILL_CHECKPOINT):
+        with open(COVER_BACKFILL_CHECKPOINT, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('options') == options:
+            previous = checkpoint['stats']
+            print(f"Tiep tuc tu sach ID {previous['last_id']} (dung --restart de chay lai tu dau).")
+
+    def on_batch(stats):
+        print(cover_backfill_summary(stats, dry_run))
+        if not dry_run:
+            with open(COVER_BACKFILL_CHECKPOINT, 'w', encoding='utf-8') as f:
+                json.dump({'options': options, 'stats': stats}, f)
+
+    stats = backfill_covers(filter_name, older_than, workers, dry_run, user_id, stats=previous, on_batch=on_batch)
+    if not dry_run and os.path.exists(COVER_BACKFILL_CHECKPOINT):
+        os.remove(COVER_BACKFILL_CHECKPOINT)
+    print("Hoan tat: " + cover_backfill_summary(stats, dry_run))
+
+@app.route('/admin/covers/backfill', methods=['POST'])
+@login_required
+def start_cover_backfill():
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('index'))
+    filter_name = request.form.get('filter', 'missing')
+    if filter_name not in COVER_BACKFILL_FILTERS:
+        flash('Bộ lọc không hợp lệ.', 'warning')
+        return redirect(url_for('settings'))
+    older_than = request.form.get('older_than') or None
+    if older_than:
+        try:
+            datetime.strptime(older_than, '%Y-%m-%d')
+        except ValueError:
+            flash('Ngày không hợp lệ.', 'warning')
+            return redirect(url_for('settings'))
+    params = {'filter_name': filter_name, 'older_than': older_than, 'dry_run': bool(request.form.get('dry_run'))}
+    job = enqueue_job('cover_backfill', params, session.get('user_id'), dedupe_key='cover_backfill')
+    return redirect(url_for('job_status', job_id=job.id))
+
+# --- KIEM TRA TINH TOAN VEN THU VIEN (FSCK) ---
+# Doi chieu bang book / blob voi books/, static/covers/ va blobs/ tren dia: liet ke thu
+# muc song song bang os.scandir (chi ten file, khong stat), nap cac dong CSDL mot lan roi
+# so sanh bang tap hop trong bo nho. Tuy chon bam lai noi dung de so voi blob_sha256.
+# Dung qua lenh `flask --app app fsck` hoac tac vu nen 'library_fsck' (trang Cai dat).
+FSCK_CHECKS = {
+    'missing_files': 'Sách không còn file',
+    'orphan_files': 'File sách không thuộc sách nào',
+    'orphan_covers': 'Ảnh bìa không thuộc sách nào',
+    'stale_has_cover': 'Cờ has_cover sai',
+    'dangling_rows': 'Dòng tham chiếu sách đã xóa',
+    'missing_blobs': 'Blob không còn file',
+    'orphan_blobs': 'File trong kho blob không có dòng blob',
+    'hash_mismatch': 'Nội dung file khác blob_sha256',
+}
+FSCK_REPAIRS = {
+    'delete_missing': 'Xóa sách không còn file',
+    'move_orphan_files': 'Chuyển file mồ côi vào lost+found',
+    'delete_orphan_covers': 'Xóa ảnh bìa mồ côi',
+    'fix_has_cover': 'Sửa cờ has_cover',
+    'delete_dangling_rows': 'Xóa dòng tham chiếu sách đã xóa',
+    'delete_orphan_blobs': 'Xóa file mồ côi trong kho blob',
+}
+FSCK_SAMPLE_SIZE = 50 # So muc moi loai luu trong ket qua tac vu (bao cao day du: lenh fsck --output)
+LOST_FOUND_FOLDER = os.path.join(DATA_ROOT, 'lost+found')
+# Bang tham chieu sach: xoa sach thi phai xoa cac dong nay truoc
+BOOK_REFERENCE_TABLES = (book_list_association, book_tag, ReadingHistory.__table__, BookMark.__table__, Favorite.__table__)
+
+def scandir_names(folder, dirs=False):
+    """Ten cac file (hoac thu muc con) truc tiep trong folder; rong neu folder khong ton tai."""
+    try:
+        with os.scandir(folder) as entries:
+            return [entry.name for entry in entries
+                    if (entry.is_dir(follow_symlinks=False) if dirs else entry.is_file(follow_symlinks=False))]
+    except FileNotFoundError:
+        return []
+
+def hash_file(path):
+    """SHA-256 doc thang tu dia (khong qua bo nho dem cua file_sha256)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def delete_book_rows(book_ids):
+    """Xoa cac Book (va dong tham chieu toi chung) bang DELETE theo tap, theo lo 500 id. Khong commit."""
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), 500):
+        chunk = book_ids[start:start + 500]
+        for table in BOOK_REFERENCE_TABLES:
+            db.session.execute(db.delete(table).where(table.c.book_id.in_(chunk)))
+        db.session.execute(db.delete(Book).where(Book.id.in_(chunk)))
+
+def recently_modified(path):
+    """File vua duoc ghi hoac vua duoc hard link (vd. dang tai len, chua kip co dong Book) thi khong coi la mo coi."""
+    try:
+        st = os.stat(path)
+        # ctime doi ca khi tao hard link moi toi inode, con mtime thi khong
+        return time.time() - max(st.st_mtime, st.st_ctime) < BLOB_GC_GRACE_SECONDS
+    except OSError:
+        return True
+
+def check_library(verify_hashes=False, workers=0, on_progress=None):
+    """
+    Kiem tra CSDL / file sach / anh bia / kho blob. Tra ve bao cao {loai: [muc, ...]} voi cac
+    loai trong FSCK_CHECKS; on_progress(thong diep) giua cac buoc.
+    """
+    workers = workers or min(32, (os.cpu_count() or 1) * 4) # Chu yeu cho I/O
+    report = {name: [] for name in FSCK_CHECKS}
+    books = db.session.query(Book.id, Book.user_id, Book.filename, Book.has_cover, Book.blob_sha256).all()
+    blob_exts = dict(db.session.query(Blob.sha256, Blob.ext))
+    book_ids = {book_id for book_id, *_ in books}
+    for table in BOOK_REFERENCE_TABLES:
+        for row_book_id, count in db.session.query(table.c.book_id, func.count()).group_by(table.c.book_id):
+            if row_book_id not in book_ids:
+                report['dangling_rows'].append({'table': table.name, 'book_id': row_book_id, 'count': count})
+    db.session.commit()
+    if on_progress:
+        on_progress(f"Đã nạp {len(books)} sách, đang quét thư mục...")
+
+    user_dirs = ({str(user_id) for _, user_id, *_ in books}
+                 | set(scandir_names(app.config['UPLOAD_FOLDER'], dirs=True))
+                 | set(scandir_names(app.config['COVER_FOLDER'], dirs=True)))
+    blob_dirs = [name for name in scandir_names(BLOB_FOLDER, dirs=True) if len(name) == 2]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fsck') as pool:
+        book_files = dict(zip(user_dirs, pool.map(
+            lambda name: set(scandir_names(os.path.join(app.config['UPLOAD_FOLDER'], name))), user_dirs)))
+        cover_files = dict(zip(user_dirs, pool.map(
+            lambda name: set(scandir_names(os.path.join(app.config['COVER_FOLDER'], name))), user_dirs)))
+        blob_files = {}
+        for name, files in zip(blob_dirs, pool.map(lambda name: scandir_names(os.path.join(BLOB_FOLDER, name)), blob_dirs)):
+            blob_files.update((filename, name) for filename in files)
+
+        referenced_files = {}
+        expected_covers = {}
+        to_verify = []
+        for book_id, user_id, filename, has_cover, blob_sha256 in books:
+            user_dir = str(user_id)
+            referenced_files.setdefault(user_dir, set()).add(filename)
+            expected_covers.setdefault(user_dir, set()).add(f"{book_id}.jpg")
+            path = os.path.join(user_dir, filename)
+            if filename not in book_files.get(user_dir, ()):
+                report['missing_files'].append({'book_id': book_id, 'user_id': user_id, 'path': path})
+            elif verify_hashes and blob_sha256:
+                to_verify.append((book_id, path, blob_sha256))
+            cover_exists = f"{book_id}.jpg" in cover_files.get(user_dir, ())
+            if bool(has_cover) != cover_exists:
+                report['stale_has_cover'].append({'book_id': book_id, 'has_cover': bool(has_cover), 'cover_file': cover_exists})
+
+        for user_dir, files in book_files.items():
+            for filename in sorted(files - referenced_files.get(user_dir, set())):
+                if not recently_modified(os.path.join(app.config['UPLOAD_FOLDER'], user_dir, filename)):
+                    report['orphan_files'].append({'path': os.path.join(user_dir, filename)})
+        for user_dir, files in cover_files.items():
+            for filename in sorted(files - expected_covers.get(user_dir, set())):
+                # Sach tao trong luc quet (sau khi nap danh sach sach) da co anh bia nhung chua co trong expected_covers
+                if not recently_modified(os.path.join(app.config['COVER_FOLDER'], user_dir, filename)):
+                    report['orphan_covers'].append({'path': os.path.join(user_dir, filename)})
+
+        expected_blobs = {}
+        for sha256, ext in blob_exts.items():
+            expected_blobs[f"{sha256}.{ext}"] = sha256
+            expected_blobs[f"{sha256}.cover.jpg"] = sha256
+            if f"{sha256}.{ext}" not in blob_files:
+                report['missing_blobs'].append({'sha256': sha256})
+        for filename, subdir in sorted(blob_files.items()):
+            if filename not in expected_blobs and not recently_modified(os.path.join(BLOB_FOLDER, subdir, filename)):
+                report['orphan_blobs'].append({'path': os.path.join(subdir, filename)})
+
+        if to_verify:
+            def verify(item):
+                book_id, path, expected = item
+                try:
+                    actual = hash_file(os.path.join(app.config['UPLOAD_FOLDER'], path))
+                except OSError as e:
+                    actual = f"error: {e}"
+                return None if actual == expected else {'book_id': book_id, 'path': path, 'expected': expected, 'actual': actual}
+            for done, mismatch in enumerate(pool.map(verify, to_verify), 1):
+                if mismatch:
+                    report['hash_mismatch'].append(mismatch)
+                if on_progress and done % 1000 == 0:
+                    on_progress(f"Đã băm {done}/{len(to_verify)} file...")
+    return report
+
+def repair_library(report, repairs):
+    """Ap dung cac sua chua da chon (ten trong FSCK_REPAIRS) theo bao cao cua check_library. Tra ve so muc da sua."""
+    repaired = {name: 0 for name in repairs}
+    if 'delete_missing' in repairs and report['missing_files']:
+        book_ids = [item['book_id'] for item in report['missing_files']]
+        for item in report['missing_files']:
+            try:
+                os.remove(os.path.join(app.config['COVER_FOLDER'], str(item['user_id']), f"{item['book_id']}.jpg"))
+            except OSError:
+                pass
+        delete_book_rows(book_ids)
+        db.session.commit()
+        collect_unused_blobs()
+        repaired['delete_missing'] = len(book_ids)
+    if 'move_orphan_files' in repairs:
+        for item in report['orphan_files']:
+            dest = os.path.join(LOST_FOUND_FOLDER, item['path'])
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(os.path.join(app.config['UPLOAD_FOLDER'], item['path']), dest)
+                repaired['move_orphan_files'] += 1
+            except OSError as e:
+                print(f"Khong chuyen duoc {item['path']}: {e}")
+    if 'delete_orphan_covers' in repairs:
+        for item in report['orphan_covers']:
+            try:
+                os.remove(os.path.join(app.config['COVER_FOLDER'], item['path']))
+                repaired['delete_orphan_covers'] += 1
+            except OSError:
+                pass
+    if 'fix_has_cover' in repairs and report['stale_has_cover']:
+        for value in (True, False):
+            book_ids = [item['book_id'] for item in report['stale_has_cover'] if item['cover_file'] == value]
+            for start in range(0, len(book_ids), 500):
+                db.session.execute(db.update(Book).where(Book.id.in_(book_ids[start:start + 500])).values(has_cover=value))
         db.session.commit()
+        repaired['fix_has_cover'] = len(report['stale_has_cover'])
+    if 'delete_dangling_rows' in repairs and report['dangling_rows']:
+        tables = {table.name: table for table in BOOK_REFERENCE_TABLES}
+        for item in report['dangling_rows']:
+            table = tables[item['table']]
+            db.session.execute(db.delete(table).where(table.c.book_id == item['book_id']))
+            repaired['delete_dangling_rows'] += item['count']
+        db.session.commit()
+    if 'delete_orphan_blobs' in repairs:
+        for item in report['orphan_blobs']:
+            try:
+                os.remove(os.path.join(BLOB_FOLDER, item['path']))
+                repaired['delete_orphan_blobs'] += 1
+            except OSError:
+                pass
+    return repaired
+
+def fsck_summary(report, repaired=None):
+    found = ', '.join(f"{FSCK_CHECKS[name].lower()}: {len(items)}" for name, items in report.items() if items)
+    text = f"Phát hiện {found}." if found else "Không phát hiện vấn đề nào."
+    if repaired:
+        text += " Kết quả sửa chữa: " + ', '.join(f"{FSCK_REPAIRS[name].lower()}: {count}" for name, count in repaired.items()) + "."
+    return text
 
-    except zipfile.BadZipFile:
-        flash('File zip không hợp lệ hoặc bị hỏng.', 'danger')
-    except Exception as e:
-        db.session.rollback()
-        flash(f'Đã xảy ra lỗi không mong muốn: {e}', 'danger')
+@job_handler('library_fsck', 'Kiểm tra thư viện')
+def _library_fsck_job(job_id, verify_hashes=False, repairs=()):
+    started = time.perf_counter()
+    report = check_library(verify_hashes, on_progress=lambda message: report_job_progress(job_id, None, message, force=True))
+    repaired = repair_library(report, repairs) if repairs else None
+    return {
+        'counts': {name: len(items) for name, items in report.items()},
+        'samples': {name: items[:FSCK_SAMPLE_SIZE] for name, items in report.items() if items},
+        'repaired': repaired,
+        'elapsed': round(time.perf_counter() - started, 1),
+        'message': fsck_summary(report, repaired),
+    }
+
+@app.cli.command('fsck')
+@click.option('--verify-hashes', is_flag=True, help='Bam lai moi file sach de so voi blob_sha256 (cham, doc toan bo du lieu).')
+@click.option('--workers', default=0, help='So thread quet / bam song song (0 = tu dong).')
+@click.option('--repair', 'repairs', multiple=True, type=click.Choice(list(FSCK_REPAIRS)), help='Sua chua can ap dung (lap lai duoc).')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help='Ghi bao cao day du ra file JSON.')
+def fsck_command(verify_hashes, workers, repairs, output):
+    """Kiem tra (va tuy chon sua) su lech nhau giua CSDL, file sach, anh bia va kho blob."""
+    started = time.perf_counter()
+    report = check_library(verify_hashes, workers, on_progress=print)
+    for name, items in report.items():
+        print(f"{name}: {len(items)}")
+        for item in items[:10]:
+            print(f"    {item}")
+    repaired = repair_library(report, repairs) if repairs else None
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'report': report, 'repaired': repaired}, f, ensure_ascii=False, indent=1)
+    print(f"Hoan tat trong {time.perf_counter() - started:.1f} giay. {fsck_summary(report, repaired)}")
+
+@app.route('/admin/fsck', methods=['POST'])
+@login_required
+def start_library_fsck():
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
+        return redirect(url_for('index'))
+    repairs = [name for name in request.form.getlist('repairs') if name in FSCK_REPAIRS]
+    params = {'verify_hashes': bool(request.form.get('verify_hashes')), 'repairs': repairs}
+    job = enqueue_job('library_fsck', params, session.get('user_id'), dedupe_key='library_fsck')
+    return redirect(url_for('job_status', job_id=job.id))
+
+def convert_file_in_job(job_id, source_path, target_format, dest_path):
+    """Chuyen doi ra thu muc tam roi moi doi ten sang dest_path, de ban huy/loi khong de lai file do dang."""
+    os.makedirs(JOB_TMP_FOLDER, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f"convert_{job_id}_", dir=JOB_TMP_FOLDER)
+    try:
+        temp_output = os.path.join(work_dir, f"output.{target_format}")
+        report_job_progress(job_id, 0, 'Đang chuyển đổi...', force=True)
+        run_calibre_tool_with_progress(
+            ["ebook-convert", source_path, temp_output],
+            on_progress=lambda pct, msg: report_job_progress(job_id, pct, msg),
+            timeout=config.get('convert_timeout') or None
+        )
+        report_job_progress(job_id, 100, 'Đang lưu kết quả...', force=True)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(temp_output, dest_path)
     finally:
-        shutil.rmtree(temp_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-    flash_messages = []
-    if success_count > 0: flash_messages.append(f"Nhập thành công {success_count} đầu sách.")
-    if warning_count > 0: flash_messages.append(f"{warning_count} định dạng sách đã tồn tại và được bỏ qua.")
-    if error_count > 0: flash_messages.append(f"Gặp lỗi khi xử lý {error_count} mục.")
-    
-    if flash_messages:
-        flash(' '.join(flash_messages), 'success' if success_count > 0 and error_count == 0 else 'warning')
-    else:
-        flash("Không tìm thấy sách hợp lệ nào trong file zip.", "info")
+@job_handler('convert', 'Chuyển đổi sách', concurrency_setting='convert_concurrency')
+def _convert_job(job_id, book_id, target_format):
+    book = db.session.get(Book, book_id)
+    if not book:
+        raise ValueError('Sách gốc không còn tồn tại.')
 
-    return redirect(url_for('index'))
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id))
+    source_path = os.path.join(user_folder, book.filename)
+    base_name = os.path.splitext(book.filename)[0]
+    output_filename = f"{base_name}.{target_format}"
+    counter = 1
+    while os.path.exists(os.path.join(user_folder, output_filename)):
+        output_filename = f"{base_name}_{counter}.{target_format}"
+        counter += 1
+
+    convert_file_in_job(job_id, source_path, target_format, os.path.join(user_folder, output_filename))
+
+    new_book = Book(
+        filename=output_filename, title=book.title, author=book.author,
+        format=target_format, tags=book.tags, description=book.description,
+        rating=book.rating, series=book.series, series_index=book.series_index,
+        user_id=book.user_id
+    )
+    db.session.add(new_book)
+    db.session.commit()
+
+    # Tao anh bia cho dinh dang moi
+    generate_and_save_cover(new_book)
+    return {'book_id': new_book.id}
+
+@job_handler('convert_download', 'Chuẩn bị bản tải về', concurrency_setting='convert_concurrency',
+             result_url=lambda result: url_for('read', book_id=result['book_id'], format=result['format']),
+             auto_open=True)
+def _convert_download_job(job_id, book_id, target_format):
+    book = db.session.get(Book, book_id)
+    if not book:
+        raise ValueError('Sách gốc không còn tồn tại.')
+    source_path = os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id), book.filename)
+    cache_path = conversion_cache_path(file_sha256(source_path), target_format)
+    if not os.path.exists(cache_path):
+        convert_file_in_job(job_id, source_path, target_format, cache_path)
+        prune_conversion_cache(keep=cache_path)
+    return {'book_id': book_id, 'format': target_format}
 
 @app.route('/convert_page/<int:book_id>', methods=['GET'])
 @login_required
@@ -2742,7 +6686,7 @@ def convert_page(book_id):
     if not book:
         flash('Bạn không có quyền thực hiện thao tác này.', 'danger')
         return redirect(url_for('index'))
-    content = render_template_string(CONVERT_PAGE_TEMPLATE, book=book)
+    content = render_template_string(CONVERT_PAGE_TEMPLATE, book=book, convert_formats=CONVERT_TARGET_FORMATS)
     return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
 
 @app.route('/convert/<int:book_id>', methods=['POST'])
@@ -2754,34 +6698,148 @@ def convert_book(book_id):
         return redirect(url_for('index'))
 
     target_format = request.form.get('target_format')
-    if not target_format:
+    if target_format not in CONVERT_TARGET_FORMATS or target_format == book.format:
         flash('Định dạng chuyển đổi không hợp lệ.', 'warning')
         return redirect(url_for('book_detail', book_id=book.id))
 
-    user_folder = os.path.join(app.config['UPLOAD_FOLDER'], str(book.user_id))
-    source_path = os.path.join(user_folder, book.filename)
-    output_filename = f"{os.path.splitext(book.filename)[0]}.{target_format}"
-    output_path = os.path.join(user_folder, output_filename)
+    # Bam lai nut / F5 khi tac vu cu chua xong se dua ve dung tac vu do, khong chay lan hai
+    job = enqueue_job('convert', {'book_id': book.id, 'target_format': target_format},
+                      user_id=session.get('user_id'), dedupe_key=f"convert:{book.id}:{target_format}")
+    return redirect(url_for('job_status', job_id=job.id))
 
-    try:
-        subprocess.run(["ebook-convert", source_path, output_path], check=True, capture_output=True)
-        new_book = Book(
-            filename=output_filename, title=book.title, author=book.author,
-            format=target_format, tags=book.tags, description=book.description,
-            rating=book.rating, series=book.series, series_index=book.series_index,
-            user_id=book.user_id
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    job = check_job_permission(job_id)
+    if not job:
+        flash('Bạn không có quyền xem tác vụ này.', 'danger')
+        return redirect(url_for('index'))
+    params = json.loads(job.params or '{}')
+    book = db.session.get(Book, params['book_id']) if params.get('book_id') else None
+    content = render_template_string(JOB_STATUS_TEMPLATE, job=job, info=job_to_dict(job), book=book)
+    return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def job_status_api(job_id):
+    job = check_job_permission(job_id)
+    if not job:
+        return jsonify(success=False, error="Không có quyền truy cập"), 403
+    return jsonify(job_to_dict(job))
+
+@app.route('/api/jobs/<int:job_id>/events')
+@login_required
+def job_events(job_id):
+    """Server-Sent Events: gui trang thai tac vu (nhu /api/jobs/<id>) moi khi thay doi, dong khi tac vu ket thuc."""
+    job = check_job_permission(job_id)
+    if not job:
+        return jsonify(success=False, error="Không có quyền truy cập"), 403
+
+    def generate():
+        last_payload = None
+        last_sent = time.time()
+        while True:
+            db.session.expire_all()
+            job = db.session.get(BackgroundJob, job_id)
+            db.session.rollback() # Khong giu transaction doc (va snapshot SQLite) giua cac lan hoi
+            if job is None:
+                return
+            payload = json.dumps(job_to_dict(job), ensure_ascii=False)
+            if payload != last_payload:
+                yield f"event: progress\ndata: {payload}\n\n"
+                last_payload = payload
+                last_sent = time.time()
+            elif time.time() - last_sent >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.time()
+            if job.status not in ACTIVE_JOB_STATUSES:
+                yield "event: end\ndata: {}\n\n"
+                return
+            time.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    job = check_job_permission(job_id)
+    if not job:
+        flash('Hành động không được phép.', 'danger')
+        return redirect(url_for('index'))
+    # Tac vu chua chay thi huy ngay; dang chay thi dat co de handler tu dung (va giet ebook-convert)
+    cancelled = db.session.execute(
+        db.update(BackgroundJob)
+        .where(BackgroundJob.id == job.id, BackgroundJob.status == 'queued')
+        .values(status='cancelled', message='Đã hủy theo yêu cầu.', finished_at=datetime.utcnow())
+    ).rowcount
+    if not cancelled:
+        db.session.execute(
+            db.update(BackgroundJob)
+            .where(BackgroundJob.id == job.id, BackgroundJob.status == 'running')
+            .values(cancel_requested=True)
         )
-        db.session.add(new_book)
-        db.session.commit()
+    db.session.commit()
+    if request.accept_mimetypes.best == 'application/json':
+        db.session.refresh(job)
+        return jsonify(job_to_dict(job))
+    flash('Đã gửi yêu cầu hủy tác vụ.', 'info')
+    return redirect(url_for('job_status', job_id=job.id))
 
-        # Tao anh bia cho dinh dang moi
-        generate_and_save_cover(new_book)
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+def retry_job(job_id):
+    """Chay lai tac vu loi voi cung id (handler bo qua phan da xong nho checkpoint cua tac vu)."""
+    job = check_job_permission(job_id)
+    if not job:
+        flash('Hành động không được phép.', 'danger')
+        return redirect(url_for('index'))
+    requeued = 0
+    if JOB_HANDLERS.get(job.kind, {}).get('retryable'):
+        try:
+            requeued = db.session.execute(
+                db.update(BackgroundJob)
+                .where(BackgroundJob.id == job.id, BackgroundJob.status == 'failed')
+                .values(status='queued', message='Đang chờ chạy lại...', cancel_requested=False,
+                        worker=None, finished_at=None, heartbeat_at=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+        except IntegrityError:
+            # Da co tac vu cung dedupe_key dang cho / chay
+            db.session.rollback()
+    if requeued:
+        db.session.refresh(job)
+        submit_job(job)
+        flash('Đã chạy lại tác vụ.', 'info')
+    else:
+        flash('Không thể chạy lại tác vụ này.', 'warning')
+    if request.accept_mimetypes.best == 'application/json':
+        db.session.refresh(job)
+        return jsonify(job_to_dict(job)), 200 if requeued else 409
+    return redirect(url_for('job_status', job_id=job.id))
 
-        flash(f'Chuyển đổi sách thành công sang {target_format.upper()}!', 'success')
-    except Exception as e:
-        flash(f'Lỗi khi chuyển đổi sách: {e}', 'danger')
-    
-    return redirect(url_for('book_detail', book_id=book.id))
+@app.route('/jobs/<int:job_id>/discard', methods=['POST'])
+@login_required
+def discard_job(job_id):
+    """Bo tac vu loi (khong chay lai): chuyen sang 'cancelled' va don file tam cua no."""
+    job = check_job_permission(job_id)
+    if not job:
+        flash('Hành động không được phép.', 'danger')
+        return redirect(url_for('index'))
+    discarded = db.session.execute(
+        db.update(BackgroundJob)
+        .where(BackgroundJob.id == job.id, BackgroundJob.status == 'failed')
+        .values(status='cancelled', message='Đã bỏ tác vụ lỗi.')
+    ).rowcount
+    db.session.commit()
+    on_discard = JOB_HANDLERS.get(job.kind, {}).get('on_discard')
+    if discarded and on_discard:
+        on_discard(json.loads(job.params or '{}'))
+    if request.accept_mimetypes.best == 'application/json':
+        db.session.refresh(job)
+        return jsonify(job_to_dict(job))
+    flash('Đã bỏ tác vụ.' if discarded else 'Tác vụ không ở trạng thái lỗi.', 'info' if discarded else 'warning')
+    return redirect(url_for('job_status', job_id=job.id))
 
 @app.route('/list_manager/<int:book_id>', methods=['GET', 'POST'])
 @login_required
@@ -2792,47 +6850,23 @@ def list_manager_page(book_id):
         return redirect(url_for('index'))
 
     user_id = session.get('user_id')
-    
-    if request.method == 'POST':
-        selected_list_ids = request.form.getlist('list_ids')
-        
-        all_formats = Book.query.filter_by(title=book_rep.title, author=book_rep.author, user_id=user_id).all()
-        all_format_ids = {b.id for b in all_formats}
-        all_user_lists = BookList.query.filter_by(user_id=user_id).all()
+    format_ids = selected_work_ids([book_rep.id])
+    user_list_ids = db.select(BookList.id).where(BookList.user_id == user_id)
 
-        for book_list in all_user_lists:
-            # Check if this list was selected in the form
-            is_selected = str(book_list.id) in selected_list_ids
-            
-            # Get all books of the same title/author already in this list
-            current_books_in_list = {b.id for b in book_list.books if b.id in all_format_ids}
-            
-            if is_selected:
-                # Add all formats to the list if they aren't already there
-                for book_format in all_formats:
-                    if book_format.id not in current_books_in_list:
-                        book_list.books.append(book_format)
-            else:
-                # Remove all formats from the list
-                for book_format_id in current_books_in_list:
-                    book_to_remove = Book.query.get(book_format_id)
-                    if book_to_remove:
-                        book_list.books.remove(book_to_remove)
-                        
+    if request.method == 'POST':
+        selected_list_ids = [int(list_id) for list_id in request.form.getlist('list_ids') if list_id.isdigit()]
+        add_to_shelves(user_list_ids.where(BookList.id.in_(selected_list_ids)), format_ids)
+        remove_from_shelves(user_list_ids.where(BookList.id.not_in(selected_list_ids)), format_ids)
         db.session.commit()
         flash("Đã cập nhật kệ sách.", 'success')
         return redirect(url_for('book_detail', book_id=book_id))
 
-    # GET request logic
     all_user_lists = BookList.query.filter_by(user_id=user_id).order_by(BookList.name).all()
-    all_format_ids = {b.id for b in Book.query.filter_by(title=book_rep.title, author=book_rep.author, user_id=user_id).all()}
-    
-    book_list_ids_with_book = {
-        row.book_list_id for row in db.session.query(book_list_association.c.book_list_id)
-        .filter(book_list_association.c.book_id.in_(all_format_ids))
-        .distinct()
-    }
-    
+    book_list_ids_with_book = set(db.session.scalars(
+        db.select(book_list_association.c.book_list_id).distinct()
+        .where(book_list_association.c.book_id.in_(format_ids))
+    ))
+
     content = render_template_string(LIST_MANAGER_PAGE_TEMPLATE, book=book_rep, all_user_lists=all_user_lists, book_list_ids=book_list_ids_with_book)
     return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
 
@@ -2860,15 +6894,36 @@ def create_list_and_add_book(book_id):
         db.session.add(new_list)
         flash(f"Đã tạo kệ sách '{list_name}'.", 'success')
 
-    all_formats = Book.query.filter_by(title=book_rep.title, author=book_rep.author, user_id=user_id).all()
-    for book in all_formats:
-        if book not in new_list.books:
-            new_list.books.append(book)
-    
+    db.session.flush()
+    add_to_shelves([new_list.id], selected_work_ids([book_rep.id]))
     db.session.commit()
     flash(f"Đã thêm sách vào kệ '{list_name}'.", 'success')
     return redirect(url_for('list_manager_page', book_id=book_id))
 
+@app.route('/lists/<int:list_id>/toggle/<int:book_id>', methods=['POST'])
+@login_required
+def toggle_list_book(list_id, book_id):
+    """Them / bo moi dinh dang cua sach khoi mot ke: {"member": true|false}, bo trong thi dao trang thai."""
+    book_list = BookList.query.filter_by(id=list_id, user_id=session.get('user_id')).first()
+    if book_list is None:
+        return jsonify(success=False, message="Không tìm thấy kệ sách."), 404
+    book_rep = check_book_permission(book_id)
+    if not book_rep:
+        return jsonify(success=False, message="Không có quyền truy cập sách này."), 403
+
+    format_ids = selected_work_ids([book_rep.id])
+    member = (request.get_json(silent=True) or {}).get('member')
+    if member is None:
+        member = not db.session.scalar(db.select(db.select(book_list_association).where(
+            book_list_association.c.book_list_id == list_id, book_list_association.c.book_id.in_(format_ids)).exists()))
+    if member:
+        add_to_shelves([list_id], format_ids)
+    else:
+        remove_from_shelves([list_id], format_ids)
+    db.session.commit()
+    return jsonify(success=True, member=bool(member), list_id=list_id,
+                   message=f"Đã thêm vào kệ '{book_list.name}'." if member else f"Đã bỏ khỏi kệ '{book_list.name}'.")
+
 
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
@@ -2904,9 +6959,47 @@ def settings():
 
         return redirect(url_for('settings'))
 
-    content = render_template_string(SETTINGS_TEMPLATE, safe_root=SAFE_BROWSING_ROOT.replace('\\', '/'))
+    watch_stats = {
+        (folder_id, status): count for folder_id, status, count in
+        db.session.query(WatchedFile.folder_id, WatchedFile.status, func.count()).group_by(WatchedFile.folder_id, WatchedFile.status)
+    }
+    content = render_template_string(SETTINGS_TEMPLATE, file_browser=render_file_browser(), fsck_repairs=FSCK_REPAIRS,
+                                     watch_folders=WatchFolder.query.options(db.joinedload(WatchFolder.user)).order_by(WatchFolder.path).all(), watch_stats=watch_stats)
     return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
 
+@app.route('/admin/slow_queries')
+@login_required
+def slow_queries():
+    if not session.get('is_admin'):
+        flash('Bạn không có quyền truy cập trang này.', 'danger')
+        return redirect(url_for('index'))
+    report = read_slow_query_report()
+    content = render_template_string(SLOW_QUERY_TEMPLATE, report=report, threshold=config.get('slow_query_ms') or 0)
+    return render_template_string(LAYOUT_TEMPLATE, content=content, query='')
+
+@app.route('/admin/slow_queries/clear', methods=['POST'])
+@login_required
+def clear_slow_queries():
+    if not session.get('is_admin'):
+        flash('Hành động không được phép.', 'danger')
+        return redirect(url_for('index'))
+    for suffix in ['', '.1', '.2', '.3']:
+        log_file = SLOW_QUERY_LOG_FILE + suffix
+        if os.path.exists(log_file):
+            # Cat ngan thay vi xoa de handler dang mo van ghi tiep duoc
+            open(log_file, 'w').close()
+    flash('Đã xóa nhật ký truy vấn chậm.', 'success')
+    return redirect(url_for('slow_queries'))
+
+@app.route('/metrics')
+def metrics():
+    # Mac dinh khong cong khai: ten endpoint, luu luong, so byte tai len / nhap chi danh cho quan tri
+    token = config.get('metrics_token')
+    bearer_ok = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not bearer_ok and not session.get('is_admin'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/browse')
 @login_required
 def browse_fs():
@@ -2930,6 +7023,566 @@ def browse_fs():
     except OSError as e:
         return jsonify(success=False, error=f"Không thể đọc thư mục: {e}"), 500
 
+# --- API JSON /api/v1 ---
+# Cho ung dung di dong / script: cung quyen nhu giao dien web (check_book_permission,
+# GuestPermission), dang nhap bang cookie phien hoac HTTP Basic. Danh sach phan trang theo
+# khoa (?cursor=<next_cursor>&limit=), ?fields=a,b chi doc cac cot can thiet, moi phan hoi
+# GET co ETag de client gui If-None-Match va nhan 304 khi khong doi.
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+API_BOOK_FIELDS = ('id', 'title', 'author', 'format', 'tags', 'description', 'rating', 'series', 'series_index',
+                   'publisher', 'pubdate', 'language', 'date_added', 'user_id', 'has_cover')
+API_DEFAULT_BOOK_FIELDS = tuple(name for name in API_BOOK_FIELDS if name != 'description')
+API_GUEST_PERMISSIONS = {'favorites': 'can_favorite', 'bookmarks': 'can_bookmark'}
+
+def api_error(status, message):
+    response = jsonify(success=False, error=message)
+    response.status_code = status
+    return response
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not session.get('logged_in') and not login_from_basic_auth():
+            response = api_error(401, "Cần đăng nhập.")
+            response.headers['WWW-Authenticate'] = 'Basic realm="thuvien"'
+            return response
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_response(data, status=200):
+    """JSON gon (khong thut dong) kem ETag; tra 304 neu khop If-None-Match."""
+    response = Response(json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str),
+                        status=status, mimetype='application/json')
+    if request.method == 'GET' and status == 200:
+        response.add_etag()
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+    return response
+
+def api_fields():
+    """Cac cot Book duoc yeu cau qua ?fields=; luon kem id (dung lam con tro)."""
+    requested = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()]
+    if not requested:
+        return API_DEFAULT_BOOK_FIELDS
+    unknown = [name for name in requested if name not in API_BOOK_FIELDS]
+    if unknown:
+        raise ValueError(f"Trường không hợp lệ: {', '.join(unknown)}")
+    return ('id',) + tuple(name for name in requested if name != 'id')
+
+def api_page_args():
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = max(1, min(request.args.get('limit', API_PAGE_SIZE, type=int), API_MAX_PAGE_SIZE))
+    return cursor, limit
+
+def api_book_row(row, fields):
+    item = dict(zip(fields, row))
+    if isinstance(item.get('date_added'), datetime):
+        item['date_added'] = item['date_added'].isoformat()
+    item['links'] = {
+        'self': url_for('api_book', book_id=item['id']),
+        'download': url_for('read', book_id=item['id']),
+        'cover': url_for('cover', book_id=item['id']),
+    }
+    return item
+
+def api_visible_books():
+    """Dieu kien WHERE giong index(): quan tri vien thay moi sach, nguoi khac chi sach cua minh."""
+    return db.true() if current_auth('is_admin') else Book.user_id == current_auth('user_id')
+
+def visible_works(*columns, conditions=()):
+    """
+    SELECT columns tren dong dai dien cua moi sach (tua + tac gia): dinh dang co id nho nhat
+    trong cac dong thoa conditions, kem cot formats = 'id:dinh dang,...'. Khong GROUP BY nen
+    phan trang bang WHERE tren Book.id (hoac cot co index) chi doc dung so dong cua trang;
+    moi dong chi ton them mot lan tim theo ix_book_user_title_author_format.
+    """
+    conditions = [api_visible_books(), *conditions]
+    other = Book.__table__.alias('other_format')
+    other_conditions = [ClauseAdapter(other).traverse(condition) for condition in conditions]
+    same_work = and_(other.c.user_id == Book.user_id, other.c.title == Book.title, other.c.author.is_(Book.author))
+    formats = (db.select(func.group_concat(other.c.id.concat(':').concat(other.c.format)))
+               .where(same_work, *other_conditions).scalar_subquery())
+    # "+ 0": khong de SQLite chon index (author, user_id) chi vi dung duoc them khoang rowid
+    earlier = db.select(other.c.id).where(same_work, other.c.id + 0 < Book.id, *other_conditions).exists()
+    return db.select(*columns, formats.label('formats')).where(*conditions, ~earlier)
+
+def api_book_page(*conditions):
+    """Mot trang sach theo khoa id > cursor, chi SELECT cac cot trong ?fields=."""
+    try:
+        fields = api_fields()
+    except ValueError as e:
+        return api_error(400, str(e))
+    cursor, limit = api_page_args()
+    rows = db.session.execute(
+        db.select(*[getattr(Book, name) for name in fields])
+        .where(api_visible_books(), Book.id > cursor, *conditions)
+        .order_by(Book.id).limit(limit + 1)
+    ).all()
+    items = [api_book_row(row, fields) for row in rows[:limit]]
+    next_cursor = items[-1]['id'] if len(rows) > limit else None
+    return api_response({'items': items, 'next_cursor': next_cursor})
+
+def api_search_conditions():
+    conditions = []
+    query_str = request.args.get('q', '').strip()
+    if query_str:
+        search_term = f"%{remove_diacritics(query_str)}%"
+        conditions.append(or_(
+            db.func.unaccent(Book.title).like(search_term),
+            and_(Book.author != None, db.func.unaccent(Book.author).like(search_term)),
+            and_(Book.tags != None, db.func.unaccent(Book.tags).like(search_term)),
+            and_(Book.series != None, db.func.unaccent(Book.series).like(search_term))
+        ))
+    for name in ('author', 'series', 'format', 'language', 'publisher'):
+        if request.args.get(name):
+            conditions.append(getattr(Book, name) == request.args[name])
+    return conditions
+
+def api_user_book_ids(model):
+    return db.select(model.book_id).where(model.user_id == current_auth('user_id'))
+
+def api_get_book(book_id):
+    """Book neu ton tai va nguoi dung duoc phep, nguoc lai tra ve response loi."""
+    if db.session.get(Book, book_id) is None:
+        return None, api_error(404, "Không tìm thấy sách.")
+    book = check_book_permission(book_id)
+    if not book:
+        return None, api_error(403, "Không có quyền truy cập sách này.")
+    return book, None
+
+@app.route('/api/v1/books')
+@api_login_required
+def api_books():
+    return api_book_page(*api_search_conditions())
+
+@app.route('/api/v1/search')
+@api_login_required
+def api_search():
+    if not request.args.get('q', '').strip():
+        return api_error(400, "Thiếu tham số q.")
+    return api_book_page(*api_search_conditions())
+
+@app.route('/api/v1/books/<int:book_id>')
+@api_login_required
+def api_book(book_id):
+    book, error = api_get_book(book_id)
+    if error:
+        return error
+    try:
+        fields = api_fields() if request.args.get('fields') else API_BOOK_FIELDS
+    except ValueError as e:
+        return api_error(400, str(e))
+    return api_response(api_book_row([getattr(book, name) for name in fields], fields))
+
+@app.route('/api/v1/works')
+@api_login_required
+def api_works():
+    """Moi sach (tua + tac gia) mot muc kem cac dinh dang, con tro la id nho nhat cua nhom."""
+    cursor, limit = api_page_args()
+    rows = db.session.execute(
+        visible_works(Book.id, Book.title, Book.author, Book.series, Book.series_index, Book.user_id,
+                      conditions=api_search_conditions())
+        .where(Book.id > cursor).order_by(Book.id).limit(limit + 1)
+    ).all()
+    items = []
+    for work_id, title, author, series, series_index, owner_id, formats in rows[:limit]:
+        items.append({
+            'id': work_id, 'title': title, 'author': author, 'series': series, 'series_index': series_index,
+            'user_id': owner_id, 'cover': url_for('cover', book_id=work_id),
+            'formats': [{'book_id': int(book_id), 'format': fmt, 'download': url_for('read', book_id=int(book_id))}
+                        for book_id, fmt in (entry.split(':', 1) for entry in formats.split(','))],
+        })
+    return api_response({'items': items, 'next_cursor': items[-1]['id'] if len(rows) > limit else None})
+
+@app.route('/api/v1/shelves')
+@api_login_required
+def api_shelves():
+    rows = db.session.execute(
+        db.select(BookList.id, BookList.name, func.count(book_list_association.c.book_id))
+        .outerjoin(book_list_association, book_list_association.c.book_list_id == BookList.id)
+        .where(BookList.user_id == current_auth('user_id'))
+        .group_by(BookList.id).order_by(BookList.name)
+    ).all()
+    return api_response({'items': [{'id': list_id, 'name': name, 'book_count': count,
+                                    'links': {'books': url_for('api_shelf_books', list_id=list_id)}}
+                                   for list_id, name, count in rows]})
+
+@app.route('/api/v1/shelves/<int:list_id>/books')
+@api_login_required
+def api_shelf_books(list_id):
+    if not BookList.query.filter_by(id=list_id, user_id=current_auth('user_id')).first():
+        return api_error(404, "Không tìm thấy kệ sách.")
+    return api_book_page(Book.id.in_(
+        db.select(book_list_association.c.book_id).where(book_list_association.c.book_list_id == list_id)))
+
+@app.route('/api/v1/shelves/<int:list_id>/books/<int:book_id>', methods=['PUT', 'DELETE'])
+@api_login_required
+def api_shelf_book(list_id, book_id):
+    if not BookList.query.filter_by(id=list_id, user_id=current_auth('user_id')).first():
+        return api_error(404, "Không tìm thấy kệ sách.")
+    book, error = api_get_book(book_id)
+    if error:
+        return error
+    if request.method == 'PUT':
+        add_to_shelves([list_id], selected_work_ids([book.id]))
+    else:
+        remove_from_shelves([list_id], selected_work_ids([book.id]))
+    db.session.commit()
+    return api_response({'success': True})
+
+@app.route('/api/v1/<any(favorites, bookmarks):collection>')
+@api_login_required
+def api_collection(collection):
+    if not guest_allowed(API_GUEST_PERMISSIONS[collection]):
+        return api_error(403, "Tài khoản khách không được phép.")
+    model = Favorite if collection == 'favorites' else BookMark
+    return api_book_page(Book.id.in_(api_user_book_ids(model)))
+
+@app.route('/api/v1/<any(favorites, bookmarks):collection>/<int:book_id>', methods=['PUT', 'DELETE'])
+@api_login_required
+def api_collection_book(collection, book_id):
+    """Them / bo moi dinh dang cua sach, giong toggle_favorite / toggle_bookmark."""
+    if not guest_allowed(API_GUEST_PERMISSIONS[collection]):
+        return api_error(403, "Tài khoản khách không được phép.")
+    book, error = api_get_book(book_id)
+    if error:
+        return error
+    model = Favorite if collection == 'favorites' else BookMark
+    user_id = current_auth('user_id')
+    format_ids = selected_work_ids([book.id])
+    if request.method == 'PUT':
+        db.session.execute(
+            sqlite_insert(model).from_select(['user_id', 'book_id'], db.select(db.literal(user_id), Book.id).where(Book.id.in_(format_ids)))
+            .on_conflict_do_nothing()
+        )
+    else:
+        db.session.execute(db.delete(model).where(model.user_id == user_id, model.book_id.in_(format_ids)))
+    db.session.commit()
+    return api_response({'success': True})
+
+@app.route('/api/v1/progress/<int:book_id>', methods=['GET', 'PUT'])
+@api_login_required
+def api_progress(book_id):
+    """Vi tri doc / cai dat trinh doc (cung du lieu voi save_reader_settings)."""
+    book, error = api_get_book(book_id)
+    if error:
+        return error
+    user_id = current_auth('user_id')
+    history_entry = ReadingHistory.query.filter_by(user_id=user_id, book_id=book_id).first()
+    if request.method == 'PUT':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('settings'), dict):
+            return api_error(400, "Cần JSON dạng {\"settings\": {...}}.")
+        if not history_entry:
+            history_entry = ReadingHistory(user_id=user_id, book_id=book_id)
+            db.session.add(history_entry)
+        history_entry.settings = json.dumps(data['settings'])
+        history_entry.last_read = datetime.utcnow()
+        db.session.commit()
+    return api_response({
+        'book_id': book_id,
+        'settings': json.loads(history_entry.settings or '{}') if history_entry else {},
+        'last_read': history_entry.last_read.isoformat() if history_entry and history_entry.last_read else None,
+    })
+
+# --- DANH MUC OPDS (CHO MAY DOC SACH: KOREADER...) ---
+# OPDS 1.2 (Atom) duoi /opds va OPDS 2.0 (JSON) duoi /opds/v2, cung du lieu. Feed duoc sinh
+# dan tung muc (stream), phan trang theo khoa (?after=), lien ket tai ve tro toi read() va
+# anh bia toi cover(). ETag = the he thu vien cua nguoi dung (bang library_generation, trigger
+# tang khi sach / ke sach cua ho thay doi) + URL: may doc tai lai danh muc khong doi chi ton
+# mot truy van nho roi nhan 304.
+OPDS_PAGE_SIZE = 50
+OPDS_MIME_TYPES = {
+    'epub': 'application/epub+zip', 'pdf': 'application/pdf', 'mobi': 'application/x-mobipocket-ebook',
+    'prc': 'application/x-mobipocket-ebook', 'azw': 'application/vnd.amazon.ebook', 'azw3': 'application/vnd.amazon.ebook',
+    'txt': 'text/plain', 'html': 'text/html', 'rtf': 'application/rtf', 'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'lit': 'application/x-ms-reader',
+}
+OPDS_ATOM_TYPE = 'application/atom+xml;profile=opds-catalog;kind='
+OPDS_JSON_TYPE = 'application/opds+json'
+
+def library_generation():
+    """(so the he, thoi diem thay doi cuoi) cua phan thu vien nguoi dung hien tai thay duoc."""
+    scope = 0 if current_auth('is_admin') else current_auth('user_id')
+    row = db.session.execute(db.select(LibraryGeneration.value, LibraryGeneration.updated_at).where(LibraryGeneration.id == scope)).first()
+    return (row.value, row.updated_at) if row else (0, None)
+
+def opds_scope():
+    return 'all' if current_auth('is_admin') else str(current_auth('user_id'))
+
+def opds_url(endpoint, v2, **values):
+    return url_for(endpoint, v2=v2, _external=True, **values)
+
+def opds_works(conditions, after=None, order='id', limit=OPDS_PAGE_SIZE):
+    """
+    Mot trang sach (gom moi dinh dang cung tua / tac gia, xem visible_works), khoa la id cua
+    dong dai dien. order: 'id' (tang dan), 'recent' (moi them truoc) hoac 'series' (theo
+    series_index, dung index (series, series_index)). Tra ve (cac dong, con tro trang sau).
+    """
+    query = visible_works(Book.id, Book.title, Book.author, Book.description, Book.series, Book.series_index,
+                          Book.language, Book.publisher, Book.date_added, Book.tags, conditions=conditions)
+    if order == 'series':
+        if after:
+            series_index, book_id = (int(part) for part in after.split(':'))
+            query = query.where(db.tuple_(Book.series_index, Book.id) > db.tuple_(series_index, book_id))
+        query = query.order_by(Book.series_index, Book.id)
+    elif order == 'recent':
+        if after:
+            query = query.where(Book.id < int(after))
+        query = query.order_by(Book.id.desc())
+    else:
+        if after:
+            query = query.where(Book.id > int(after))
+        query = query.order_by(Book.id)
+    rows = db.session.execute(query.limit(limit + 1)).all()
+    next_after = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_after = f"{last.series_index or 0}:{last.id}" if order == 'series' else str(last.id)
+    return rows[:limit], next_after
+
+def opds_publication(row, v2):
+    formats = [entry.split(':', 1) for entry in (row.formats or '').split(',') if ':' in entry]
+    links = [(url_for('read', book_id=int(book_id), _external=True), OPDS_MIME_TYPES.get(fmt, 'application/octet-stream'))
+             for book_id, fmt in formats]
+    cover_url = url_for('cover', book_id=row.id, _external=True)
+    if v2:
+        metadata = {'@type': 'http://schema.org/Book', 'identifier': f"urn:thuvien:book:{row.id}", 'title': row.title,
+                    'author': row.author, 'language': row.language, 'publisher': row.publisher,
+                    'description': row.description, 'subject': split_tags(row.tags) or None,
+                    'modified': row.date_added.isoformat() + 'Z' if row.date_added else None}
+        if row.series:
+            metadata['belongsTo'] = {'series': {'name': row.series, 'position': row.series_index}}
+        return {'metadata': {key: value for key, value in metadata.items() if value is not None},
+                'links': [{'rel': 'http://opds-spec.org/acquisition', 'href': href, 'type': mime} for href, mime in links],
+                'images': [{'href': cover_url, 'type': 'image/jpeg'}]}
+    parts = [f"<entry><title>{xml_escape(row.title)}</title><id>urn:thuvien:book:{row.id}</id>"]
+    if row.date_added:
+        parts.append(f"<updated>{row.date_added.isoformat()}Z</updated>")
+    if row.author:
+        parts.append(f"<author><name>{xml_escape(row.author)}</name></author>")
+    for tag, value in (('dc:language', row.language), ('dc:publisher', row.publisher)):
+        if value:
+            parts.append(f"<{tag}>{xml_escape(value)}</{tag}>")
+    for tag in split_tags(row.tags):
+        parts.append(f"<category term={quoteattr(tag)} label={quoteattr(tag)}/>")
+    if row.series:
+        parts.append(f"<content type=\"text\">{xml_escape(f'{row.series} #{row.series_index}')}</content>")
+    if row.description:
+        parts.append(f"<summary>{xml_escape(row.description[:2000])}</summary>")
+    parts.append(f"<link rel=\"http://opds-spec.org/image\" href={quoteattr(cover_url)} type=\"image/jpeg\"/>")
+    parts.append(f"<link rel=\"http://opds-spec.org/image/thumbnail\" href={quoteattr(cover_url)} type=\"image/jpeg\"/>")
+    for href, mime in links:
+        parts.append(f"<link rel=\"http://opds-spec.org/acquisition\" href={quoteattr(href)} type=\"{mime}\"/>")
+    parts.append("</entry>")
+    return ''.join(parts)
+
+def opds_navigation(title, href, count, v2):
+    if v2:
+        entry = {'title': title, 'href': href, 'type': OPDS_JSON_TYPE}
+        if count is not None:
+            entry['properties'] = {'numberOfItems': count}
+        return entry
+    content = f"<content type=\"text\">{count} sách</content>" if count is not None else ''
+    return (f"<entry><title>{xml_escape(title)}</title><id>{xml_escape(href)}</id>{content}"
+            f"<link rel=\"subsection\" href={quoteattr(href)} type=\"{OPDS_ATOM_TYPE}navigation\"/></entry>")
+
+def opds_feed(title, kind, v2, load):
+    """
+    Response stream cho mot feed. load() tra ve (cac muc da dinh dang - chuoi XML hoac dict,
+    URL trang sau) va chi duoc goi khi ETag khong khop, nen 304 khong chay truy van cua feed.
+    """
+    generation, updated_at = library_generation()
+    etag = hashlib.sha1(f"{generation}:{opds_scope()}:{request.full_path}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    self_url = request.url
+    start_url = opds_url('opds_root', v2)
+    search_url = opds_url('opds_search', v2)
+    updated = (updated_at or datetime.utcnow()).isoformat() + 'Z'
+    items, next_url = load()
+
+    def generate_atom():
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" '
+               'xmlns:opds="http://opds-spec.org/2010/catalog">'
+               f"<id>{xml_escape(self_url)}</id><title>{xml_escape(title)}</title><updated>{updated}</updated>"
+               f"<link rel=\"self\" href={quoteattr(self_url)} type=\"{OPDS_ATOM_TYPE}{kind}\"/>"
+               f"<link rel=\"start\" href={quoteattr(start_url)} type=\"{OPDS_ATOM_TYPE}navigation\"/>"
+               f"<link rel=\"search\" href={quoteattr(url_for('opds_opensearch', _external=True))} type=\"application/opensearchdescription+xml\"/>")
+        for item in items:
+            yield item
+        if next_url:
+            yield f"<link rel=\"next\" href={quoteattr(next_url)} type=\"{OPDS_ATOM_TYPE}{kind}\"/>"
+        yield '</feed>'
+
+    def generate_json():
+        links = [{'rel': 'self', 'href': self_url, 'type': OPDS_JSON_TYPE},
+                 {'rel': 'start', 'href': start_url, 'type': OPDS_JSON_TYPE},
+                 {'rel': 'search', 'href': search_url + '{?query}', 'type': OPDS_JSON_TYPE, 'templated': True}]
+        if next_url:
+            links.append({'rel': 'next', 'href': next_url, 'type': OPDS_JSON_TYPE})
+        yield json.dumps({'metadata': {'title': title, 'modified': updated}, 'links': links}, ensure_ascii=False)[:-1]
+        yield ',"publications":[' if kind == 'acquisition' else ',"navigation":['
+        for i, item in enumerate(items):
+            yield (',' if i else '') + json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+        yield ']}'
+
+    response = Response(stream_with_context(generate_json() if v2 else generate_atom()),
+                        mimetype=OPDS_JSON_TYPE if v2 else 'application/atom+xml')
+    if not v2:
+        response.headers['Content-Type'] = f"{OPDS_ATOM_TYPE}{kind}; charset=utf-8"
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def opds_acquisition_feed(title, v2, conditions, order='id', **url_values):
+    after = request.args.get('after')
+    if after and not re.fullmatch(r'\d+:\d+' if order == 'series' else r'\d+', after):
+        return api_error(400, "Tham số after không hợp lệ.")
+
+    def load():
+        rows, next_after = opds_works(conditions, after, order)
+        next_url = opds_url(request.endpoint, v2, after=next_after, **url_values) if next_after else None
+        return (opds_publication(row, v2) for row in rows), next_url
+    return opds_feed(title, 'acquisition', v2, load)
+
+def opds_name_feed(title, v2, column, endpoint, arg):
+    """Danh muc dieu huong theo gia tri cua mot cot (tac gia, bo truyen) kem so sach, phan trang theo ten."""
+    def load():
+        after = request.args.get('after')
+        query = (db.select(column, func.count(func.distinct(Book.title)))
+                 .where(api_visible_books(), column != None, column != '')
+                 .group_by(column).order_by(column).limit(OPDS_PAGE_SIZE + 1))
+        if after:
+            query = query.where(column > after)
+        rows = db.session.execute(query).all()
+        next_url = opds_url(request.endpoint, v2, after=rows[OPDS_PAGE_SIZE - 1][0]) if len(rows) > OPDS_PAGE_SIZE else None
+        return (opds_navigation(name, opds_url(endpoint, v2, **{arg: name}), count, v2) for name, count in rows[:OPDS_PAGE_SIZE]), next_url
+    return opds_feed(title, 'navigation', v2, load)
+
+@app.route('/opds', defaults={'v2': False})
+@app.route('/opds/v2', defaults={'v2': True})
+@api_login_required
+def opds_root(v2):
+    sections = [
+        ('Mới thêm gần đây', 'opds_recent'),
+        ('Tất cả sách', 'opds_all_books'),
+        ('Tác giả', 'opds_authors'),
+        ('Bộ truyện', 'opds_series_list'),
+        ('Thẻ', 'opds_tags'),
+        ('Kệ sách', 'opds_shelves'),
+    ]
+    items = [opds_navigation(title, opds_url(endpoint, v2), None, v2) for title, endpoint in sections]
+    return opds_feed(config.get('library_name') or 'Thư viện', 'navigation', v2, lambda: (items, None))
+
+@app.route('/opds/opensearch.xml')
+@api_login_required
+def opds_opensearch():
+    template = url_for('opds_search', v2=False, _external=True) + '?q={searchTerms}'
+    body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<OpenSearchDescription xmlns="http://a9.com/-/spec/opensearch/1.1/">'
+            f"<ShortName>{xml_escape(config.get('library_name') or 'Thư viện')}</ShortName>"
+            '<Description>Tìm sách</Description><InputEncoding>UTF-8</InputEncoding><OutputEncoding>UTF-8</OutputEncoding>'
+            f"<Url type=\"{OPDS_ATOM_TYPE}acquisition\" template={quoteattr(template)}/>"
+            '</OpenSearchDescription>')
+    return Response(body, mimetype='application/opensearchdescription+xml')
+
+@app.route('/opds/search', defaults={'v2': False})
+@app.route('/opds/v2/search', defaults={'v2': True})
+@api_login_required
+def opds_search(v2):
+    query_str = (request.args.get('q') or request.args.get('query') or '').strip()
+    search_term = f"%{remove_diacritics(query_str)}%"
+    conditions = [or_(
+        db.func.unaccent(Book.title).like(search_term),
+        and_(Book.author != None, db.func.unaccent(Book.author).like(search_term)),
+        and_(Book.series != None, db.func.unaccent(Book.series).like(search_term)),
+    )]
+    return opds_acquisition_feed(f"Tìm kiếm: {query_str}", v2, conditions, q=query_str)
+
+@app.route('/opds/recent', defaults={'v2': False})
+@app.route('/opds/v2/recent', defaults={'v2': True})
+@api_login_required
+def opds_recent(v2):
+    return opds_acquisition_feed('Mới thêm gần đây', v2, [], order='recent')
+
+@app.route('/opds/books', defaults={'v2': False})
+@app.route('/opds/v2/books', defaults={'v2': True})
+@api_login_required
+def opds_all_books(v2):
+    return opds_acquisition_feed('Tất cả sách', v2, [])
+
+@app.route('/opds/authors', defaults={'v2': False})
+@app.route('/opds/v2/authors', defaults={'v2': True})
+@api_login_required
+def opds_authors(v2):
+    return opds_name_feed('Tác giả', v2, Book.author, 'opds_author_books', 'author')
+
+@app.route('/opds/authors/books', defaults={'v2': False})
+@app.route('/opds/v2/authors/books', defaults={'v2': True})
+@api_login_required
+def opds_author_books(v2):
+    author = request.args.get('author', '')
+    return opds_acquisition_feed(author, v2, [Book.author == author], author=author)
+
+@app.route('/opds/series', defaults={'v2': False})
+@app.route('/opds/v2/series', defaults={'v2': True})
+@api_login_required
+def opds_series_list(v2):
+    return opds_name_feed('Bộ truyện', v2, Book.series, 'opds_series_books', 'series')
+
+@app.route('/opds/series/books', defaults={'v2': False})
+@app.route('/opds/v2/series/books', defaults={'v2': True})
+@api_login_required
+def opds_series_books(v2):
+    series = request.args.get('series', '')
+    return opds_acquisition_feed(series, v2, [Book.series == series], order='series', series=series)
+
+@app.route('/opds/tags', defaults={'v2': False})
+@app.route('/opds/v2/tags', defaults={'v2': True})
+@api_login_required
+def opds_tags(v2):
+    def load():
+        counts = tag_counts()
+        after = request.args.get('after')
+        if after:
+            counts = [(tag, count) for tag, count in counts if tag > after]
+        page = counts[:OPDS_PAGE_SIZE]
+        next_url = opds_url('opds_tags', v2, after=page[-1][0]) if len(counts) > OPDS_PAGE_SIZE else None
+        return (opds_navigation(tag, opds_url('opds_tag_books', v2, tag=tag), count, v2) for tag, count in page), next_url
+    return opds_feed('Thẻ', 'navigation', v2, load)
+
+@app.route('/opds/tags/books', defaults={'v2': False})
+@app.route('/opds/v2/tags/books', defaults={'v2': True})
+@api_login_required
+def opds_tag_books(v2):
+    tag = request.args.get('tag', '')
+    return opds_acquisition_feed(tag, v2, [Book.id.in_(tag_book_ids(tag))], tag=tag)
+
+@app.route('/opds/shelves', defaults={'v2': False})
+@app.route('/opds/v2/shelves', defaults={'v2': True})
+@api_login_required
+def opds_shelves(v2):
+    def load():
+        shelves = BookList.query.filter_by(user_id=current_auth('user_id')).order_by(BookList.name).all()
+        return [opds_navigation(shelf.name, opds_url('opds_shelf_books', v2, list_id=shelf.id), None, v2) for shelf in shelves], None
+    return opds_feed('Kệ sách', 'navigation', v2, load)
+
+@app.route('/opds/shelves/<int:list_id>', defaults={'v2': False})
+@app.route('/opds/v2/shelves/<int:list_id>', defaults={'v2': True})
+@api_login_required
+def opds_shelf_books(v2, list_id):
+    shelf = BookList.query.filter_by(id=list_id, user_id=current_auth('user_id')).first()
+    if shelf is None:
+        return api_error(404, "Không tìm thấy kệ sách.")
+    condition = Book.id.in_(db.select(book_list_association.c.book_id).where(book_list_association.c.book_list_id == list_id))
+    return opds_acquisition_feed(shelf.name, v2, [condition], list_id=list_id)
+
 if __name__ == '__main__':
     app_config = load_config()
     port = app_config.get('port', 5000)
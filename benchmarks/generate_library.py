@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Tao thu vien tong hop quy mo lon de do hieu nang.
+
+Ghi truc tiep vao books.db, thu muc books/ va static/covers/ cua thu muc du lieu
+duoc cau hinh trong file config (mac dinh benchmarks/bench_config.json, KHONG dung
+config.json that). Du lieu gom tua sach tieng Viet co dau, sach nhieu dinh dang,
+bo truyen, the loai, yeu thich, danh dau va ke sach.
+
+Cach dung:
+    python benchmarks/generate_library.py --books 200000 --users 500
+    python benchmarks/generate_library.py --books 5000 --users 20 --data-path /tmp/thuvien_bench --reset
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+import zipfile
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(REPO_ROOT, 'benchmarks', 'bench_config.json')
+BENCH_PASSWORD = 'bench'
+
+HO = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ', 'Hồ', 'Ngô', 'Dương', 'Lý']
+TEN_DEM = ['Văn', 'Thị', 'Hữu', 'Đức', 'Minh', 'Ngọc', 'Thanh', 'Quốc', 'Xuân', 'Thu', 'Bảo', 'Gia']
+TEN = ['An', 'Bình', 'Châu', 'Dũng', 'Giang', 'Hà', 'Hải', 'Hạnh', 'Khoa', 'Lan', 'Long', 'Mai', 'Nam', 'Phúc', 'Quân', 'Sơn', 'Tâm', 'Thảo', 'Trang', 'Tú', 'Việt', 'Yến']
+TU_DAU = ['Những', 'Một', 'Chuyện', 'Bí mật', 'Hành trình', 'Mùa', 'Ký ức', 'Tiếng gọi', 'Bóng', 'Giấc mơ', 'Truyền thuyết', 'Nhật ký']
+TU_GIUA = ['ngày', 'đêm', 'dòng sông', 'thành phố', 'ngọn núi', 'biển', 'cánh đồng', 'khu vườn', 'con đường', 'ngôi nhà', 'vì sao', 'cơn mưa', 'làng quê']
+TU_CUOI = ['thơ ấu', 'xa xăm', 'đã mất', 'không tên', 'bình yên', 'rực rỡ', 'lặng lẽ', 'cuối cùng', 'phương Nam', 'Hà Nội', 'Sài Gòn', 'mùa thu', 'đầu tiên']
+BO_TRUYEN = ['Thám tử lừng danh', 'Đất rừng phương Nam', 'Hiệp sĩ ánh trăng', 'Vương quốc mây', 'Học viện pháp thuật', 'Biên niên sử Đông Dương', 'Kiếm hiệp kỳ duyên', 'Thủy thủ mặt trăng']
+THE_LOAI = ['Tiểu thuyết', 'Văn học Việt Nam', 'Trinh thám', 'Khoa học viễn tưởng', 'Lịch sử', 'Kinh tế', 'Tâm lý', 'Thiếu nhi', 'Manga', 'Kỹ năng sống', 'Thơ', 'Hồi ký', 'Giả tưởng', 'Kinh dị']
+NHA_XUAT_BAN = ['NXB Trẻ', 'NXB Kim Đồng', 'NXB Văn học', 'NXB Hội Nhà văn', 'Nhã Nam', 'Alpha Books', 'NXB Tổng hợp TP.HCM']
+NGON_NGU = ['Tiếng Việt'] * 6 + ['vi', 'en', 'fr', 'ja']
+FORMATS = ['epub', 'mobi', 'pdf', 'azw3']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Tao thu vien tong hop de do hieu nang.')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='File cau hinh (se duoc tao neu chua co).')
+    parser.add_argument('--data-path', help='Thu muc du lieu cho file cau hinh moi.')
+    parser.add_argument('--books', type=int, default=200000, help='Tong so dong Book (moi dinh dang la mot dong).')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--favorites-per-user', type=int, default=200)
+    parser.add_argument('--bookmarks-per-user', type=int, default=50)
+    parser.add_argument('--shelves-per-user', type=int, default=8)
+    parser.add_argument('--books-per-shelf', type=int, default=150)
+    parser.add_argument('--cover-fraction', type=float, default=1.0, help='Ti le sach co san file anh bia.')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1912)
+    parser.add_argument('--reset', action='store_true', help='Xoa thu muc du lieu truoc khi tao.')
+    return parser.parse_args()
+
+
+def prepare_config(args):
+    if not os.path.exists(args.config) or args.data_path:
+        data_path = os.path.abspath(args.data_path or os.path.join(REPO_ROOT, 'benchmarks', 'bench_data'))
+        with open(args.config, 'w', encoding='utf-8') as f:
+            json.dump({'library_name': 'Thư Viện Benchmark', 'data_path': data_path, 'port': 5000}, f, indent=4, ensure_ascii=False)
+    with open(args.config, 'r', encoding='utf-8') as f:
+        data_path = os.path.abspath(json.load(f)['data_path'])
+    if args.reset and os.path.isdir(data_path):
+        shutil.rmtree(data_path)
+    os.environ['THUVIEN_CONFIG'] = os.path.abspath(args.config)
+
+
+def make_template_files(folder):
+    """Tao mot file mau nho cho moi dinh dang; sach tong hop la hard link toi cac file nay."""
+    os.makedirs(folder, exist_ok=True)
+    paths = {}
+    for fmt in FORMATS:
+        path = os.path.join(folder, f'template.{fmt}')
+        if fmt == 'epub':
+            with zipfile.ZipFile(path, 'w') as zf:
+                zf.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+                zf.writestr('META-INF/container.xml', '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container"><rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+                zf.writestr('content.opf', '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0"><metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Benchmark</dc:title></metadata><manifest/><spine/></package>')
+        else:
+            with open(path, 'wb') as f:
+                f.write(f'benchmark {fmt} '.encode() * 256)
+        paths[fmt] = path
+    return paths
+
+
+def make_template_covers(folder, count=32):
+    from PIL import Image
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f'cover_{i}.jpg')
+        color = ((i * 53) % 256, (i * 97) % 256, (i * 151) % 256)
+        Image.new('RGB', (400, 600), color).save(path, 'jpeg', quality=80)
+        paths.append(path)
+    return paths
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def random_title(rng):
+    return f"{rng.choice(TU_DAU)} {rng.choice(TU_GIUA)} {rng.choice(TU_CUOI)}"
+
+
+def random_author(rng):
+    return f"{rng.choice(HO)} {rng.choice(TEN_DEM)} {rng.choice(TEN)}"
+
+
+def main():
+    args = parse_args()
+    prepare_config(args)
+    sys.path.insert(0, REPO_ROOT)
+    import app as library_app
+
+    rng = random.Random(args.seed)
+    started = time.time()
+    library_app.initialize_database()
+
+    data_root = library_app.DATA_ROOT
+    upload_folder = library_app.app.config['UPLOAD_FOLDER']
+    cover_folder = library_app.app.config['COVER_FOLDER']
+    template_files = make_template_files(os.path.join(data_root, 'bench_templates'))
+    template_covers = make_template_covers(os.path.join(data_root, 'bench_templates'))
+
+    conn = sqlite3.connect(library_app.DATABASE_FILE)
+    conn.create_function('unaccent', 1, library_app.remove_diacritics)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+
+    # --- Nguoi dung ---
+    existing_users = {row[0] for row in conn.execute('SELECT username FROM user')}
+    new_users = [(f'bench{i:04d}', BENCH_PASSWORD, 0, 1) for i in range(1, args.users + 1) if f'bench{i:04d}' not in existing_users]
+    conn.executemany('INSERT INTO user (username, password, is_admin, is_active) VALUES (?, ?, ?, ?)', new_users)
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM user WHERE username LIKE 'bench%' ORDER BY id")]
+    conn.commit()
+    # Phan bo lech: mot so nguoi dung co thu vien rat lon
+    user_weights = [1.0 / (rank + 1) ** 0.8 for rank in range(len(user_ids))]
+
+    # --- Sach ---
+    next_id = (conn.execute('SELECT MAX(id) FROM book').fetchone()[0] or 0) + 1
+    now = datetime.utcnow()
+    works_by_user = {uid: [] for uid in user_ids}
+    book_rows, created_folders = [], set()
+    total = 0
+    while total < args.books:
+        user_id = rng.choices(user_ids, weights=user_weights)[0]
+        title, author = random_title(rng), random_author(rng)
+        series, series_index = None, 1
+        if rng.random() < 0.25:
+            series = rng.choice(BO_TRUYEN)
+            series_index = rng.randint(1, 300 if series == 'Thám tử lừng danh' else 40)
+            title = f"{series} - Tập {series_index}"
+        tags = ', '.join(rng.sample(THE_LOAI, rng.randint(1, 4)))
+        description = f"{title} là một tác phẩm của {author}. " * rng.randint(2, 12)
+        date_added = now - timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+        pubdate = f"{rng.randint(1950, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        formats = rng.sample(FORMATS, min(rng.choices([1, 2, 3], weights=[6, 3, 1])[0], args.books - total))
+        work_ids = []
+        for fmt in formats:
+            book_id = next_id
+            next_id += 1
+            filename = f"bench_{book_id}.{fmt}"
+            user_folder = os.path.join(upload_folder, str(user_id))
+            if user_folder not in created_folders:
+                os.makedirs(user_folder, exist_ok=True)
+                os.makedirs(os.path.join(cover_folder, str(user_id)), exist_ok=True)
+                created_folders.add(user_folder)
+            link_or_copy(template_files[fmt], os.path.join(user_folder, filename))
+            has_cover = rng.random() < args.cover_fraction
+            if has_cover:
+                link_or_copy(rng.choice(template_covers), os.path.join(cover_folder, str(user_id), f"{book_id}.jpg"))
+            book_rows.append((book_id, filename, title, author, fmt, tags, description, rng.randint(0, 5), series, series_index,
+                              rng.choice(NHA_XUAT_BAN), pubdate, rng.choice(NGON_NGU), date_added.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                              user_id, 1 if has_cover else 0))
+            work_ids.append(book_id)
+            total += 1
+        works_by_user[user_id].append(work_ids)
+        if len(book_rows) >= args.batch_size:
+            insert_books(conn, book_rows, library_app.split_tags)
+            book_rows = []
+            print(f"  {total}/{args.books} sach ({time.time() - started:.0f}s)")
+    insert_books(conn, book_rows, library_app.split_tags)
+
+    # --- Yeu thich, danh dau, ke sach ---
+    favorites, bookmarks, shelf_rows = [], [], []
+    for user_id in user_ids:
+        works = works_by_user[user_id]
+        if not works:
+            continue
+        for work in rng.sample(works, min(len(works), args.favorites_per_user)):
+            favorites.extend((user_id, book_id) for book_id in work)
+        for work in rng.sample(works, min(len(works), args.bookmarks_per_user)):
+            bookmarks.extend((user_id, book_id) for book_id in work)
+        for shelf_number in range(args.shelves_per_user):
+            cursor = conn.execute('INSERT INTO book_list (name, user_id) VALUES (?, ?)', (f'Kệ sách {shelf_number + 1}', user_id))
+            shelf_id = cursor.lastrowid
+            for work in rng.sample(works, min(len(works), args.books_per_shelf)):
+                shelf_rows.extend((book_id, shelf_id) for book_id in work)
+    conn.executemany('INSERT OR IGNORE INTO favorite (user_id, book_id) VALUES (?, ?)', favorites)
+    conn.executemany('INSERT OR IGNORE INTO book_mark (user_id, book_id) VALUES (?, ?)', bookmarks)
+    conn.executemany('INSERT OR IGNORE INTO book_list_association (book_id, book_list_id) VALUES (?, ?)', shelf_rows)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+    print(f"Da tao {total} sach, {len(user_ids)} nguoi dung, {len(favorites)} yeu thich, "
+          f"{len(bookmarks)} danh dau, {len(shelf_rows)} muc ke sach trong {time.time() - started:.0f}s.")
+    print(f"Thu muc du lieu: {data_root}")
+    print(f"Dang nhap bang bench0001..bench{args.users:04d} / mat khau '{BENCH_PASSWORD}'.")
+
+
+def insert_books(conn, rows, split_tags):
+    """Ghi mot lo Book kem bang the chuan hoa tag / book_tag (trigger cua book_tag cap nhat tag_count)."""
+    if not rows:
+        return
+    conn.executemany(
+        'INSERT INTO book (id, filename, title, author, format, tags, description, rating, series, series_index, '
+        'publisher, pubdate, language, date_added, user_id, has_cover) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    pairs = [(row[0], name) for row in rows for name in split_tags(row[5])]
+    conn.executemany('INSERT OR IGNORE INTO tag (name) VALUES (?)', sorted({(name,) for _, name in pairs}))
+    conn.executemany('INSERT OR IGNORE INTO book_tag (book_id, tag_id) SELECT ?, id FROM tag WHERE name = ?', pairs)
+    conn.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Kiem tra tai dau-cuoi cho thu vien dang chay.
+
+Dang nhap bang cac tai khoan benchXXXX (tao boi generate_library.py), goi dong thoi
+trang chu (moi kieu sap xep), tim kiem, /cover, trang chi tiet sach, yeu thich va
+ke sach, roi bao cao p50/p95/p99 va thong luong cho tung kich ban.
+
+Cach dung:
+    python app.py   (voi THUVIEN_CONFIG=benchmarks/bench_config.json)
+    python benchmarks/load_test.py --base-url http://localhost:5000 --concurrency 16 --duration 60
+    python benchmarks/load_test.py --output bench_output.json --compare benchmarks/load_baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(REPO_ROOT, 'benchmarks', 'bench_config.json')
+SORT_OPTIONS = ['title_asc', 'title_desc', 'author_asc', 'author_desc', 'rating_desc', 'date_desc']
+SEARCH_TERMS = ['Những', 'nhung', 'dòng sông', 'dong song', 'Nguyễn', 'nguyen', 'Thám tử', 'tham tu', 'Hà Nội', 'ha noi', 'Manga', 'mùa thu']
+# Trong so: trang chu va anh bia chiem phan lon luu luong thuc te
+SCENARIOS = {
+    'index': 25,
+    'search': 15,
+    'cover': 30,
+    'book_detail': 15,
+    'favorites': 8,
+    'view_list': 7,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Kiem tra tai cho thu vien sach.')
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='File cau hinh de tim books.db (lay id sach va ke sach).')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=60, help='Thoi gian chay (giay).')
+    parser.add_argument('--warmup', type=float, default=5, help='Thoi gian khoi dong khong tinh vao ket qua (giay).')
+    parser.add_argument('--users', type=int, default=50, help='So tai khoan bench dung de dang nhap.')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--seed', type=int, default=1912)
+    parser.add_argument('--output', help='Ghi ket qua JSON ra file.')
+    parser.add_argument('--compare', help='So sanh voi file ket qua JSON truoc do.')
+    return parser.parse_args()
+
+
+def load_targets(config_path, usernames):
+    """Doc books.db (chi doc) de lay id sach va ke sach cua cac tai khoan bench."""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        data_path = json.load(f)['data_path']
+    conn = sqlite3.connect(f"file:{os.path.join(data_path, 'books.db')}?mode=ro", uri=True)
+    targets = {}
+    for username in usernames:
+        row = conn.execute('SELECT id FROM user WHERE username = ?', (username,)).fetchone()
+        if not row:
+            continue
+        user_id = row[0]
+        book_ids = [r[0] for r in conn.execute('SELECT id FROM book WHERE user_id = ? ORDER BY RANDOM() LIMIT 500', (user_id,))]
+        list_ids = [r[0] for r in conn.execute('SELECT id FROM book_list WHERE user_id = ?', (user_id,))]
+        if book_ids:
+            targets[username] = {'book_ids': book_ids, 'list_ids': list_ids}
+    conn.close()
+    return targets
+
+
+def build_request(scenario, rng, target):
+    if scenario == 'index':
+        return '/', {'sort': rng.choice(SORT_OPTIONS), 'page': rng.choice([1, 1, 1, 2, 3, 10, 50])}
+    if scenario == 'search':
+        return '/', {'q': rng.choice(SEARCH_TERMS), 'sort': rng.choice(SORT_OPTIONS)}
+    if scenario == 'cover':
+        return f"/cover/{rng.choice(target['book_ids'])}", None
+    if scenario == 'book_detail':
+        return f"/book/{rng.choice(target['book_ids'])}", None
+    if scenario == 'favorites':
+        return '/favorites', {'page': rng.choice([1, 1, 2])}
+    if scenario == 'view_list' and target['list_ids']:
+        return f"/lists/{rng.choice(target['list_ids'])}", None
+    return '/', None
+
+
+def login(base_url, username, password):
+    s = requests.Session()
+    r = s.post(f"{base_url}/login", data={'username': username, 'password': password}, allow_redirects=False)
+    if r.status_code != 302 or 'session' not in s.cookies:
+        raise RuntimeError(f"Khong dang nhap duoc bang {username} (HTTP {r.status_code}).")
+    return s
+
+
+def worker(worker_id, args, targets, deadline, measure_from, results, lock):
+    rng = random.Random(args.seed + worker_id)
+    username = rng.choice(sorted(targets))
+    target = targets[username]
+    session = login(args.base_url, username, args.password)
+    names, weights = zip(*SCENARIOS.items())
+    local = defaultdict(list)
+    errors = defaultdict(int)
+    while time.time() < deadline:
+        scenario = rng.choices(names, weights=weights)[0]
+        path, params = build_request(scenario, rng, target)
+        started = time.perf_counter()
+        try:
+            response = session.get(args.base_url + path, params=params, allow_redirects=False)
+            ok = response.status_code == 200
+            response.content
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        if time.time() < measure_from:
+            continue
+        if ok:
+            local[scenario].append(elapsed)
+        else:
+            errors[scenario] += 1
+    with lock:
+        for scenario, samples in local.items():
+            results['latencies'][scenario].extend(samples)
+        for scenario, n in errors.items():
+            results['errors'][scenario] += n
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def summarize(results, measured_seconds):
+    summary = {}
+    all_samples = []
+    for scenario in SCENARIOS:
+        samples = sorted(results['latencies'].get(scenario, []))
+        all_samples.extend(samples)
+        summary[scenario] = {
+            'requests': len(samples),
+            'errors': results['errors'].get(scenario, 0),
+            'rps': len(samples) / measured_seconds if measured_seconds else 0,
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+        }
+    all_samples.sort()
+    summary['total'] = {
+        'requests': len(all_samples),
+        'errors': sum(results['errors'].values()),
+        'rps': len(all_samples) / measured_seconds if measured_seconds else 0,
+        'p50_ms': percentile(all_samples, 50) * 1000,
+        'p95_ms': percentile(all_samples, 95) * 1000,
+        'p99_ms': percentile(all_samples, 99) * 1000,
+    }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    header = f"{'Kich ban':<14}{'So req':>9}{'Loi':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'p95 truoc':>12}{'thay doi':>10}"
+    print(header)
+    print('-' * len(header))
+    for scenario, row in summary.items():
+        line = (f"{scenario:<14}{row['requests']:>9}{row['errors']:>6}{row['rps']:>9.1f}"
+                f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+        if baseline and scenario in baseline and baseline[scenario]['p95_ms']:
+            before = baseline[scenario]['p95_ms']
+            line += f"{before:>12.1f}{(row['p95_ms'] - before) / before * 100:>+9.0f}%"
+        print(line)
+
+
+def main():
+    args = parse_args()
+    usernames = [f'bench{i:04d}' for i in range(1, args.users + 1)]
+    targets = load_targets(args.config, usernames)
+    if not targets:
+        sys.exit('Khong tim thay tai khoan bench nao co sach. Hay chay generate_library.py truoc.')
+
+    results = {'latencies': defaultdict(list), 'errors': defaultdict(int)}
+    lock = threading.Lock()
+    started = time.time()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+    threads = [threading.Thread(target=worker, args=(i, args, targets, deadline, measure_from, results, lock))
+               for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    summary = summarize(results, args.duration)
+    baseline = None
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['summary']
+    print(f"{args.concurrency} luong, {args.duration:.0f}s do, {len(targets)} tai khoan, {args.base_url}")
+    print_summary(summary, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'concurrency': args.concurrency,
+                       'duration': args.duration, 'summary': summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark cho cac ham nong: remove_diacritics (ham UDF unaccent cua SQLite),
+parse_opf va chuoi thu nho / chuyen mau / luu anh bia (save_cover_image).
+
+Chay offline tren cac file mau trong benchmarks/fixtures, so sanh voi moc luu trong
+benchmarks/microbench_baseline.json va tra ve ma loi 1 neu co ham cham hon moc qua
+--max-regression lan.
+
+Cach dung:
+    python benchmarks/microbench.py                    # do va so sanh voi moc
+    python benchmarks/microbench.py --save-baseline    # ghi lai moc moi (chay tren may CI)
+    python benchmarks/microbench.py --only parse_opf --max-regression 2
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+FIXTURES = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'microbench_baseline.json')
+
+
+def load_app(work_dir):
+    """Nap app.py voi file cau hinh tam de khong dung toi thu vien that."""
+    config_path = os.path.join(work_dir, 'config.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({'data_path': os.path.join(work_dir, 'data')}, f)
+    os.environ['THUVIEN_CONFIG'] = config_path
+    sys.path.insert(0, REPO_ROOT)
+    import app as library_app
+    return library_app
+
+
+def build_benchmarks(library_app, work_dir):
+    from PIL import Image
+
+    with open(os.path.join(FIXTURES, 'sample.opf'), 'r', encoding='utf-8') as f:
+        opf_content = f.read()
+    with zipfile.ZipFile(os.path.join(FIXTURES, 'sample.epub')) as zf:
+        epub_opf = zf.read('OEBPS/content.opf').decode('utf-8')
+
+    titles = [
+        'Đất rừng phương Nam', 'Những ngày thơ ấu', 'Số đỏ', 'Dế Mèn phiêu lưu ký', 'Tắt đèn',
+        'Nỗi buồn chiến tranh', 'Cho tôi xin một vé đi tuổi thơ', 'Harry Potter và Hòn đá Phù thủy',
+        'ĐẤT NƯỚC ĐỨNG LÊN', 'Plain ASCII title for comparison',
+    ] * 100
+
+    conn = sqlite3.connect(':memory:')
+    conn.create_function('unaccent', 1, library_app.remove_diacritics)
+    conn.execute('CREATE TABLE book (id INTEGER PRIMARY KEY, title TEXT)')
+    conn.executemany('INSERT INTO book (title) VALUES (?)', [(t,) for t in titles * 5])
+
+    cover_out = os.path.join(work_dir, 'covers', 'out.jpg')
+
+    def resize_jpeg():
+        with Image.open(os.path.join(FIXTURES, 'cover.jpg')) as img:
+            library_app.save_cover_image(img, [cover_out])
+
+    def resize_rgba_png():
+        with Image.open(os.path.join(FIXTURES, 'cover.png')) as img:
+            library_app.save_cover_image(img, [cover_out])
+
+    # (ten, ham, so phan tu moi lan goi) - ket qua bao cao theo micro giay / phan tu
+    return [
+        ('remove_diacritics', lambda: [library_app.remove_diacritics(t) for t in titles], len(titles)),
+        ('unaccent_sql_like', lambda: conn.execute("SELECT COUNT(*) FROM book WHERE unaccent(title) LIKE '%dat%'").fetchone(), len(titles) * 5),
+        ('parse_opf', lambda: library_app.parse_opf(opf_content), 1),
+        ('parse_opf_epub', lambda: library_app.parse_opf(epub_opf), 1),
+        ('cover_resize_jpeg', resize_jpeg, 1),
+        ('cover_convert_rgba_png', resize_rgba_png, 1),
+    ]
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmark cho cac ham nong.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', help='Chi chay benchmark co ten nay (co the lap lai).')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--max-regression', type=float, default=1.5, help='Bao loi neu cham hon moc qua so lan nay.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='thuvien_microbench_')
+    try:
+        library_app = load_app(work_dir)
+        benchmarks = build_benchmarks(library_app, work_dir)
+        results = {}
+        for name, func, items in benchmarks:
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(func, args.repeat) / items * 1e6
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+
+    regressions = []
+    print(f"{'Benchmark':<26}{'us/phan tu':>14}{'moc':>14}{'ti le':>9}")
+    print('-' * 63)
+    for name, value in results.items():
+        before = baseline.get(name)
+        if before:
+            ratio = value / before
+            flag = '  CHAM' if ratio > args.max_regression else ''
+            print(f"{name:<26}{value:>14.3f}{before:>14.3f}{ratio:>8.2f}x{flag}")
+            if ratio > args.max_regression:
+                regressions.append(name)
+        else:
+            print(f"{name:<26}{value:>14.3f}{'-':>14}{'-':>9}")
+
+    if args.save_baseline:
+        merged = dict(baseline, **results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': merged}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Da luu moc vao {args.baseline}")
+    elif regressions:
+        print(f"Cham hon moc qua {args.max_regression}x: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
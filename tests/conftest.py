@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""Fixture dung chung: nap app.py voi thu muc du lieu tam (mot lan cho ca phien test)."""
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def library_app(tmp_path_factory):
+    data_path = tmp_path_factory.mktemp('thuvien')
+    config_path = data_path / 'config.json'
+    config_path.write_text(json.dumps({'data_path': str(data_path / 'data')}), encoding='utf-8')
+    os.environ['THUVIEN_CONFIG'] = str(config_path)
+    sys.path.insert(0, REPO_ROOT)
+    library_app = importlib.import_module('app')
+    library_app.initialize_database()
+    return library_app
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Ngan sach truy van SQL cho cac trang chinh: them truy van lap theo tung sach (N+1) se lam
+test nay that bai. Chay: python -m pytest -q tests
+"""
+import pytest
+
+BOOKS = 40 # Du lon de truy van lap theo tung sach vuot ngan sach
+
+
+@pytest.fixture(scope='module')
+def library(library_app):
+    with library_app.app.app_context():
+        db, Book = library_app.db, library_app.Book
+        admin = library_app.User.query.filter_by(username=library_app.ADMIN_USERNAME).one()
+        books = []
+        for i in range(BOOKS):
+            for fmt in ('epub', 'pdf'):
+                books.append(Book(title=f'Sách {i:03d}', author=f'Tác giả {i % 7}', filename=f'{i}.{fmt}', format=fmt,
+                                  tags='Tiểu thuyết, Lịch sử', series='Bộ A' if i % 3 == 0 else None, series_index=i,
+                                  user_id=admin.id))
+        db.session.add_all(books)
+        book_list = library_app.BookList(name='Kệ 1', user_id=admin.id)
+        db.session.add(book_list)
+        db.session.flush()
+        for book in books:
+            db.session.add(library_app.Favorite(user_id=admin.id, book_id=book.id))
+            db.session.add(library_app.BookMark(user_id=admin.id, book_id=book.id))
+            db.session.execute(library_app.book_list_association.insert().values(book_id=book.id, book_list_id=book_list.id))
+        db.session.commit()
+        list_id = book_list.id
+
+    client = library_app.app.test_client()
+    response = client.post('/login', data={'username': library_app.ADMIN_USERNAME, 'password': library_app.ADMIN_PASSWORD})
+    assert response.status_code == 302
+    return library_app, client, list_id
+
+
+# Muc hien tai + mot chut du phong; tang ngan sach phai co ly do (sua trong cung commit)
+@pytest.mark.parametrize('url, max_queries', [
+    ('/', 16),
+    ('/?sort=date_desc&page=2', 16),
+    ('/favorites', 12),
+    ('/bookmarks', 12),
+])
+def test_page_query_budget(library, url, max_queries):
+    library_app, client, _ = library
+    response = library_app.assert_endpoint_query_budget(client, url, max_queries)
+    assert response.status_code == 200
+
+
+def test_view_list_query_budget(library):
+    library_app, client, list_id = library
+    response = library_app.assert_endpoint_query_budget(client, f'/lists/{list_id}', 14)
+    assert response.status_code == 200
+
+
+def test_query_budget_reports_overrun(library):
+    library_app, client, _ = library
+    with pytest.raises(AssertionError, match='Vuot ngan sach truy van'):
+        library_app.assert_endpoint_query_budget(client, '/', 1)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""tag_count dem moi the mot lan cho moi sach (tua + tac gia), ke ca khi doi tua / tac gia hay xoa sach."""
+import pytest
+
+
+@pytest.fixture
+def owner(library_app):
+    with library_app.app.app_context():
+        db = library_app.db
+        user = library_app.User(username=f'tags{library_app.User.query.count()}', password='x', is_active=True)
+        db.session.add(user)
+        db.session.commit()
+        yield library_app, user.id
+
+
+def add_book(library_app, user_id, title, author, fmt, tags):
+    db = library_app.db
+    book = library_app.Book(title=title, author=author, filename=f'{title}.{fmt}', format=fmt, tags=tags, user_id=user_id)
+    db.session.add(book)
+    db.session.flush()
+    library_app.sync_book_tags([book.id])
+    db.session.commit()
+    return book
+
+
+def tag_count(library_app, user_id, name):
+    db = library_app.db
+    return db.session.execute(
+        db.select(library_app.TagCount.count).join(library_app.Tag, library_app.Tag.id == library_app.TagCount.tag_id)
+        .where(library_app.TagCount.user_id == user_id, library_app.Tag.name == name)
+    ).scalar()
+
+
+def test_formats_of_one_work_count_once(owner):
+    library_app, user_id = owner
+    add_book(library_app, user_id, 'A', 'X', 'epub', 't1')
+    add_book(library_app, user_id, 'A', 'X', 'pdf', 't1')
+    assert tag_count(library_app, user_id, 't1') == 1
+
+
+def test_rename_and_delete_keep_count_in_step(owner):
+    library_app, user_id = owner
+    db = library_app.db
+    epub = add_book(library_app, user_id, 'A', 'X', 'epub', 't1')
+    pdf = add_book(library_app, user_id, 'A', 'X', 'pdf', 't1')
+
+    pdf.title = 'B' # Hai sach khac nhau, moi sach mot lan
+    db.session.commit()
+    assert tag_count(library_app, user_id, 't1') == 2
+
+    pdf.title, pdf.author = 'A', 'X' # Gop lai
+    db.session.commit()
+    assert tag_count(library_app, user_id, 't1') == 1
+
+    pdf.author = 'Y'
+    db.session.commit()
+    library_app.delete_book_rows([epub.id, pdf.id])
+    db.session.commit()
+    assert tag_count(library_app, user_id, 't1') == 0